@@ -176,6 +176,25 @@ def main(argv=None):
 		parser_recolor.add_argument('--combine', dest='mode', choices=['sum','product'], default='sum', help='how to combine multiple mappings, if specified')
 		parser_recolor.add_argument('--output-mapping-image', dest='mapping_output', help="Write an image representation of the palette mapping to this path, if given")
 		parser_recolor.add_argument('--reindex', default=[], action='append', help='if a mapping was given, use a different palette within the the mapping as the "source" palette. Must be a name of a palette in the mapping or integer index')
+		parser_recolor.add_argument('--engine', choices=['lookup','mask'], default='lookup', 
+			help=dedent("""\
+			how to match pixels to the source palette. 'lookup' (default) matches every pixel 
+			in one pass; 'mask' is the original, slower per-color implementation, which gives 
+			identical results and is kept for comparison."""))
+		parser_recolor.add_argument('--indexed', action='store_true', 
+			help=dedent("""\
+			write indexed (palette-based) images. Each input image is converted to palette 
+			indices once, and each output only swaps in the colors of its palette; output 
+			files are also smaller. Images with more than 256 colors are written as RGBA."""))
+		parser_recolor.add_argument('--jobs', '-j', type=int, default=None, 
+			help='number of input images to process in parallel (default: one per CPU core)')
+		parser_recolor.add_argument('--threads', type=int, default=1, 
+			help='split each image into this many horizontal bands, processed in parallel; useful for very large images')
+		parser_recolor.add_argument('--tolerance', type=int, default=0, 
+			help=dedent("""\
+			Also recolor pixels whose colors differ from a source color by at most TOLERANCE in each of the R, G, B and A 
+			channels, as the nearest such source color; e.g. 1 or 2 to fix slight color drift. The number of such pixels is 
+			reported. Not supported by --engine mask."""))
 
 
 		# coerce subcommand
@@ -189,6 +208,18 @@ def main(argv=None):
 		parser_coerce.add_argument('--output', dest='output', action='store', nargs='+', #action=ExtendActionOverwriteDefault, nargs='+',
 							default=['%i/%p.%e'])
 		parser_coerce.add_argument('--palette', dest='palettes', default=['universal'], nargs='+')
+		parser_coerce.add_argument('--engine', choices=['lut','quantize'], default='quantize', 
+			help=dedent("""\
+			'quantize' (default) uses PIL's quantizer, which is faster for one-off palettes 
+			but does not always pick the nearest color. 'lut' replaces each pixel with the 
+			nearest palette color according to --metric; nearest colors are cached per 
+			palette, in memory and on disk."""))
+		parser_coerce.add_argument('--metric', choices=['rgb','lab'], default='rgb', 
+			help="color distance used by --engine lut: euclidean distance in RGB (default) or CIELAB")
+		parser_coerce.add_argument('--jobs', '-j', type=int, default=None, 
+			help='number of input images to process in parallel (default: one per CPU core)')
+		parser_coerce.add_argument('--threads', type=int, default=1, 
+			help='split each image into this many horizontal bands, processed in parallel; useful for very large images')
 
 
 		# convertpalette subcommand
@@ -209,7 +240,7 @@ def main(argv=None):
 			help='Convert a color mapping between formats',
 			description='Convert a color mapping (created with `lpctools colors create-mapping`) between formats.')	
 		parser_convertmapping.add_argument('--input', help='input color mapping; format will be inferred from file extension')
-		parser_convertmapping.add_argument('--output', help='output color mapping; format will be inferred from file extension')
+		parser_convertmapping.add_argument('--output', help='output color mapping; format will be inferred from file extension (.json, .png, or .npz for a compiled mapping, which is fastest to load)')
 		parser_convertmapping.add_argument('--palette-names', dest='names', default=[], action='extend', nargs='+', 
 			help=dedent("""\
 			specify or override the names for palettes given in INPUT. If 
@@ -233,7 +264,14 @@ def main(argv=None):
 		parser_mapping.add_argument('--to',  dest='target',  action='extend', nargs='+', 
 			help="path(s) to target palette(s); target palettes can be named by writing NAME=PATH")
 		parser_mapping.add_argument('--output', help='Filename to save the output mapping; format will be inferred from extension')
-		parser_mapping.add_argument('--strict', help='Advanced. Compare images pixelwise and produce a mapping of unique colors in SOURCE to unique pixel(s) in TARGET(s)', action='store_true')
+		parser_mapping.add_argument('--strict', help=dedent("""\
+			Advanced. Compare images pixelwise and produce a mapping of unique colors in SOURCE to unique pixel(s) in TARGET(s). 
+			SOURCE and TARGET(s) can also be directories; each image in SOURCE is then compared to the images with the 
+			same relative path in each TARGET, and the results are merged into one mapping."""), action='store_true')
+		parser_mapping.add_argument('--on-conflict', choices=['last','first','error'], default='last', 
+			help=dedent("""\
+			With --strict, what to do when one color in SOURCE corresponds to different colors in the TARGET(s) 
+			at different pixels: keep the 'last' (default) or 'first' colors seen, or stop with an 'error'."""))
 
 
 		parser_increment_shade = subparsers.add_parser('increment-shade', help='Increment each pixel matching a mask to a different color in the palette',
@@ -279,32 +317,74 @@ def main(argv=None):
 		parser_increment_shade.add_argument('--increments', nargs='+', required=True, metavar=('MASK_COLOR_1=INCREMENT_1','MASK_COLOR_2=INCREMENT_2'), help="For each MASK_COLOR_N, shift pixels in INPUT by to INCREMENT_N colors later in the palette.")
 		parser_increment_shade.add_argument('--overflow', choices=('squish','wrap'), default='squish', help="What do do if INCREMENT_N results in a palette index greater than the length of the palette (or less than zero).")
 		parser_increment_shade.add_argument('--mask',required=True)
+		parser_increment_shade.add_argument('--threads', type=int, default=1, 
+			help='split each image into this many horizontal bands, processed in parallel; useful for very large images')
 
-		# parser_concat_mappings = subparsers.add_parser('concat-mappings', help='Concatenates one or more mappings',
-		# 	formatter_class=argparse.RawTextHelpFormatter
-		# 	)	
-		# parser_concat_mappings.add_argument('--mapping', dest='mapping', help="path to source mapping(s)")
-		# parser_concat_mappings.add_argument('--from', dest='source', help="path to new source palette")
-		# parser_concat_mappings.add_argument('--to',  dest='target',  action='extend', nargs='+', 
-		# 	help="path(s) to additional target palette(s); target palettes can be named by writing NAME=PATH")
-		# parser_concat_mappings.add_argument('--output', help='Filename to save the output mapping; format will be inferred from extension')
-		# parser_concat_mappings.add_argument('--sort', help='sorts the mapping by alpha, then luminosity of the source palette', action='store_const', const='auto')
-		# parser_concat_mappings.add_argument('--filter', action='extend', nargs='+', help='filter the mapping to only include the listed palettes')
-		# parser_concat_mappings.add_argument('--drop', action='extend', nargs='+', help='filter the mapping to NOT include the listed palettes')
+		parser_concat_mappings = subparsers.add_parser('concat-mappings', help='Concatenates one or more mappings',
+			formatter_class=argparse.RawTextHelpFormatter
+			)	
+		parser_concat_mappings.add_argument('--mapping', dest='mapping', action='extend', nargs='+', required=True, 
+			help="path(s) to source mapping(s), or directories to search for mappings; all must have the same source colors")
+		parser_concat_mappings.add_argument('--from', dest='source', 
+			help="path to new source palette, with the same colors as the mappings' source palettes; or the name of a palette in the mappings")
+		parser_concat_mappings.add_argument('--to',  dest='target',  action='extend', nargs='+', 
+			help="path(s) to additional target palette(s); target palettes can be named by writing NAME=PATH")
+		parser_concat_mappings.add_argument('--output', required=True, 
+			help='Filename to save the output mapping; format will be inferred from extension (.npz for a compiled mapping)')
+		parser_concat_mappings.add_argument('--sort', help='sorts the mapping by alpha, then luminosity of the source palette', action='store_const', const='auto')
+		parser_concat_mappings.add_argument('--filter', action='extend', nargs='+', help='filter the mapping to only include the listed palettes')
+		parser_concat_mappings.add_argument('--drop', action='extend', nargs='+', help='filter the mapping to NOT include the listed palettes')
 
 		parser_doctor = subparsers.add_parser('doctor', help='Highlight all pixels that are not found in the palette')
-		parser_doctor.add_argument('--input', required=True)
+		parser_doctor.add_argument('--input', action='extend', nargs='+', required=True, 
+			help='input image(s), or directories to search for .png images')
 		parser_doctor.add_argument('--palette', required=True)
 		parser_doctor.add_argument('--color', default='#ff0000', help='What color to use in the output image for colors not found in the palette')
 		parser_doctor.add_argument('--squish-transparent', default=True, dest='squish_transparent', help='Treat all fully transparent colors as identical, even if they have different RGB values')
 		parser_doctor.add_argument('--ignore-transparent', default=True, dest='ignore_transparent', help='Do not complain if the image includes fully transparent pixels, even if they are missing from the palette')
-		parser_doctor.add_argument('--output', required=True)
-
+		parser_doctor.add_argument('--output', action='extend', nargs='+', 
+			help=dedent("""\
+			Where to save images highlighting the pixels not found in the palette, for each input which has any. 
+			Either one output per input, or a single pattern with placeholders, e.g. %%i.doctor.png; see `recolor --help`"""))
+		parser_doctor.add_argument('--tolerance', type=int, default=0, 
+			help='Accept colors which differ from a palette color by at most TOLERANCE in each of the R, G, B and A channels')
+		parser_doctor.add_argument('--report', help='Filename to save a JSON report of the pixels and colors not found in the palette, for each input')
+		parser_doctor.add_argument('--jobs', '-j', type=int, default=None, 
+			help='number of images to check in parallel (default: one per CPU core)')
+
+
+		parser_audit = subparsers.add_parser('audit', help='Report which colors of a palette, and which other colors, are used across many images')
+		parser_audit.add_argument('--input', action='extend', nargs='+', required=True, 
+			help='input image(s), or directories to search for .png images')
+		parser_audit.add_argument('--palette', required=True)
+		parser_audit.add_argument('--report', help=dedent("""\
+			Filename to save a JSON report with the number of pixels of, and the images using, each color in the 
+			palette and each color not in the palette, and a summary for each image"""))
+		parser_audit.add_argument('--jobs', '-j', type=int, default=None, 
+			help='number of images to scan in parallel (default: one per CPU core)')
+		parser_audit.add_argument('--no-cache', dest='cache', action='store_false', 
+			help="Don't read or write the cache of each image's colors; by default, images are only scanned again if their contents change")
+
+		parser_collapse = subparsers.add_parser('collapse-recolors', help='Find images which are recolors of each other, and express each group as one base image and a mapping')
+		parser_collapse.add_argument('--input', action='extend', nargs='+', required=True, 
+			help='input image(s), or directories to search for .png images')
+		parser_collapse.add_argument('--output-dir', help=dedent("""\
+			Directory in which to save, for each group of recolors, the first image of the group and a mapping from its 
+			colors to those of each image in the group. Both are named after the first image."""))
+		parser_collapse.add_argument('--format', choices=['json','png','npz'], default='json', help='format of the mappings to save')
+		parser_collapse.add_argument('--jobs', '-j', type=int, default=None, 
+			help='number of images to read in parallel (default: one per CPU core)')
 
 		parser_difference = subparsers.add_parser('difference', help='Produce a mask indicating pixels where two images are identical')
 		parser_difference.add_argument('--input', nargs='+')
 		parser_difference.add_argument('--output')
 		parser_difference.add_argument('--close', action='store_true', help='Perform morphological closing on the identity mask; useful for removing small dissimilarities and creating larger contiguous regions')
+		parser_difference.add_argument('--report', help=dedent("""\
+			Filename to save a JSON report of the changed pixels: the bounding box of each connected region of changed 
+			pixels, and which images differ from the first in it"""))
+		parser_difference.add_argument('--layout', help=dedent("""\
+			If given with --report, also report the changed pixels within each frame of this spritesheet layout 
+			(name of a built-in layout or path to a JSON layout)"""))
 
 
 
@@ -313,7 +393,7 @@ def main(argv=None):
 		from .recolor import (main_recolor, main_convertpalette, main_convertmapping, 
 				main_create_mapping, main_concat_mappings, 
 				main_coerce, main_increment_shade, main_difference,
-				main_doctor)
+				main_doctor, main_audit, main_collapse_recolors)
 		sub_commands = {
 			'recolor': main_recolor,
 			'convert-palette': main_convertpalette,
@@ -322,8 +402,10 @@ def main(argv=None):
 			'coerce': main_coerce,
 			'increment-shade': main_increment_shade,
 			'difference': main_difference,
-			'doctor':main_doctor
-			# ,'concat-mappings': main_concat_mappings
+			'doctor':main_doctor,
+			'audit': main_audit,
+			'collapse-recolors': main_collapse_recolors,
+			'concat-mappings': main_concat_mappings
 		}
 
 		sub_commands[args.command](args)
@@ -333,7 +415,7 @@ def main(argv=None):
 		
 		from .arrange import (
 			layouts, distribute_layers, IMAGE_FRAME_PATTERN, 
-			main_pack, main_unpack, main_repack, main_distribute, main_distribute_repack, main_convert_layout, 
+			main_pack, main_unpack, main_repack, main_repack_tree, main_distribute, main_distribute_repack, main_convert_layout, 
 			main_combine, main_separate)
 
 		parser = argparse.ArgumentParser(description='Utilities for arranging and combining images', prog='lpctools arrange')
@@ -483,6 +565,35 @@ def main(argv=None):
 		parser_repack.add_argument('--output-dir',dest='output_dir', default='.', 
 			help='Directory where the repacked spritesheet(s) should be placed; each output file will be named OUTPUT_DIR/TO.png (default: %(default)s)')
 
+		# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *  
+		# repack-tree subcommand
+		parser_repacktree = subparsers.add_parser('repack-tree', help='Re-packs every spritesheet in directory tree(s) from one layout to other(s)',
+			formatter_class=argparse.RawTextHelpFormatter,
+			epilog=dedent(f"""\
+			Each .png image found (recursively) in the --input directories is repacked from the FROM layout 
+			to each TO layout, as by `repack`. The directory structure of each input directory is mirrored 
+			in OUTPUT_DIR. Sheets are processed in parallel, and sheets which cannot be repacked are reported 
+			rather than stopping the batch.
+
+			Output file names are given by --output, where %%b is the name of the input sheet (without 
+			extension) and %%l is the layout name. By default, this is '%%b.png' for a single TO layout, 
+			or '%%b/%%l.png' for several.
+
+			{layouts_help}
+			""")
+			)
+
+		parser_repacktree.add_argument('--input', required=True, help='Directories (or individual sheets) to repack', action='extend', nargs='+')
+		parser_repacktree.add_argument('--from', dest='from_layout', default='universal', help='Layout of the original spritesheet images (default: %(default)s)')
+		parser_repacktree.add_argument('--to', dest='to_layouts', required=True, nargs='+', help='New layout(s) to create')
+		parser_repacktree.add_argument('--mirror', dest='mirror', default=False, help='w:e to generate east frames by mirroring west frames, e:w for the opposite')
+		parser_repacktree.add_argument('--output-dir', dest='output_dir', required=True, help='Directory where the repacked tree should be placed')
+		parser_repacktree.add_argument('--output', dest='output_pattern', default=None, 
+			help='Pattern for how to name output files, relative to the mirrored directory of each sheet.')
+		parser_repacktree.add_argument('--jobs', '-j', type=int, default=None, 
+			help='number of sheets to process in parallel (default: one per CPU core)')
+		parser_repacktree.add_argument('--report', help='Filename to save a JSON report of the status and outputs of each input sheet')
+
 		# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *  
 		# distribute subcommand
 		layers_help = '\n'.join(wrap_fill(f"- {layer_name} : {layer['help']}", width=79) for layer_name, layer in distribute_layers.items() )
@@ -653,6 +764,7 @@ def main(argv=None):
 		sub_commands = {
 			'unpack':main_unpack,
 			'repack':main_repack,
+			'repack-tree':main_repack_tree,
 			'pack':main_pack,
 			'distribute':main_distribute,
 			'distribute-repack': main_distribute_repack,
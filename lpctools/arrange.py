@@ -25,6 +25,77 @@ from .utils import *
 COLOR_TRANSPARENT = Color(255,255,255,0)
 
 
+class FrameImages(collections.abc.MutableMapping):
+	"""
+	A mapping of `AnimationFrameID`s to frame images, as returned by `SpritesheetLayout.unpack_images`. 
+	Frames can be stored as (height, width, 4) RGBA arrays, usually views into one decoded 
+	spritesheet; a `PIL.Image` is only created (and kept) when a frame is looked up. Use `array` to 
+	get a frame as an array without creating an image. `infos` holds the `PIL.Image.info` of the 
+	sheet each frame came from (e.g. its `icc_profile`), which is copied to the frame's image, as 
+	`Image.crop` would.
+	"""
+	def __init__(self, frames=None, filenames=None, infos=None):
+		# afi -> numpy.ndarray or PIL.Image, in order of insertion
+		self.frames = dict(frames or {})
+		self.filenames = dict(filenames or {})
+		self.infos = dict(infos or {})
+		self._images = {}
+
+	def __getitem__(self, afi):
+		frame = self.frames[afi]
+		if not isinstance(frame, np.ndarray):
+			return frame
+		if afi not in self._images:
+			img = Image.fromarray(frame)
+			if afi in self.infos:
+				img.info = self.infos[afi].copy()
+			if afi in self.filenames:
+				setattr(img, 'filename', self.filenames[afi])
+			self._images[afi] = img
+		return self._images[afi]
+
+	def __setitem__(self, afi, frame):
+		self.frames[afi] = frame
+		self._images.pop(afi, None)
+
+	def __delitem__(self, afi):
+		del self.frames[afi]
+		self._images.pop(afi, None)
+
+	def __contains__(self, afi):
+		return afi in self.frames
+
+	def __iter__(self):
+		return iter(self.frames)
+
+	def __len__(self):
+		return len(self.frames)
+
+	def array(self, afi):
+		"""frame `afi` as a (height, width, 4) RGBA array, which may be a read-only view"""
+		frame = self.frames[afi]
+		if isinstance(frame, np.ndarray):
+			return frame
+		return np.array(frame.convert('RGBA') if frame.mode != 'RGBA' else frame)
+
+	def update(self, other=(), **kwargs):
+		# merge arrays without creating images
+		if isinstance(other, FrameImages):
+			for afi in other.frames:
+				self._images.pop(afi, None)
+			self.frames.update(other.frames)
+			self.filenames.update(other.filenames)
+			self.infos.update(other.infos)
+			self._images.update(other._images)
+			other = ()
+		super().update(other, **kwargs)
+
+	def copy(self):
+		out = FrameImages(self.frames, self.filenames, self.infos)
+		out._images = self._images.copy()
+		return out
+
+
 class ImageCollection(dict):
 
 	def pick_image():
@@ -104,17 +175,131 @@ class FrameTemplate():
 		return FrameTemplate(_offset, _mask, **kwargs)
 
 
+class SheetTemplate():
+	"""
+	The `FrameTemplate`s of every frame of `layout`, for a whole spritesheet at once: `offsets` maps 
+	each `AnimationFrameID` to the offset of its image within the frame, and `mask` is a (height, width) 
+	boolean array of the pixels of the sheet to remove. `apply` gives the same result as applying the 
+	template of each frame with `distribute_images`, then packing the frames with `layout.pack_images`.
+	"""
+	def __init__(self, layout, offsets=None, mask=None):
+		self.layout = load_layout(layout)
+
+		# frames without an offset are centered, as by `FrameTemplate`
+		frame_w, frame_h = self.layout.frame_size
+		self.offsets = { afi: (frame_w//2, frame_h//2) for afi in self.layout }
+		self.offsets.update(offsets or {})
+
+		shape = self.layout.pixel_size[::-1]
+		if mask is None:
+			self.mask = np.zeros(shape, dtype=bool)
+		else:
+			self.mask = np.asarray(mask, dtype=bool)
+			if self.mask.shape != shape:
+				raise Exception(f"Mask shape {self.mask.shape} != layout shape {shape}")
+
+	def apply(self, images, verbose=False):
+		"""
+		places the best image from `images` (see `pick_image`) for each frame of the layout at the 
+		offset of that frame, in one preallocated array, then clears the masked pixels of the 
+		whole sheet at once; returns a `PIL.Image`
+		"""
+		if not isinstance(images, FrameImages):
+			images = FrameImages(images)
+
+		out = self.layout.new_array()
+		frame_w, frame_h = self.layout.frame_size
+
+		# the same image is usually picked for many frames; convert each one once
+		arrays = {}
+		for (x, y), afi in self.layout.inverse_positions.items():
+			c = pick_afi(afi, images)
+			if c is None:
+				if verbose: print(f"miss {afi}")
+				continue
+			if verbose: print(f"PICK {afi} --> {c}  '{images.filenames.get(c, getattr(images.frames[c], 'filename', ''))}'")
+			if c not in arrays:
+				arrays[c] = images.array(c)
+
+			# offset coordinates are w/r/t the middle of the image; parts outside of the frame are cropped
+			frame = arrays[c]
+			left = self.offsets[afi][0] - frame.shape[1]//2
+			top = self.offsets[afi][1] - frame.shape[0]//2
+			x0, y0 = max(left, 0), max(top, 0)
+			x1, y1 = min(left + frame.shape[1], frame_w), min(top + frame.shape[0], frame_h)
+			if x1 > x0 and y1 > y0:
+				out[y*frame_h + y0 : y*frame_h + y1, x*frame_w + x0 : x*frame_w + x1] = frame[y0-top:y1-top, x0-left:x1-left]
+
+		# masked pixels become (0,0,0,0), as by `Image.composite`; whole pixels are written at once
+		np.copyto(out.view('<u4')[..., 0], 0, where=self.mask)
+		return Image.fromarray(out)
+
+	@staticmethod
+	def from_images(layout, offsets_image=None, masks_image=None, mask_colors=['#ffffff']):
+		"""
+		like `get_frame_templates_from_images`: the offset of each frame is the top-left corner of the 
+		bounding box (see `Image.getbbox`) of that frame in `offsets_image`, and pixels of `masks_image` with any of 
+		`mask_colors` are masked; both images are decoded and searched once, for the whole sheet.
+		"""
+		layout = load_layout(layout)
+
+		offsets = {}
+		if offsets_image is not None:
+			# pixels which `Image.getbbox` counts: those which are not transparent, for images with 
+			# an alpha band, or else those with any nonzero band; this depends on the mode of the image
+			arr = np.array(offsets_image)
+			layout.check_size((arr.shape[1], arr.shape[0]), getattr(offsets_image, 'filename', ''))
+			if getattr(offsets_image, 'mode', 'RGBA') in ('RGBA', 'RGBa', 'LA', 'La', 'PA'):
+				visible = arr[..., -1] > 0
+			else:
+				visible = arr.reshape(arr.shape[:2] + (-1,)).any(axis=-1)
+			(cols, rows), (frame_w, frame_h) = layout.size, layout.frame_size
+			visible = visible[:rows*frame_h, :cols*frame_w].reshape((rows, frame_h, cols, frame_w)).swapaxes(1, 2)
+
+			found = visible.any(axis=(2, 3))
+			lefts = visible.any(axis=2).argmax(axis=-1)
+			tops = visible.any(axis=3).argmax(axis=-1)
+			for afi, (x, y) in layout.positions.items():
+				if found[y, x]:
+					offsets[afi] = (int(lefts[y, x]), int(tops[y, x]))
+
+		mask = None
+		if masks_image is not None:
+			if not isinstance(mask_colors, np.ndarray):
+				mask_colors = [Color(mask_color).to_array() for mask_color in mask_colors]
+			# compare whole pixels at once
+			mask_keys = np.ascontiguousarray(mask_colors, dtype='uint8').view('<u4').reshape(-1)
+			masked = np.isin(layout.frame_grid(masks_image).view('<u4')[..., 0], mask_keys)
+
+			# each position uses the mask of its frame, which is the first position of that frame in the layout
+			mask_grid = np.zeros_like(masked)
+			for (x, y), afi in layout.inverse_positions.items():
+				x0, y0 = layout.positions[afi]
+				mask_grid[y, x] = masked[y0, x0]
+			rows, cols, frame_h, frame_w = mask_grid.shape
+			mask = mask_grid.swapaxes(1, 2).reshape((rows*frame_h, cols*frame_w))
+
+		return SheetTemplate(layout, offsets, mask)
+
+
 def pick_image(afi, images, verbose=False):
 	""" picks the best image corresponding to (animation_name, direction, frame), from a collection of images
 	"""
+	c = pick_afi(afi, images)
+	if c is None:
+		if verbose: print(f"miss {afi}")
+		return None
 
+	if verbose: print(f"PICK {afi} --> {c}  '{images[c].filename}'")
+	return images[c]
+
+def pick_afi(afi, images):
+	""" returns the key of the image `pick_image` would pick for `afi`, or None if there is none
+	"""
 	choices = [afi, (afi[0], afi[1], None), (None, afi[1], afi[2]), (None, afi[1], None), (None, None, None)]
 	for c in choices:
 		if c in images:
-			if verbose: print(f"PICK {afi} --> {c}  '{images[c].filename}'")
-			return images[c]
-
-	if verbose: print(f"miss {afi}")
+			return c
 
 # def get_animation_templates(animations, offsets_image, masks_image, layout, verbose=False, **kwargs):
 # 	offsets_images = layout.unpack_images(offsets_image)
@@ -140,7 +325,13 @@ def get_frame_templates_from_images(layout, offsets_image=None, masks_image=None
 	if offsets_image is None:
 		offsets_images = {}
 	else: 
-		offsets_images = layout.unpack_images(offsets_image)
+		# crop frames in the mode of `offsets_image`, since `getbbox` depends on it
+		layout.check_size(offsets_image.size, getattr(offsets_image, 'filename', ''))
+		frame_w, frame_h = layout.frame_size
+		offsets_images = {}
+		for afi in layout:
+			x, y = layout.get_pixel_pos(afi)
+			offsets_images[afi] = offsets_image.crop((x, y, x + frame_w, y + frame_h))
 
 	if masks_image is None:
 		masks_images = {}
@@ -277,10 +468,17 @@ class SpritesheetLayout():
 			size = _size
 		self.size = tuple(int(s) for s in size)
 		self.frame_size = tuple(frame_size)
+		self._hash = None
 
 	def __eq__(self, other):
 		return (self.frame_size == other.frame_size) and (self.positions == other.positions)
 
+	def __hash__(self):
+		# layouts are not changed after they are built, so they can be used as keys for `remap_plans`
+		if self._hash is None:
+			self._hash = hash((self.frame_size, frozenset(self.positions.items())))
+		return self._hash
+
 	def __iter__(self):
 		yield from self.positions
 
@@ -320,52 +518,116 @@ class SpritesheetLayout():
 				self.size[1] * self.frame_size[1])
 
 	def pack_images(self, images, verbose=True):
+		"""
+		arranges `images` (a mapping of `AnimationFrameID`s to `PIL.Image`s or (height, width, 4) 
+		RGBA arrays, e.g. a `FrameImages`) into a new spritesheet image with this layout. Frames 
+		are copied into one preallocated array; positions with no image are left transparent. 
+		Images with a different size than the frames of this layout are centered in their frame.
+		"""
 		assert isinstance(images, collections.abc.Mapping)
-		images = { AnimationFrameID(*afi): img for afi, img in images.items() }
+		if not isinstance(images, FrameImages):
+			images = FrameImages({ AnimationFrameID(*afi): img for afi, img in images.items() })
 
-		new_img = Image.new('RGBA',self.pixel_size, color=COLOR_TRANSPARENT)
-
-		for pos, afi in self.inverse_positions.items():
-			if afi not in images or images[afi] == None and verbose:
-				print(f"Warning: missing {afi} for this layout")
-			else:
-				img = images[afi]
-				if img.size != self.frame_size:
-					print(f"Warning: image size {img.size} != layout frame size {frame_size}")
-					tl = self.get_pixel_pos(afi)
-					pos = (
-						tl[0] + self.frame_size[0]//2 - img.size[0]//2,
-						tl[1] + self.frame_size[1]//2 - img.size[1]//2
-					)
-				else: pos = self.get_pixel_pos(afi)
-				new_img.paste(img, pos)
+		out = self.new_array()
+		grid = self.frame_grid(out)
+		frame_w, frame_h = self.frame_size
 
-		# for afi in images.keys():
-		# 	if afi not in self.positions:
-		# 		raise Exception(f"Do not know how to place animation '{afi}' in this layout")
+		for (x, y), afi in self.inverse_positions.items():
+			if afi not in images or images.frames[afi] is None:
+				if verbose: print(f"Warning: missing {afi} for this layout")
+				continue
 
+			frame = images.array(afi)
+			if frame.shape[:2] == (frame_h, frame_w):
+				grid[y, x] = frame
+			else:
+				print(f"Warning: image size {frame.shape[1::-1]} != layout frame size {self.frame_size}")
+				# center the image in its frame; parts outside of the sheet are cropped, as by `Image.paste`
+				left = x*frame_w + frame_w//2 - frame.shape[1]//2
+				top = y*frame_h + frame_h//2 - frame.shape[0]//2
+				x0, y0 = max(left, 0), max(top, 0)
+				x1, y1 = min(left + frame.shape[1], out.shape[1]), min(top + frame.shape[0], out.shape[0])
+				if x1 > x0 and y1 > y0:
+					out[y0:y1, x0:x1] = frame[y0-top:y1-top, x0-left:x1-left]
+
+		return Image.fromarray(out)
+
+	def pack_grid(self, grid):
+		"""
+		inverse of `frame_grid`: arranges a (rows, cols, frame_height, frame_width, 4) array of 
+		frames into a spritesheet image with a single reshape
+		"""
+		(cols, rows), (frame_w, frame_h) = self.size, self.frame_size
+		grid = np.asarray(grid, dtype='uint8')
+		if grid.shape != (rows, cols, frame_h, frame_w, 4):
+			raise Exception(f"Expected frames with shape {(rows, cols, frame_h, frame_w, 4)}; got {grid.shape}")
+		return Image.fromarray(np.ascontiguousarray(grid.swapaxes(1, 2)).reshape((rows*frame_h, cols*frame_w, 4)))
+
+	def new_array(self):
+		"""a transparent (height, width, 4) RGBA array the size of this layout"""
+		out = np.empty((self.pixel_size[1], self.pixel_size[0], 4), dtype='uint8')
+		# filling whole pixels at once is much faster than broadcasting a 4-byte color
+		out.view('<u4').fill(np.array(COLOR_TRANSPARENT, dtype='uint8').view('<u4')[0])
+		return out
 
-		# for afi, img in images.items():
-		# 	new_img.paste(img, self.get_pixel_pos(afi))
+	def frame_grid(self, img):
+		"""
+		decodes `img` (a `PIL.Image` or (height, width, 4) array) once, and returns a 
+		(rows, cols, frame_height, frame_width, 4) view of it, where `[y, x]` is the frame at 
+		position (x, y) of this layout. Views of decoded images are read-only; views of arrays 
+		can be written to. Raises an exception if `img` is smaller than the layout; 
+		the right and bottom edges of larger images are ignored.
+		"""
+		arr = img if isinstance(img, np.ndarray) else np.array(img.convert('RGBA') if img.mode != 'RGBA' else img)
+		self.check_size((arr.shape[1], arr.shape[0]), getattr(img, 'filename', ''))
+
+		(cols, rows), (frame_w, frame_h) = self.size, self.frame_size
+		arr = arr[:rows*frame_h, :cols*frame_w]
+		if not isinstance(img, np.ndarray):
+			arr.flags.writeable = False
+		return arr.reshape((rows, frame_h, cols, frame_w, 4)).swapaxes(1, 2)
+
+	def check_size(self, size, filename=''):
+		"""raises an exception if an image of `size` is smaller than this layout; warns if it is larger"""
+		if size != self.pixel_size:
+			if size[0] < self.pixel_size[0] or size[1] < self.pixel_size[1]:
+				raise Exception(f"Image {filename} is smaller than layout; Image size: {size}, layout size: {self.pixel_size}")
+			else: 
+				print(f"Warning: image {filename} is larger than layout; right- and/or bottom- edge of image will be trimmed. Image {filename} size: {size}, layout size: {self.pixel_size}")
 
-		return new_img
+	def unpack_arrays(self, img):
+		"""
+		returns a dict of each `AnimationFrameID` in this layout to a (frame_height, frame_width, 4) 
+		read-only view of its frame in `img`; see `frame_grid`
+		"""
+		grid = self.frame_grid(img)
+		return { afi: grid[y, x] for afi, (x, y) in self.positions.items() }
 
 	def unpack_images(self, img, verbose=True):
-		if img.size != self.pixel_size:
-			if img.size[0] < self.pixel_size[0] or img.size[1] < self.pixel_size[1]:
-				raise Exception(f"Image {img.filename} is smaller than layout; Image size: {img.size}, layout size: {self.pixel_size}")
-			else: 
-				print(f"Warning: image {img.filename} is larger than layout; right- and/or bottom- edge of image will be trimmed. Image {img.filename} size: {img.size}, layout size: {self.pixel_size}")
-
-		output = {}
-		for afi, pos in self.positions.items():
-			(x, y) = self.get_pixel_pos(afi)
-			bbox = (x, y, x+self.frame_size[0], y+self.frame_size[0])
-			sub_img = img.crop( bbox )
-			setattr(sub_img,'filename', f"{img.filename}#({x},{y})={afi}")
-			output[afi] = sub_img
+		"""
+		splits `img` into its frames; returns a `FrameImages` mapping each `AnimationFrameID` in 
+		this layout to its frame. The image is decoded once, and frames are views into it until 
+		they are used as images, which keep the `info` (e.g. color profile) of `img`.
+		"""
+		filename = getattr(img, 'filename', '')
+		info = getattr(img, 'info', {})
+		frames = self.unpack_arrays(img)
+		filenames = { afi: "{}#({},{})={}".format(filename, *self.get_pixel_pos(afi), afi) for afi in frames }
+		return FrameImages(frames, filenames, { afi: info for afi in frames })
 
-		return output
+	def remap_plan(self, from_layouts, mirror=False):
+		"""
+		returns a `RemapPlan` which packs the frames of sheets in `from_layouts` into this layout. 
+		Plans are compiled once for each combination of layouts and `mirror`, and kept in `remap_plans`.
+		"""
+		if isinstance(from_layouts, (str, SpritesheetLayout)):
+			from_layouts = [from_layouts]
+		from_layouts = tuple(load_layout(layout) for layout in from_layouts)
+		# layouts which are equal may still differ in size, which plans depend on
+		key = (tuple((layout.size, layout) for layout in from_layouts), (self.size, self), tuple(mirror) if mirror else False)
+		if key not in remap_plans:
+			remap_plans[key] = RemapPlan(from_layouts, self, mirror=mirror)
+		return remap_plans[key]
 
 	def to_array(self):
 		out = np.empty(shape=self.size, dtype='object')
@@ -681,6 +943,121 @@ def save_layout(layout, path, **kwargs):
 		raise Exception(f'Do not know how to save a layout to a {ext} file. Possible extensions: {layout_savers.keys()}')
 
 
+# ((size, layout) of from_layouts, (size, layout) of to_layout, mirror) -> RemapPlan
+remap_plans = {}
+
+class RemapPlan():
+	"""
+	A compiled conversion of sheets in `from_layouts` to `to_layout`; equivalent to unpacking each sheet 
+	(later sheets replacing frames of earlier ones), mirroring frames as `mirror_images` does, and 
+	packing the frames with `to_layout.pack_images`. 
+
+	`blocks` is a list of `RemapPlan.Block`s, each of which copies `width` neighboring frames from 
+	row `src[1]` of sheet number `source`, starting at column `src[0]`, to row `dst[1]` of the new 
+	sheet, starting at column `dst[0]`; each frame is mirrored if `flip` is 'h' or 'v'. `missing` lists 
+	frames of `to_layout` which are in none of the sheets. Use `SpritesheetLayout.remap_plan` to get a 
+	cached plan.
+	"""
+	Block = collections.namedtuple('Block', ['source', 'src', 'dst', 'width', 'flip'])
+
+	def __init__(self, from_layouts, to_layout, mirror=False):
+		self.from_layouts = tuple(from_layouts)
+		self.to_layout = to_layout
+		self.mirror = mirror
+
+		for layout in self.from_layouts:
+			if layout.frame_size != to_layout.frame_size:
+				raise Exception(f"Cannot remap frames of size {layout.frame_size} to a layout with frame size {to_layout.frame_size}")
+
+		# afi -> (source, (x, y), flip)
+		frames = {}
+		for source, layout in enumerate(self.from_layouts):
+			frames.update({ afi: (source, pos, None) for afi, pos in layout.positions.items() })
+		if mirror:
+			from_direction, to_direction = mirror
+			orientation = {'e': 'h', 'w':'h', 'n':'v', 's':'v'}[to_direction]
+			frames.update({ AnimationFrameID(afi.name, to_direction, afi.frame): (source, pos, orientation) 
+				for afi, (source, pos, _) in frames.items() if afi.direction == from_direction })
+
+		self.blocks = []
+		self.missing = []
+		for (x, y), afi in sorted(to_layout.inverse_positions.items(), key=lambda item: item[0][::-1]):
+			if afi not in frames:
+				self.missing.append(afi)
+				continue
+			source, (sx, sy), flip = frames[afi]
+
+			# extend the last block if this frame follows it in both sheets
+			if self.blocks:
+				last = self.blocks[-1]
+				if (last.source, last.flip) == (source, flip) and \
+					last.dst == (x - last.width, y) and last.src == (sx - last.width, sy):
+					self.blocks[-1] = last._replace(width=last.width + 1)
+					continue
+			self.blocks.append(RemapPlan.Block(source, (sx, sy), (x, y), 1, flip))
+
+	def rects(self):
+		"""yields (source, source_box, destination_box, flip) for each block, with boxes in pixels as (left, top, right, bottom)"""
+		frame_w, frame_h = self.to_layout.frame_size
+		def box(pos, width):
+			return (pos[0]*frame_w, pos[1]*frame_h, (pos[0] + width)*frame_w, (pos[1] + 1)*frame_h)
+		for block in self.blocks:
+			yield block.source, box(block.src, block.width), box(block.dst, block.width), block.flip
+
+	def apply(self, imgs, verbose=False):
+		"""
+		packs `imgs`, one `PIL.Image` or (height, width, 4) array per layout of `from_layouts`, 
+		into a new image with `to_layout`
+		"""
+		if not isinstance(imgs, (list, tuple)):
+			imgs = [imgs]
+		if len(imgs) != len(self.from_layouts):
+			raise Exception(f"Expected {len(self.from_layouts)} images, one for each source layout; got {len(imgs)}")
+		grids = [layout.frame_grid(img) for layout, img in zip(self.from_layouts, imgs)]
+
+		out = self.to_layout.new_array()
+		out_grid = self.to_layout.frame_grid(out)
+		for block in self.blocks:
+			(sx, sy), (x, y) = block.src, block.dst
+			frames = grids[block.source][sy, sx:sx + block.width]
+			if block.flip == 'h':
+				frames = frames[:, :, ::-1]
+			elif block.flip == 'v':
+				frames = frames[:, ::-1]
+			out_grid[y, x:x + block.width] = frames
+
+		if verbose:
+			for afi in self.missing:
+				print(f"Warning: missing {afi} for this layout")
+		return Image.fromarray(out)
+
+
+def remap_images(imgs, from_layouts, to_layout, mirror=False, verbose=False):
+	"""
+	packs the frames of `imgs` (each with the corresponding layout of `from_layouts`) into a new 
+	image with `to_layout`. Uses a cached `RemapPlan` unless frame sizes of the layouts differ, 
+	in which case frames are unpacked, mirrored and re-packed one by one.
+	"""
+	if not isinstance(imgs, (list, tuple)):
+		imgs = [imgs]
+	if isinstance(from_layouts, (str, SpritesheetLayout)):
+		from_layouts = [from_layouts]
+	from_layouts = [load_layout(layout) for layout in from_layouts]
+	to_layout = load_layout(to_layout)
+
+	if all(layout.frame_size == to_layout.frame_size for layout in from_layouts):
+		return to_layout.remap_plan(from_layouts, mirror=mirror).apply(imgs, verbose=verbose)
+
+	unpacked_images = FrameImages()
+	for img, from_layout in zip(imgs, from_layouts):
+		unpacked_images.update( from_layout.unpack_images(img) )
+	if mirror:
+		orientation = {'e': 'h', 'w':'h', 'n':'v', 's':'v'}[mirror[1]]
+		unpacked_images = mirror_images(unpacked_images, 
+			from_direction=mirror[0], to_direction=mirror[1], orientation=orientation, verbose=verbose)
+	return to_layout.pack_images(unpacked_images, verbose=verbose)
+
+
 
 IMAGE_FRAME_PATTERN = '%n-%d-%f.png'
 
@@ -752,11 +1129,17 @@ def mirror_images(images, from_direction='e', to_direction='w', orientation='h',
 	"""
 	new_images = images.copy()
 
-	for afi, image in images.items():
+	for afi in images:
 		if afi.direction == from_direction:
 			new_afi = AnimationFrameID(afi.name, to_direction, afi.frame)
 			if verbose: print(f"{afi} --({orientation})-> {new_afi}")
-			new_images[new_afi] = image.transpose(Image.FLIP_LEFT_RIGHT if orientation == 'h' else PIL.Image.Transpose.FLIP_TOP_BOTTOM)
+			if isinstance(images, FrameImages) and isinstance(images.frames[afi], np.ndarray):
+				# flipping an array is just another view
+				new_images[new_afi] = images.frames[afi][:, ::-1] if orientation == 'h' else images.frames[afi][::-1]
+				if afi in images.infos:
+					new_images.infos[new_afi] = images.infos[afi]
+			else:
+				new_images[new_afi] = images[afi].transpose(Image.FLIP_LEFT_RIGHT if orientation == 'h' else Image.FLIP_TOP_BOTTOM)
 	return new_images
 
 def pack_animations(image_paths, layout, output=None, pattern=IMAGE_FRAME_PATTERN, verbose=False):
@@ -802,18 +1185,10 @@ def repack_animations(images, from_layouts, to_layouts, output_dir='.', output_p
 		print("Input images: {images}")
 		print("Reading from layouts: {from_layouts}")
 
-	unpacked_images = {}
+	sheets = []
 	for image_path, from_layout in zip(images, from_layouts):
 		if verbose: print(f"{image_path} -> {from_layout}")
-		img = Image.open(image_path)
-		from_layout = load_layout(from_layout)
-		unpacked_images.update( from_layout.unpack_images(img) )
-		if verbose: print(f"= {len(unpacked_images)} images total")
-
-	if mirror:
-		orientation = {'e': 'h', 'w':'h', 'n':'v', 's':'v'}[mirror[1]]
-		unpacked_images = mirror_images(unpacked_images, 
-			from_direction=mirror[0], to_direction=mirror[1], orientation=orientation, verbose=verbose)
+		sheets.append(Image.open(image_path))
 
 	if verbose: print("Writing to layouts: {to_layouts}")
 
@@ -821,8 +1196,7 @@ def repack_animations(images, from_layouts, to_layouts, output_dir='.', output_p
 		output_pattern = str(Path(output_dir) / "%l.png")
 
 	for layout_name in to_layouts:
-		layout = load_layout(layout_name)
-		new_img = layout.pack_images(unpacked_images)
+		new_img = remap_images(sheets, from_layouts, layout_name, mirror=mirror, verbose=verbose)
 		outfile = mkdirpf(format_placeholders(output_pattern, {'%l':layout_name}))
 		if verbose: print(f"- Saved {layout_name} -> {outfile}")
 		new_img.save(outfile)
@@ -831,9 +1205,10 @@ def repack_animations(images, from_layouts, to_layouts, output_dir='.', output_p
 def parse_mirror(arg_mirror):
 	if arg_mirror:
 		if arg_mirror == True or arg_mirror == 'true':
-			mirror = ('e','w')
+			return ('e','w')
 		else:
-			mirror = tuple(arg_mirror.split(':'))
+			return tuple(arg_mirror.split(':'))
+	return False
 
 
 def main_repack(args):
@@ -843,6 +1218,76 @@ def main_repack(args):
 		mirror=parse_mirror(args.mirror), verbose=args.verbose)
 
 
+def repack_tree(inputs, from_layout, to_layouts, output_dir='.', output_pattern=None, mirror=False, jobs=1, verbose=False):
+	"""
+	repacks every sheet in `inputs` (paths to images, or directories to search for .png images) 
+	from `from_layout` to each of `to_layouts`, in a pool of `jobs` processes (all cores if None). 
+	The directory structure of each input directory is mirrored in `output_dir`; within it, each 
+	output file is named by `output_pattern`, where %b is the basename of the sheet (without 
+	extension) and %l is the layout name. By default, this is '%b.png' for a single layout, or 
+	'%b/%l.png' for several.
+
+	returns a report: a dict of input path -> {'status': 'ok', 'outputs': [paths]}, or 
+	{'status': 'error', 'error': message} if the sheet could not be repacked.
+	"""
+	to_layouts = listify(to_layouts)
+	if output_pattern is None:
+		output_pattern = '%b.png' if len(to_layouts) == 1 else str(Path('%b') / '%l.png')
+
+	tasks = []
+	for input in listify(inputs):
+		root = input if os.path.isdir(input) else os.path.dirname(input)
+		for path in find_images([input]):
+			tasks.append((path, str(Path(output_dir) / os.path.relpath(os.path.dirname(path), root))))
+	if verbose: print(f"Repacking {len(tasks)} sheets from {from_layout} to {to_layouts}")
+
+	# layouts are sent to each worker once; each worker then compiles its remap plans once
+	results = pool_map(repack_file, tasks, jobs=jobs, shared=dict(
+		from_layout=load_layout(from_layout), 
+		to_layouts={ name: load_layout(name) for name in to_layouts }, 
+		output_pattern=output_pattern, mirror=mirror, verbose=verbose))
+
+	report = {}
+	for (path, _), (result, error) in zip(tasks, results):
+		if error is not None:
+			report[path] = { 'status': 'error', 'error': error.strip().splitlines()[-1] }
+			if verbose: print(f"Error processing {path}:\n{error}")
+		else: 
+			report[path] = { 'status': 'ok', **result }
+	return report
+
+def repack_file(input_path, output_dir, from_layout, to_layouts, output_pattern, mirror=False, verbose=False):
+	"""repacks the sheet at `input_path` to each of `to_layouts` (a dict of names to layouts); see `repack_tree`"""
+	img = Image.open(input_path)
+	basename = os.path.splitext(os.path.basename(input_path))[0]
+
+	outputs = []
+	for layout_name, to_layout in to_layouts.items():
+		new_img = remap_images(img, from_layout, to_layout, mirror=mirror)
+		outfile = mkdirpf(output_dir, format_placeholders(output_pattern, {'%b':basename, '%l':layout_name}))
+		new_img.save(outfile)
+		outputs.append(outfile)
+		if verbose: print(f"- {input_path} -> {outfile}")
+	return { 'outputs': outputs }
+
+def main_repack_tree(args):
+	import json
+	report = repack_tree(args.input, args.from_layout, args.to_layouts, 
+		output_dir=args.output_dir, output_pattern=args.output_pattern, 
+		mirror=parse_mirror(args.mirror), jobs=args.jobs, verbose=args.verbose)
+
+	failed = {path: r for path, r in report.items() if r['status'] != 'ok'}
+	print(f"Repacked {len(report) - len(failed)} of {len(report)} sheets")
+	for path, r in failed.items():
+		print(f"- {path}: {r['error']}")
+
+	if args.report is not None:
+		if args.verbose: print(f"Writing report to {args.report}")
+		mkdirpf(args.report)
+		with open(args.report, 'w') as f:
+			json.dump(report, f, indent=2)
+
+
 def separate(images, from_layouts, verbose=False, **kwargs):
 	animations = set()
 	for from_layout in from_layouts:
@@ -864,7 +1309,8 @@ def main_separate(args):
 		mirror=parse_mirror(args.mirror), verbose=args.verbose)
 
 def combine(inputs, layout, output=None, verbose=False):
-	unpacked_images = {}
+	sheets = []
+	from_layouts = []
 
 	def guess_layout(img_path):
 		basename, ext = os.path.splitext(os.path.basename(img_path))
@@ -881,9 +1327,8 @@ def combine(inputs, layout, output=None, verbose=False):
 		if from_layout is not None:
 			if verbose:
 				print(f"{img_path} -> layout {from_layout}")
-			img = Image.open(img_path)
-			from_layout = load_layout(from_layout)
-			unpacked_images.update( from_layout.unpack_images(img) )
+			sheets.append(Image.open(img_path))
+			from_layouts.append(from_layout)
 
 	for p in inputs:
 		if os.path.isdir(p):
@@ -894,8 +1339,7 @@ def combine(inputs, layout, output=None, verbose=False):
 			guess_layout_and_load_img(p)
 
 
-	to_layout = load_layout(layout)
-	img = to_layout.pack_images(unpacked_images)
+	img = remap_images(sheets, from_layouts, layout, verbose=verbose)
 
 	if output is not None:
 		img.save(output)
@@ -960,6 +1404,24 @@ def make_frame_templates_per_layer(layout, layers, offsets_image=None, masks_ima
 	return layer_templates
 
 
+def make_sheet_templates_per_layer(layout, layers, offsets_image=None, masks_image=None):
+	"""like `make_frame_templates_per_layer`, but makes one `SheetTemplate` per layer"""
+	offsets_image = Image.open(offsets_image) if offsets_image is not None else None
+	masks_image = Image.open(masks_image) if masks_image is not None else None
+
+	layer_templates = {}
+
+	for layer_name, layer_args in layers.items():
+
+		layer_templates[layer_name] = SheetTemplate.from_images(
+			layout = layout,
+			offsets_image = Image.open(layer_args['offsets_image']) if 'offsets_image' in layer_args else offsets_image,
+			masks_image   = Image.open(layer_args['masks_image']) if 'masks_image' in layer_args else masks_image, 
+			mask_colors   = layer_args['mask_colors'] if 'mask_colors' in layer_args else ['#ffffff']
+		)
+	return layer_templates
+
+
 def distribute_repack(image_paths, from_layout, to_layout, offsets_image, masks_image, outputs=None, 
 	layers=distribute_layers, verbose=False): 
 
@@ -976,8 +1438,8 @@ def distribute_repack(image_paths, from_layout, to_layout, offsets_image, masks_
 	if len(outputs) != len(image_paths):
 		raise Exception("Must provide same number of --input and --output images")
 
-	# construct a set of frame templates for each layer
-	layer_templates = make_frame_templates_per_layer(to_layout, layers, offsets_image, masks_image)
+	# construct a sheet template for each layer
+	layer_templates = make_sheet_templates_per_layer(to_layout, layers, offsets_image, masks_image)
 
 	output_imgs = []
 	for image_group_layers, group_output_path in zip(image_groups, outputs):
@@ -994,13 +1456,7 @@ def distribute_repack(image_paths, from_layout, to_layout, offsets_image, masks_
 
 				# maybe there are no images for this layer; if so, save some loops
 				if len(images) > 0: 
-					
-					images_distributed = distribute_images(images, 
-						templates=layer_templates[layer_name], 
-						positions=to_layout, 
-						verbose=verbose)
-
-					img_layers.append( to_layout.pack_images(images_distributed) )
+					img_layers.append( layer_templates[layer_name].apply(images, verbose=verbose) )
 					continue
 
 			if verbose: print('- found no images')
@@ -1056,10 +1512,10 @@ def distribute(image_paths, offsets_image, masks_image, layout, output=None,
 
 	if verbose: print(f"output: {output}\n")	
 
-	# construct a set of frame templates for each layer; each layer needs a different 
+	# construct a sheet template for each layer; each layer needs a different 
 	# template since it may use a different mask image and/or color. offsets could 
 	# technically be different too
-	layer_templates = make_frame_templates_per_layer(layout, layers, offsets_image, masks_image)
+	layer_templates = make_sheet_templates_per_layer(layout, layers, offsets_image, masks_image)
 
 	output_imgs = []
 	for image_group, group_output in zip(image_groups, output):
@@ -1077,12 +1533,7 @@ def distribute(image_paths, offsets_image, masks_image, layout, output=None,
 				if verbose: print('- found no images')
 				continue
 
-			images_distributed = distribute_images(images, 
-				templates=layer_templates[layer_name], 
-				positions=layout, 
-				verbose=verbose)
-
-			img_layers.append( layout.pack_images(images_distributed) )
+			img_layers.append( layer_templates[layer_name].apply(images, verbose=verbose) )
 
 		img = composite_images(img_layers)
 
@@ -1,7 +1,12 @@
 import os
 import collections.abc
 import colorsys
+import contextlib
+import hashlib
+import itertools
 import json
+import struct
+import zlib
 import numpy as np
 
 from PIL import Image
@@ -90,48 +95,267 @@ class Color(RGBATuple):
 			return (255,255,255,0)
 		return tuple(t)
 
+
+def pack_colors(arr):
+	"""packs a (..., 4) array of RGBA values into a (...) array of uint32 keys, one key per color"""
+	arr = np.ascontiguousarray(arr, dtype='uint8')
+	if arr.shape[-1] != 4:
+		raise Exception(f"Can only pack RGBA colors; got array of shape {arr.shape}")
+	return arr.view('<u4')[..., 0]
+
+def unpack_colors(keys):
+	"""inverse of `pack_colors`; converts a (...) array of uint32 keys to a (..., 4) uint8 array of RGBA values"""
+	keys = np.ascontiguousarray(keys, dtype='<u4')
+	return keys[..., np.newaxis].view('uint8')
+
+# key of rgba(255,255,255,0), which stands in for all fully transparent colors
+TRANSPARENT_KEY = int(pack_colors(np.array([255,255,255,0])))
+
+def unique_colors(keys, max_colors=None, chunk_size=1<<16):
+	"""
+	finds the distinct colors among `keys` (as produced by `pack_colors`), in order of their first 
+	appearance in `keys.ravel()` (i.e. left-to-right, top-to-bottom for an image)
+
+	If `max_colors` is given, returns None as soon as more than `max_colors` distinct colors have 
+	been found; `keys` are then scanned in chunks of `chunk_size`, so images with many colors 
+	are rejected without sorting all of their pixels.
+	"""
+	keys = np.ravel(keys)
+	if max_colors is None:
+		_, first = np.unique(keys, return_index=True)
+		return keys[np.sort(first)]
+
+	found = np.empty(0, dtype='<u4')
+	for start in range(0, len(keys), chunk_size):
+		chunk = keys[start:start+chunk_size]
+		_, first = np.unique(chunk, return_index=True)
+		new = chunk[np.sort(first)]
+		found = np.concatenate([found, new[~np.isin(new, found)]])
+		if len(found) > max_colors:
+			return None
+	return found
+
+def lookup_colors(keys, palette_keys, threads=1):
+	"""
+	finds the position of each of `keys` within `palette_keys` (both as produced by `pack_colors`)
+
+	returns (index, found), two arrays with the same shape as `keys`. Where `found` is False, the
+	color is not in the palette and `index` is meaningless. If `palette_keys` contains duplicates,
+	the last matching position is returned (like a dict built from the palette). With `threads` > 1, 
+	bands of rows of `keys` are searched in parallel.
+	"""
+	keys = np.asarray(keys, dtype='<u4')
+	palette_keys = np.asarray(palette_keys, dtype='<u4')
+	if len(palette_keys) == 0:
+		return np.zeros(keys.shape, dtype=np.intp), np.zeros(keys.shape, dtype=bool)
+
+	# sorted keys + binary search; side='right' with a stable sort lands on the last duplicate
+	order = np.argsort(palette_keys, kind='stable')
+	sorted_keys = palette_keys[order]
+	index = np.empty(keys.shape, dtype=np.intp)
+	found = np.empty(keys.shape, dtype=bool)
+
+	def lookup_band(start, stop):
+		band = keys[start:stop]
+		pos = np.searchsorted(sorted_keys, band, side='right') - 1
+		np.maximum(pos, 0, out=pos)
+		np.equal(sorted_keys[pos], band, out=found[start:stop])
+		np.take(order, pos, out=index[start:stop])
+
+	map_row_bands(lookup_band, len(keys), threads)
+	return index, found
+
+
+def match_colors(keys, palette_keys, tolerance=0, threads=1):
+	"""
+	like `lookup_colors`, but colors which are not in the palette are also matched to the nearest 
+	palette color (see `nearest_colors_within`) if it differs by at most `tolerance` in each of the 
+	R, G, B and A channels. The nearest colors are only searched for among the distinct unmatched 
+	colors, so this costs little more than `lookup_colors` for images with few such colors.
+
+	returns (index, found, snapped), where `snapped` is the number of `keys` which were matched 
+	within the tolerance rather than exactly
+	"""
+	index, found = lookup_colors(keys, palette_keys, threads=threads)
+	if tolerance <= 0 or found.all() or len(palette_keys) == 0:
+		return index, found, 0
+
+	missing = ~found
+	unmatched, inverse = np.unique(np.asarray(keys)[missing], return_inverse=True)
+	nearest, within = nearest_colors_within(unmatched, palette_keys, tolerance)
+	index[missing] = nearest[inverse]
+	found[missing] = within[inverse]
+	return index, found, int(np.count_nonzero(within[inverse]))
+
+def nearest_colors_within(keys, palette_keys, tolerance, chunk_size=4096):
+	"""
+	for each of `keys`, finds the index of the nearest of `palette_keys` (both packed as by 
+	`pack_colors`) by euclidean distance in RGBA, among those which differ by at most `tolerance` 
+	in every channel; ties go to the earlier palette color. 
+
+	returns (index, within); where `within` is False, no palette color is close enough.
+	"""
+	colors = unpack_colors(keys).reshape((-1, 4)).astype('int32')
+	palette = unpack_colors(palette_keys).reshape((-1, 4)).astype('int32')
+
+	index = np.zeros(len(colors), dtype=np.intp)
+	within = np.zeros(len(colors), dtype=bool)
+	far = np.iinfo('int32').max
+	for start in range(0, len(colors), chunk_size):
+		diff = colors[start:start+chunk_size, np.newaxis, :] - palette[np.newaxis, :, :]
+		dist = np.where(np.abs(diff).max(axis=-1) <= tolerance, (diff * diff).sum(axis=-1), far)
+		index[start:start+chunk_size] = dist.argmin(axis=-1)
+		within[start:start+chunk_size] = dist.min(axis=-1) < far
+	return index, within
+
+
+def parse_hex_colors(colors):
+	"""
+	parses a list of '#rrggbb' or '#rrggbbaa' strings into an (n_colors, 4) uint8 array; returns 
+	None if any of `colors` is not such a string (see `Color` for other formats)
+	"""
+	rows = []
+	for c in colors:
+		if not isinstance(c, str) or len(c) not in (7, 9) or c[0] != '#':
+			return None
+		try:
+			row = bytes.fromhex(c[1:])
+		except ValueError:
+			return None
+		if len(row) * 2 != len(c) - 1:
+			return None
+		rows.append(row if len(row) == 4 else row + b'\xff')
+	return np.frombuffer(b''.join(rows), dtype='uint8').reshape((-1, 4))
+
+def rgb_to_hsv_array(arr):
+	"""
+	converts an (..., 3) or (..., 4) array of RGB(A) values to HSV(A), with the same values as 
+	`colorsys.rgb_to_hsv` (and `Color.to_hsv`) gives for each color; returns a float array
+	"""
+	arr = np.asarray(arr, dtype=float)
+	r, g, b = arr[..., 0], arr[..., 1], arr[..., 2]
+	maxc = arr[..., :3].max(axis=-1)
+	minc = arr[..., :3].min(axis=-1)
+	rangec = maxc - minc
+	gray = rangec == 0
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		s = np.where(gray, 0.0, rangec / maxc)
+		rc = (maxc - r) / rangec
+		gc = (maxc - g) / rangec
+		bc = (maxc - b) / rangec
+	h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+	h = np.where(gray, 0.0, np.mod(h / 6.0, 1.0))
+
+	return np.stack([h, s, maxc] + ([arr[..., 3]] if arr.shape[-1] == 4 else []), axis=-1)
+
 class ImagePalette():
+	"""
+	An ordered list of colors, stored as an (n_colors, 4) uint8 array (`self.array`); iterating or 
+	indexing the palette gives `Color`s. Colors are found in the palette by their packed keys 
+	(see `pack_colors`); if a color appears more than once, `index` gives its last position.
+	"""
 	def __init__(self, colors=[], name='', unique=False):
-		# self._colors = [getrgba(c) for c in colors]
-		self._colors = [Color(c) for c in colors]
-		if unique: self._colors = list(dict.fromkeys(self._colors))
+		if isinstance(colors, ImagePalette):
+			array = colors.array
+		elif isinstance(colors, np.ndarray) and colors.ndim == 2 and colors.shape[1] in (3, 4) and colors.dtype != object:
+			array = colors
+		else: 
+			colors = list(colors)
+			array = parse_hex_colors(colors)
+			if array is None:
+				# self._colors = [getrgba(c) for c in colors]
+				array = [Color(c) for c in colors]
+		array = np.array(array, dtype='uint8')
+		if array.ndim != 2:
+			array = array.reshape((-1, array.shape[-1] if len(array) > 0 else 4))
+		if array.shape[1] == 3:
+			array = np.concatenate([array, np.full((len(array), 1), 255, dtype='uint8')], axis=1)
+
+		if unique: 
+			_, first = np.unique(pack_colors(array), return_index=True)
+			array = array[np.sort(first)]
+
+		self.array = np.ascontiguousarray(array)
+		self.array.flags.writeable = False
+		self.packed = pack_colors(self.array)
+		self._colors = None
+		self._sorted = None
 
-		self._dict = dict((c, i) for i, c in enumerate(self._colors))
 		if not name and hasattr(colors, 'name'):
 			self.name = colors.name
 		else:
 			self.name = name
 
+	@property
+	def colors(self):
+		"""the colors of the palette, as a list of `Color`s"""
+		if self._colors is None:
+			self._colors = [Color._make(c) for c in self.array.tolist()]
+		return self._colors
+
 	def __iter__(self):
-		yield from self._colors
+		yield from self.colors
 
 	def __len__(self):
-		return len(self._colors)
+		return len(self.array)
 
 	def __contains__(self, rgb):
-		return rgb in self._dict
+		key = self._color_key(rgb)
+		return key is not None and self.lookup(key)[1].item()
 
 	def __getitem__(self, i):
-		return self._colors[i]
+		return self.colors[i]
 
 	def __repr__(self):
-		r = 'ImagePalette([' + ",".join( f"'{c.to_hex(color=True)}'" for c in self._colors ) + ']'
+		r = 'ImagePalette([' + ",".join( f"'{c.to_hex(color=True)}'" for c in self ) + ']'
 		if self.name != '':
 			r += f",name={self.name}"
 		r += ")"
 		return r
 
+	@staticmethod
+	def _color_key(color):
+		arr = np.asarray(color)
+		if arr.shape != (4,) or not np.issubdtype(arr.dtype, np.integer) or (arr < 0).any() or (arr > 255).any():
+			return None
+		return pack_colors(arr)
+
+	def lookup(self, keys):
+		"""
+		finds packed colors `keys` in this palette; returns (index, found) as for `lookup_colors`
+		"""
+		if self._sorted is None:
+			order = np.argsort(self.packed, kind='stable')
+			self._sorted = (order, self.packed[order])
+		order, sorted_keys = self._sorted
+
+		keys = np.asarray(keys, dtype='<u4')
+		if len(sorted_keys) == 0:
+			return np.zeros(keys.shape, dtype=np.intp), np.zeros(keys.shape, dtype=bool)
+		pos = np.maximum(np.searchsorted(sorted_keys, keys, side='right') - 1, 0)
+		return order[pos], sorted_keys[pos] == keys
+
 	def index(self, color):
-		return self._dict[color]
+		key = self._color_key(color)
+		if key is not None:
+			i, found = self.lookup(key)
+			if found:
+				return int(i)
+		raise KeyError(color)
 
 	def to_hex(self):
-		return [rgb2hex(*x) for x in self._colors]
+		return [rgb2hex(*x[:3]) for x in self.array.tolist()]
 
 	def to_hsv(self):
-		return [x.to_hsv() for x in self._colors]
+		return [(h, s, int(v), int(a)) for h, s, v, a in self.to_hsv_array().tolist()]
+
+	def to_hsv_array(self):
+		"""the colors of the palette in HSV(A), as an (n_colors, 4) float array; see `rgb_to_hsv_array`"""
+		return rgb_to_hsv_array(self.array)
 
 	def reorder(self, ordering):
-		return ImagePalette(np.array(self._colors)[ordering], name=self.name)
+		return ImagePalette(self.array[np.asarray(ordering, dtype=np.intp)], name=self.name)
 
 	def argsort(self, param='auto'):
 		"""
@@ -148,7 +372,7 @@ class ImagePalette():
 			raise Exception(f"Unknown sort key(s) {channel_order}. ")
 
 		# k channels x N colors
-		hsvs = np.array(self.to_hsv(), dtype=int).T
+		hsvs = self.to_hsv_array().astype(int).T
 		channels = ['hue','saturation','value','alpha']
 
 		# re-arrange channels in desired order
@@ -159,94 +383,101 @@ class ImagePalette():
 		sort_order = np.lexsort(data)
 		return sort_order
 
-		# hsvs = self.to_hsv()
-		# key = {
-		# 	'hue':lambda h,s,v,a: h,
-		# 	'saturation':lambda h,s,v,a: s,
-		# 	'value':lambda h,s,v,a: v
-		# }[param]
-
-		# keyed = np.fromiter((key(*c) for c in self), count=len(self), dtype=int)
-		# sort_order = np.argsort(keyed)
-		# return sort_order
-		# else:
-			# raise Exception(f"Unknown sort key {param}")
-			# return ImagePalette([colorsys.hsv_to_rgb(*x) for x in hsvs_sorted])	
-
 	def sort(self, param='value'):
 		return self.reorder(self.argsort(param))
 
 	def sort_hue(self):
-		# hsvs = self.to_hsv()
-		# hsvs_sorted = sorted(hsvs, key=lambda h,s,v: h)
-		# return ImagePalette([colorsys.hsv_to_rgb(*x) for x in hsvs_sorted])
 		return self.sort(param='hue')
 
 	def drop_transparent(self):
-		return ImagePalette(c for c in self if c.a != 0)
+		return ImagePalette(self.array[self.array[:, 3] != 0])
 
 	def has_alpha(self):
 		"""determines whether colors in palette have alpha values that are not 0 or 255"""
-		return any(c.a != 0 and c.a != 255 for c in self)
+		alpha = self.array[:, 3]
+		return bool(((alpha != 0) & (alpha != 255)).any())
 
 	def drop_alpha(self, unique=False):
-		return ImagePalette((c.drop_alpha() for c in self), name=self.name, unique=unique)
+		array = self.array.copy()
+		array[:, 3] = 255
+		return ImagePalette(array, name=self.name, unique=unique)
 
 	def unique(self):
 		return ImagePalette(self, name=self.name, unique=True)
 
-	def find_colors(self, img, squish_transparent=True, ignore_transparent=True):
-		"""find pixels in img that contain colors in this palette"""
+	def find_colors(self, img, squish_transparent=True, ignore_transparent=True, tolerance=0):
+		"""
+		find pixels in img that contain colors in this palette; returns a (height, width) boolean 
+		array, or None if img is not an image or array. If `squish_transparent`, all fully 
+		transparent colors are treated as identical; if `ignore_transparent`, transparent pixels 
+		are always considered found. Colors within `tolerance` of a palette color are also 
+		considered found; see `match_colors`.
+		"""
+		keys = self._find_keys(img, squish_transparent)
+		if keys is None:
+			return None
+		palette_keys = self._find_palette_keys(squish_transparent, ignore_transparent)
+		if tolerance > 0:
+			return match_colors(keys, palette_keys, tolerance)[1]
+		return np.isin(keys, palette_keys)
 
+	@staticmethod
+	def _find_keys(img, squish_transparent=True):
 		if isinstance(img, Image.Image):
-			arr = np.array(img)
-		elif isinstance(img, np.array):
+			arr = np.array(img if img.mode == 'RGBA' else img.convert('RGBA'))
+		elif isinstance(img, np.ndarray):
 			arr = img
 		else: return None
 
+		keys = pack_colors(arr)
 		if squish_transparent:
-			arr[arr[:,:,3] == 0] = [255,255,255,0]
+			keys = np.where(arr[..., 3] == 0, np.uint32(TRANSPARENT_KEY), keys)
+		return keys
 
-		found_pixels = np.zeros(arr.shape[0:2])
-
-		colors = list(self)
+	def _find_palette_keys(self, squish_transparent=True, ignore_transparent=True):
+		keys = self.packed
+		if squish_transparent:
+			keys = np.where(self.array[:, 3] == 0, np.uint32(TRANSPARENT_KEY), keys)
 		if ignore_transparent:
-			colors = colors + [(255,255,255,0)]
+			keys = np.append(keys, np.uint32(TRANSPARENT_KEY))
+		return keys
 
-		for c in colors:
-
-			# find pixels in `mask` matching `mask_color`
-			c_arr = Color(c).to_array()
-			found_pixels = np.logical_or(found_pixels, (arr == c_arr[np.newaxis, np.newaxis, :]).all(axis=-1) )
-
-		return found_pixels
+	def doctor_image(self, img, color='#ff0000', squish_transparent=True, ignore_transparent=True, tolerance=0):
+		"""
+		finds pixels of img whose colors are not in this palette, or not within `tolerance` of a 
+		color in this palette (see `match_colors`); returns a dict with:
 
-	def doctor_image(self, img, color='#ff0000', squish_transparent=True, ignore_transparent=True):
-		# import pdb; pdb.set_trace()
-		# 
+		- 'colors': an `ImagePalette` of the colors not in the palette, in order of appearance
+		- 'counts': the number of pixels of each of those colors
+		- 'snapped': the number of pixels which are within `tolerance` of, but not exactly, a palette color
+		- 'img': an image with the offending pixels set to `color`, and transparent elsewhere
+		"""
 		# find which pixels have colors in palette
-		good_pixels = self.find_colors(img, squish_transparent)
-		bad_pixels = ~good_pixels
+		keys = self._find_keys(img, squish_transparent)
+		_, found, snapped = match_colors(keys, self._find_palette_keys(squish_transparent, ignore_transparent), tolerance)
+		bad_pixels = ~found
 
 		# find unique colors that don't appear in palette
-		bad_pixel_colors = bad_pixels[:,:,np.newaxis].reshape(img.size[0]*img.size[1], 4) 
-		bad_pixel_colors_uniq = unique_rows(bad_pixel_colors).astype(int)
-		bad_palette = ImagePalette(bad_pixel_colors_uniq)
+		bad_keys = keys[bad_pixels]
+		bad_keys_uniq = unique_colors(bad_keys)
+		counts = np.bincount(np.searchsorted(np.sort(bad_keys_uniq), bad_keys), minlength=len(bad_keys_uniq))
+		counts = counts[np.argsort(np.argsort(bad_keys_uniq))]
 
 		# generate image showing locations of bad colors
-		c_arr = Color(color).to_array()
-		new_arr = bad_pixels[:,:,np.newaxis] * c_arr
+		new_arr = np.zeros(bad_pixels.shape + (4,), dtype='uint8')
+		new_arr[bad_pixels] = Color(color).to_array()
 		return {
-			'colors': bad_palette,
-			'img': Image.fromarray(new_arr)
+			'colors': ImagePalette(unpack_colors(bad_keys_uniq)),
+			'counts': counts.tolist(),
+			'snapped': snapped,
+			'img': Image.fromarray(new_arr, mode='RGBA')
 		}
 
 	def to_image(self, path=None):
-		img = Image.new('RGBA', size=(len(self), 1))
-		pixels = img.load()
-
-		for i, color in enumerate(self):
-			pixels[i, 0] = tuple(color)
+		if len(self) > 0:
+			img = Image.fromarray(self.array.reshape((1, len(self), 4)), mode='RGBA')
+		else:
+			img = Image.new('RGBA', size=(0, 1))
 
 		if path is not None:
 			img.save(path)
@@ -282,7 +513,14 @@ def load_palette_json(path, name=''):
 		data = json.load(f)
 	return ImagePalette(data, name=name)
 
-def load_palette_png(path, name='', squish_transparent=True):
+def load_palette_png(path, name='', squish_transparent=True, max_colors=None):
+	"""
+	loads the colors of an image as a palette. For indexed images, this is the image's palette; 
+	otherwise, the distinct colors of the image, in the order they first appear (left-to-right, 
+	top-to-bottom). If `squish_transparent`, all fully transparent colors are treated as 
+	rgba(255,255,255,0). If `max_colors` is given, raises an exception if the image has more 
+	colors than that.
+	"""
 	if isinstance(path, str):
 		img = Image.open(path)
 		bn, _ = os.path.splitext(os.path.basename(path))
@@ -294,24 +532,32 @@ def load_palette_png(path, name='', squish_transparent=True):
 
 	# for indexed image, get palette directly in order
 	if img.mode == 'P':
-		colors = img.getpalette()
+		colors = np.array(img.getpalette('RGBA'), dtype='uint8').reshape((-1, 4))
+
+		# transparency of indexed images is stored separately from the palette
+		transparency = img.info.get('transparency')
+		if isinstance(transparency, int):
+			colors[transparency, 3] = 0
+		elif isinstance(transparency, bytes):
+			colors[:len(transparency), 3] = np.frombuffer(transparency, dtype='uint8')[:len(colors)]
+		keys = pack_colors(colors)
 	else:
-		# does not preserve order of colors in image
-		# colors = [color for count, color in img.convert('RGBA').getcolors()]
-		
-		import pandas as pd
+		# n_pixels
+		keys = pack_colors(np.array(img.convert('RGBA'))).ravel()
 
-		# n_pixels x 4
-		img_pixels = np.array(img).reshape((-1, 4))
-		# colors = unique_rows(img_pixels)
-		
-		# treat all transparent pixels as equivalent by mapping all to rgba(255,255,255,0)
-		if squish_transparent:
-			img_pixels[img_pixels[:,3] == 0] = [255,255,255,0]
+	# treat all transparent pixels as equivalent by mapping all to rgba(255,255,255,0)
+	if squish_transparent:
+		transparent = unpack_colors(keys)[..., 3] == 0
+		keys = np.where(transparent, np.uint32(TRANSPARENT_KEY), keys)
+
+	if img.mode == 'P':
+		colors = unpack_colors(keys)
+	else:
+		keys = unique_colors(keys, max_colors=max_colors)
+		colors = unpack_colors(keys) if keys is not None else None
 
-		# probably slow but seems like the only sane way to preserve ordering
-		all_colors = [tuple(a) for a in img_pixels]
-		colors = pd.unique(all_colors)
+	if colors is None or (max_colors is not None and len(colors) > max_colors):
+		raise Exception(f"Image {bn or img} has more than {max_colors} colors")
 
 	return ImagePalette(colors, name=(name or bn))
 
@@ -368,9 +614,321 @@ def save_palette(pal, path, **kwargs):
 		raise Exception(f'Do not know how to save a palette to a {ext} file. Possible extensions: {palette_savers.keys()}')
 
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def read_png_chunks(data):
+	"""splits the bytes of a PNG file into a list of [chunk_type, chunk_data, crc]; returns None if `data` is not a PNG"""
+	if not data.startswith(PNG_SIGNATURE):
+		return None
+
+	chunks = []
+	pos = len(PNG_SIGNATURE)
+	while pos + 8 <= len(data):
+		length, chunk_type = struct.unpack('>I4s', data[pos:pos+8])
+		chunk_data = data[pos+8:pos+8+length]
+		crc = data[pos+8+length:pos+12+length]
+		chunks.append([chunk_type, chunk_data, crc])
+		pos += 12 + length
+		if chunk_type == b'IEND':
+			break
+	return chunks
+
+def write_png_chunks(chunks):
+	"""inverse of `read_png_chunks`; the CRC is computed for chunks where it is None"""
+	out = [PNG_SIGNATURE]
+	for chunk_type, chunk_data, crc in chunks:
+		if crc is None:
+			crc = struct.pack('>I', zlib.crc32(chunk_data, zlib.crc32(chunk_type)))
+		out += [struct.pack('>I', len(chunk_data)), chunk_type, chunk_data, crc]
+	return b''.join(out)
+
+def read_png_palette(chunks):
+	"""returns the palette of an indexed PNG as a (n_colors, 4) uint8 array, or None if the PNG is not indexed"""
+	chunk_data = { chunk_type: chunk_data for chunk_type, chunk_data, _ in chunks }
+
+	# color type 3 = indexed; the color type is byte 9 of the IHDR chunk
+	if b'IHDR' not in chunk_data or chunk_data[b'IHDR'][9] != 3 or b'PLTE' not in chunk_data:
+		return None
+
+	rgb = np.frombuffer(chunk_data[b'PLTE'], dtype='uint8').reshape((-1, 3))
+	colors = np.full((len(rgb), 4), 255, dtype='uint8')
+	colors[:, :3] = rgb
+
+	# tRNS gives alpha values for the first entries of the palette; the rest are opaque
+	alphas = np.frombuffer(chunk_data.get(b'tRNS', b''), dtype='uint8')[:len(rgb)]
+	colors[:len(alphas), 3] = alphas
+	return colors
+
+def replace_png_palette(chunks, colors):
+	"""
+	returns the bytes of a PNG file made from `chunks`, with the PLTE and tRNS chunks replaced
+	to hold `colors`, a (n_colors, 4) uint8 array. All other chunks, including the compressed 
+	image data, are copied unchanged.
+	"""
+	colors = np.asarray(colors, dtype='uint8')
+	alphas = colors[:, 3]
+
+	# tRNS only needs to extend to the last non-opaque entry
+	translucent = np.flatnonzero(alphas != 255)
+
+	new_chunks = []
+	for chunk in chunks:
+		if chunk[0] == b'tRNS':
+			continue
+		elif chunk[0] == b'PLTE':
+			new_chunks.append([b'PLTE', colors[:, :3].tobytes(), None])
+			if len(translucent) > 0:
+				new_chunks.append([b'tRNS', alphas[:translucent[-1]+1].tobytes(), None])
+		else:
+			new_chunks.append(chunk)
+	return write_png_chunks(new_chunks)
+
+
+class IndexedImage():
+	"""
+	An image whose pixels have been resolved against a palette once, so that any number of color
+	tables for that palette can then be applied to it. 
+
+	img : PIL.Image
+		image to recolor
+	palette : numpy.ndarray
+		(n_colors, 4) uint8 array of the colors to look for
+	src : PIL.Image, optional
+		if given, will search for colors of `palette` within this image, but will write new colors to img
+	indexed : bool
+		if True, `recolor` produces indexed ('P' mode) images that all share one plane of palette 
+		indices, as long as the image needs no more than 256 palette entries; `self.indexed` 
+		indicates whether that is the case.
+	threads : int
+		number of threads to split the image into horizontal bands for; see `map_row_bands`
+	tolerance : int
+		if > 0, pixels which differ from a palette color by at most this much in each channel are 
+		treated as that color (see `match_colors`); `self.snapped` is the number of such pixels
+	"""
+	def __init__(self, img, palette, src=None, indexed=False, threads=1, tolerance=0):
+		self.size = img.size
+		self.threads = threads
+		self.keys = pack_colors(np.array(img.convert('RGBA')))
+		if src is None:
+			src_keys = self.keys
+		else:
+			src_keys = pack_colors(np.array(src.convert('RGBA')))
+
+		self.n_colors = len(palette)
+
+		# index.shape == found.shape == (height, width)
+		self.index, self.found, self.snapped = match_colors(src_keys, pack_colors(palette), tolerance, threads=threads)
+
+		self.indexed = indexed and self._make_plane()
+
+	def _make_plane(self):
+		# identify each pixel by its entry in the palette, or, for pixels that are not in 
+		# the palette, by their own color (offset past the palette entries)
+		pixel_ids = np.where(self.found, self.index, self.keys.astype('int64') + self.n_colors)
+		ids, plane = np.unique(pixel_ids, return_inverse=True)
+		if len(ids) > 256:
+			return False
+
+		self.plane = np.ascontiguousarray(plane.reshape(self.keys.shape), dtype='uint8')
+		self.plane_ids = ids
+		return True
+
+	def share(self):
+		"""
+		moves the per-pixel arrays of this image into shared memory (see `SharedArray`), so that 
+		pickling the image to send it to worker processes only sends their handles. Returns a 
+		context manager that frees the shared memory.
+		"""
+		blocks = contextlib.ExitStack()
+		try:
+			self._shared = {}
+			for name in ['keys', 'index', 'found', 'plane']:
+				if hasattr(self, name):
+					self._shared[name] = blocks.enter_context(SharedArray.from_array(getattr(self, name)))
+					setattr(self, name, self._shared[name].array)
+			# runs first on exit: the blocks can only be detached once this image holds no views of them
+			blocks.callback(self._unshare)
+		except:
+			self._unshare()
+			blocks.close()
+			raise
+		return blocks
+
+	def _unshare(self):
+		# point the per-pixel arrays back at private copies
+		for name, shared in self.__dict__.pop('_shared', {}).items():
+			if shared.array is not None:
+				setattr(self, name, shared.array.copy())
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		for name in state.get('_shared', {}):
+			del state[name]
+		return state
+
+	def __setstate__(self, state):
+		for name, shared in state.get('_shared', {}).items():
+			state[name] = shared.array
+		self.__dict__.update(state)
+
+	def recolor(self, colors):
+		"""
+		returns a new image where each pixel matching entry `i` of the palette has color `colors[i]`;
+		other pixels are unchanged
+		"""
+		color_keys = pack_colors(colors)
+
+		if self.indexed:
+			in_palette = self.plane_ids < self.n_colors
+			entries = (self.plane_ids - self.n_colors).astype('<u4')
+			entries[in_palette] = color_keys[self.plane_ids[in_palette]]
+
+			# all output images share the same buffer for their pixel data
+			out_img = Image.frombuffer('P', self.size, self.plane, 'raw', 'P', 0, 1)
+			out_img.putpalette(unpack_colors(entries).tobytes(), rawmode='RGBA')
+			return out_img
+
+		if len(color_keys) == 0:
+			return Image.fromarray(unpack_colors(self.keys))
+
+		# work on packed colors so each color table is a single uint32 gather
+		out = np.empty(self.keys.shape, dtype='<u4')
+		def recolor_band(start, stop):
+			np.take(color_keys, self.index[start:stop], out=out[start:stop])
+			np.copyto(out[start:stop], self.keys[start:stop], where=~self.found[start:stop])
+
+		map_row_bands(recolor_band, len(out), self.threads)
+		return Image.fromarray(unpack_colors(out))
+
+
+class IndexedPNG():
+	"""
+	An indexed PNG file, recolored by rewriting its PLTE/tRNS chunks: the compressed image data
+	is copied unchanged, so the image is never decoded. Use `IndexedPNG.open`.
+	"""
+	def __init__(self, chunks, png_palette, palette, tolerance=0):
+		self.chunks = chunks
+		self.keys = pack_colors(png_palette)
+		# snapped counts palette entries, not pixels, since the image is never decoded
+		self.index, self.found, self.snapped = match_colors(self.keys, pack_colors(palette), tolerance)
+
+	@staticmethod
+	def open(data, palette, tolerance=0):
+		"""
+		data : bytes
+			contents of the PNG file
+		palette : numpy.ndarray
+			(n_colors, 4) uint8 array of the colors to look for
+		tolerance : int
+			see `IndexedImage`
+
+		Returns None if `data` is not an indexed PNG or none of the entries in its palette are 
+		in `palette`. 
+		"""
+		chunks = read_png_chunks(data)
+		if chunks is None:
+			return None
+
+		png_palette = read_png_palette(chunks)
+		if png_palette is None:
+			return None
+
+		png = IndexedPNG(chunks, png_palette, palette, tolerance)
+		if not png.found.any():
+			return None
+		return png
+
+	def recolor(self, colors):
+		"""
+		returns the bytes of a PNG file where each palette entry matching entry `i` of `palette` 
+		has color `colors[i]`; other entries are unchanged
+		"""
+		color_keys = pack_colors(colors)
+		return replace_png_palette(self.chunks, unpack_colors(np.where(self.found, color_keys[self.index], self.keys)))
+
+
+def union_mappings(mappings):
+	"""
+	finds the union of the source palettes of `mappings`
+
+	returns (source_keys, covers): `source_keys` are the packed colors of the union, in order of 
+	first appearance; `covers` has one (index, found, dest_keys) tuple per mapping, giving the 
+	position of each union color in that mapping's source palette (see `lookup_colors`) and the 
+	packed colors of its destination palettes.
+	"""
+	arrays = [mapping.to_arrays() for mapping in mappings]
+
+	# union of all source palettes, in order of first appearance
+	all_keys = np.concatenate([pack_colors(source) for source, _ in arrays])
+	_, first = np.unique(all_keys, return_index=True)
+	source_keys = all_keys[np.sort(first)]
+
+	# where each entry of the union appears in the source palette of each mapping
+	covers = []
+	for source, dests in arrays:
+		index, found = lookup_colors(source_keys, pack_colors(source))
+		covers.append((index, found, pack_colors(dests)))
+
+	return source_keys, covers
+
+def sum_mappings(mappings):
+	"""
+	expresses mappings that are each applied to the original image separately (as for 
+	`recolor(..., mode='sum')`) as color tables over the union of their source palettes, so the 
+	image only needs to be matched against one palette
+
+	returns (source, tables):
+	- source: the union of the source palettes of all mappings, as an (n_colors, 4) uint8 array
+	- tables: a generator of (palette_name, colors), one for each palette of each mapping, in 
+	  order, where `colors` is the (n_colors, 4) array that `source` is mapped to. Colors of 
+	  `source` that are not in a mapping's source palette are mapped to themselves.
+	"""
+	source_keys, covers = union_mappings(mappings)
+
+	def tables():
+		for mapping, (index, found, dest_keys) in zip(mappings, covers):
+			for palette_name, keys in zip(mapping.names, dest_keys):
+				yield palette_name, unpack_colors(np.where(found, keys[index], source_keys))
+
+	return unpack_colors(source_keys), tables()
+
+def compose_mappings(mappings, join_character='_'):
+	"""
+	combines mappings that are applied one after another (as for `recolor(..., mode='product')`)
+	into a single color table per combination of their palettes
+
+	returns (source, combinations):
+	- source: the union of the source palettes of all mappings, as an (n_colors, 4) uint8 array
+	- combinations: a generator of (palette_name, colors), one for each element of the cartesian 
+	  product of the palettes of all mappings, where `colors` is the (n_colors, 4) array that 
+	  `source` is mapped to. Combinations are only computed as they are requested.
+
+	Every mapping looks for colors in the original image, so if several mappings contain the 
+	same source color, the last of them determines its final color.
+	"""
+	source_keys, covers = union_mappings(mappings)
+
+	def combinations():
+		for combination in itertools.product(*[range(mapping.n_palettes) for mapping in mappings]):
+			color_keys = source_keys.copy()
+			for (index, found, dest_keys), j in zip(covers, combination):
+				if found.any():
+					color_keys = np.where(found, dest_keys[j][index], color_keys)
+
+			palette_name = ''.join(join_character + str(mapping.names[j]) 
+				for mapping, j in zip(mappings, combination)).lstrip(join_character)
+			yield palette_name, unpack_colors(color_keys)
+
+	return unpack_colors(source_keys), combinations()
+
+
+RECOLOR_ENGINES = ['lookup', 'mask']
+
 class ImagePaletteMapping(dict):
 	def __init__(self, source_palette, dest_palettes):
-		source_palette = ImagePalette(source_palette)
+		# palettes are immutable, so can be shared between mappings
+		if not isinstance(source_palette, ImagePalette):
+			source_palette = ImagePalette(source_palette)
 		self.source_palette = source_palette
 
 		if isinstance(dest_palettes, dict):
@@ -379,7 +937,7 @@ class ImagePaletteMapping(dict):
 			# self.names = [pal.name for pal in dest_palettes]
 		else: 
 			# self.names = range(len(dest_palettes))
-			dest_palettes = [ImagePalette(d) for d in dest_palettes]
+			dest_palettes = [d if isinstance(d, ImagePalette) else ImagePalette(d) for d in dest_palettes]
 
 		self.dest_palettes = dest_palettes
 
@@ -396,9 +954,18 @@ class ImagePaletteMapping(dict):
 				"\n".join(f"- #{i}, {d.name} = {len(d)} colors: {d}" for i, d in enumerate(dest_palettes))
 				)
 
+		# (n_colors, 4) and (n_palettes, n_colors, 4) uint8 arrays
+		self.source = source_palette.array
+		if self.n_palettes > 0:
+			self.dests = np.stack([d.array for d in dest_palettes])
+		else:
+			self.dests = np.empty((0, len(source_palette), 4), dtype='uint8')
+		self.dests.flags.writeable = False
+
 		# super().__init__(zip(source_palette, dest_palettes))
 		# 
-		super().__init__( (s, [ d[i] for d in dest_palettes ]) for i,s in enumerate(source_palette) )
+		dest_colors = zip(*[d.colors for d in dest_palettes]) if self.n_palettes > 0 else ([] for s in source_palette)
+		super().__init__( zip(source_palette.colors, map(list, dest_colors)) )
 
 	def __repr__(self):
 		return f"ImagePaletteMapping({repr(self.source_palette)}, {repr(self.dest_palettes)})"
@@ -417,7 +984,9 @@ class ImagePaletteMapping(dict):
 		# other = ['d','a','b','c']
 		# self[[3, 0, 1, 2]] == other
 
-		ordering = [self.index(c) for c in other.source_palette]
+		ordering, found = self.source_palette.lookup(other.source_palette.packed)
+		if not found.all():
+			raise Exception("Cannot reorder mapping like a mapping with different source colors")
 		return self.reorder(ordering)
 
 	def reorder(self, ordering):
@@ -445,6 +1014,42 @@ class ImagePaletteMapping(dict):
 				new_dest_palettes.pop(new_source_palette_index)
 			return ImagePaletteMapping(new_source_palette, new_dest_palettes)
 
+	def rename(self, names):
+		"""Create a new mapping with the destination palettes renamed to `names`"""
+		if len(names) != self.n_palettes:
+			raise Exception(f'Error: {len(names)} names provided for {self.n_palettes} palettes')
+		return ImagePaletteMapping(self.source_palette, 
+			[ImagePalette(pal, name=name) for pal, name in zip(self.dest_palettes, names)])
+
+	def content_hash(self):
+		"""a hash of the colors and palette names of this mapping"""
+		h = hashlib.sha1()
+		h.update(np.array(self.dests.shape, dtype='<i8').tobytes())
+		h.update(self.source.tobytes())
+		h.update(self.dests.tobytes())
+		h.update(json.dumps([pal.name for pal in self.dest_palettes]).encode())
+		return h.hexdigest()
+
+	def to_npz(self, path=None, **meta):
+		"""
+		writes the mapping in compiled form: a numpy .npz file holding `colors`, a uint8 array of 
+		the source and destination palettes with shape (self.n_palettes+1, n_colors, 4), and 
+		`meta`, a JSON string with the palette names and a content hash. Additional metadata 
+		can be stored by passing `meta`. `path` can be a filename or a file object.
+		"""
+		data = dict(
+			colors=np.concatenate([self.source[np.newaxis], self.dests]),
+			meta=np.array(json.dumps({
+				'format': MAPPING_NPZ_FORMAT,
+				'source_name': self.source_palette.name,
+				'names': [pal.name for pal in self.dest_palettes],
+				'hash': self.content_hash(),
+				**meta
+			})))
+		if path is not None:
+			np.savez(path, **data)
+		return data
+
 
 	def to_image(self, path=None):
 		# +1 for the source palette
@@ -490,7 +1095,14 @@ class ImagePaletteMapping(dict):
 
 		return arr
 
-	def recolor_image(self, img, src=None):
+	def to_arrays(self):
+		"""express the mapping as a pair of read-only uint8 arrays: the source palette, with shape 
+		(n_colors, 4), and the destination palettes, with shape (self.n_palettes, n_colors, 4). If 
+		a color appears more than once in the source palette, its last entry applies.
+		"""
+		return self.source, self.dests
+
+	def recolor_image(self, img, src=None, engine='lookup', indexed=False, threads=1, tolerance=0):
 		"""
 		recolors an img to all palettes in this mapping
 
@@ -498,8 +1110,72 @@ class ImagePaletteMapping(dict):
 			image to recolor
 		src : PIL.Image, optional
 			if given, will search for colors in the source palette within this image, but will write new colors to img
+		engine : str
+			'lookup' resolves every pixel to an entry in the source palette in a single pass, then
+			produces each destination palette with one gather; 'mask' compares the whole image once
+			per source color. Both give identical results; 'mask' is kept for comparison.
+		indexed : bool
+			if True, produce indexed ('P' mode) images, see `recolor_image_indexed`. Falls back
+			to RGBA images if `img` has too many colors to be indexed.
+		threads : int
+			split the image into this many horizontal bands, processed in parallel; only used by 
+			the 'lookup' engine
+		tolerance : int
+			also recolor pixels which differ from a source color by at most this much in each 
+			channel, as that source color; see `match_colors`. Not supported by the 'mask' engine.
+		"""
+		if tolerance > 0 and engine == 'mask':
+			raise Exception("The 'mask' engine only matches colors exactly; use the 'lookup' engine with a tolerance")
+
+		if indexed:
+			out_imgs = self.recolor_image_indexed(img, src, threads=threads, tolerance=tolerance)
+			if out_imgs is not None:
+				return out_imgs
+
+		if engine == 'lookup':
+			return self._recolor_image_lookup(img, src, threads=threads, tolerance=tolerance)
+		elif engine == 'mask':
+			return self._recolor_image_mask(img, src)
+		else:
+			raise Exception(f"Unknown recolor engine {engine}; choose from {RECOLOR_ENGINES}")
+
+	def recolor_image_indexed(self, img, src=None, threads=1, tolerance=0):
+		"""
+		recolors an img to all palettes in this mapping, producing indexed ('P' mode) images
+
+		The image is converted to a plane of palette indices once; every output image shares that 
+		plane and only carries a different palette, so the work per destination palette does not 
+		depend on the size of the image. Returns None if the image would need more than 256 
+		palette entries.
+		"""
+		source, dests = self.to_arrays()
+		recolorer = IndexedImage(img, source, src=src, indexed=True, threads=threads, tolerance=tolerance)
+		if not recolorer.indexed:
+			return None
+		return [recolorer.recolor(dest) for dest in dests]
+
+	def recolor_png_indexed(self, data, tolerance=0):
 		"""
+		recolors an indexed PNG file to all palettes in this mapping by rewriting its palette
+
+		data : bytes
+			contents of the PNG file
 
+		See `IndexedPNG`. Returns a list of bytes, one PNG file per destination palette, or None 
+		if `data` is not an indexed PNG or none of its palette entries are in the source palette.
+		"""
+		source, dests = self.to_arrays()
+		recolorer = IndexedPNG.open(data, source, tolerance)
+		if recolorer is None:
+			return None
+		return [recolorer.recolor(dest) for dest in dests]
+
+	def _recolor_image_lookup(self, img, src=None, threads=1, tolerance=0):
+		source, dests = self.to_arrays()
+		recolorer = IndexedImage(img, source, src=src, threads=threads, tolerance=tolerance)
+		return [recolorer.recolor(dest) for dest in dests]
+
+	def _recolor_image_mask(self, img, src=None):
 		img = img.convert('RGBA')
 
 		# "data" is a numpy array with shape = (height, width, 4) 
@@ -515,7 +1191,7 @@ class ImagePaletteMapping(dict):
 		# clone data so when checking for matching colors, we are always referencing the original; 
 		# this is in case one color appears in both the source and the destination palette; we 
 		# don't want to re-map it twice
-		orig = np.array(src)
+		orig = np.array(src.convert('RGBA'))
 
 
 		# len(self) x n_palettes x 4
@@ -544,11 +1220,18 @@ class ImagePaletteMapping(dict):
 		return [Image.fromarray(data) for data in datas]
 
 
+MAPPING_NPZ_FORMAT = 1
+
+# opening a .npz file costs about as much as parsing a small mapping, so only mappings larger 
+# than this (in bytes) are cached by `load_palette_mapping`
+MAPPING_CACHE_MIN_SIZE = 16 * 1024
+
 def save_palette_mapping(mapping, path, **kwargs):
 	basename, ext = os.path.splitext(path)
 	mapping_savers = {
 		'.png': lambda path, **kwargs: mapping.to_image(path, **kwargs),
 		'.json': lambda path, **kwargs: mapping.to_json(path, **kwargs),
+		'.npz': lambda path, **kwargs: mapping.to_npz(path, **kwargs),
 	}
 
 	if ext in mapping_savers:
@@ -579,7 +1262,7 @@ def load_palette_mapping_png(img, names=None, **kwargs):
 	source = data[0,:,:]
 	dests = data[1:, :, :]
 
-	if names is not None:
+	if names:
 		if len(names) != dests.shape[0]:
 			raise Exception(f'Error: {len(names)} names provided for {dests.shape[0]} palettes')
 		dests = { name:pal for name, pal in zip(names, dests) }
@@ -587,18 +1270,99 @@ def load_palette_mapping_png(img, names=None, **kwargs):
 	return ImagePaletteMapping(source, dests)	
 
 
-def load_palette_mapping(path, **kwargs):
+def load_palette_mapping_npz(data, names=None):
+	"""
+	loads a mapping written by `ImagePaletteMapping.to_npz`; `data` is a path, or a (colors, meta) 
+	pair as read by `read_palette_mapping_npz`
+	"""
+	if isinstance(data, str):
+		data = read_palette_mapping_npz(data)
+	colors, meta = data
+
+	source = ImagePalette(colors[0], name=meta['source_name'])
+	dests = [ImagePalette(pal, name=name) for pal, name in zip(colors[1:], meta['names'])]
+	mapping = ImagePaletteMapping(source, dests)
+	if names:
+		mapping = mapping.rename(names)
+	return mapping
+
+def read_palette_mapping_npz(path):
+	"""reads the (colors, meta) arrays of a compiled mapping without building the mapping"""
+	with np.load(path) as data:
+		meta = json.loads(str(data['meta']))
+		if meta.get('format') != MAPPING_NPZ_FORMAT:
+			raise ValueError(f"Unsupported compiled mapping format {meta.get('format')} in {path}")
+		return data['colors'], meta
+
+def mapping_cache_path(path):
+	"""path of the compiled copy of the mapping at `path` that `load_palette_mapping` keeps"""
+	dn, bn = os.path.split(path)
+	return os.path.join(dn, '.' + bn + '.npz')
+
+def file_hash(path):
+	with open(path, 'rb') as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+def load_cached_palette_mapping(path, loader, **kwargs):
+	"""
+	loads the mapping at `path` with `loader`, keeping a compiled copy next to it (see 
+	`mapping_cache_path`). The copy is used as long as `path` has the same modification time and 
+	size, or the same contents, as when the copy was written. If the copy cannot be written 
+	(e.g. the directory is read-only), the mapping is just loaded from `path`.
+	"""
+	cache_path = mapping_cache_path(path)
+	stat = os.stat(path)
+	source_hash = None
+	try:
+		colors, meta = read_palette_mapping_npz(cache_path)
+		if (meta['source_mtime'], meta['source_size']) == (stat.st_mtime_ns, stat.st_size):
+			return load_palette_mapping_npz((colors, meta))
+		source_hash = file_hash(path)
+		if meta['source_hash'] == source_hash:
+			mapping = load_palette_mapping_npz((colors, meta))
+		else:
+			mapping = loader(path, **kwargs)
+	except (OSError, KeyError, ValueError):
+		mapping = loader(path, **kwargs)
+
+	# write to a temporary file, so concurrent processes never see a partial copy
+	tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+	try:
+		with open(tmp_path, 'wb') as f:
+			mapping.to_npz(f, source_mtime=stat.st_mtime_ns, source_size=stat.st_size, 
+				source_hash=source_hash or file_hash(path))
+		os.replace(tmp_path, cache_path)
+	except OSError:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+	return mapping
+
+def load_palette_mapping(path, names=None, cache=True, **kwargs):
+	"""
+	loads a color mapping from a .json, .png, or compiled .npz file. If `names` is given, the 
+	destination palettes are renamed. If `cache` is True, a compiled copy of .json and .png 
+	mappings larger than `MAPPING_CACHE_MIN_SIZE` is kept next to them, so later loads only 
+	read the compiled copy (see `load_cached_palette_mapping`).
+	"""
 	basename, ext = os.path.splitext(path)
 	mapping_loaders = {
 		'.png': load_palette_mapping_png,
-		'.json': load_palette_mapping_json
+		'.json': load_palette_mapping_json,
+		'.npz': load_palette_mapping_npz
 	}
 
-	if ext in mapping_loaders:
-		return mapping_loaders[ext](path, **kwargs)
-	else:
+	if ext not in mapping_loaders:
 		raise Exception(f'Do not know how to load a mapping from a {ext} file. Possible extensions: {mapping_loaders.keys()}')
 
+	if cache and ext != '.npz' and os.path.getsize(path) >= MAPPING_CACHE_MIN_SIZE:
+		mapping = load_cached_palette_mapping(path, mapping_loaders[ext], **kwargs)
+	else:
+		mapping = mapping_loaders[ext](path, **kwargs)
+
+	if names:
+		mapping = mapping.rename(names)
+	return mapping
+
 
 
 # class ImagePaletteMapping(dict):
@@ -701,17 +1465,170 @@ def recolor_map(img, mapping):
 def recolor_index(img, colormap):
 	pass
 
-def coerce(img, palette, verbose=False):
+COERCE_ENGINES = ['lut', 'quantize']
+COERCE_METRICS = ['rgb', 'lab']
+
+def rgb_to_lab_array(arr):
+	"""converts an (..., 3) array of sRGB values (0-255) to CIELAB (D65 white point)"""
+	c = np.asarray(arr, dtype=float)[..., :3] / 255
+	linear = np.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+	xyz = linear @ np.array([
+		[0.4124564, 0.3575761, 0.1804375],
+		[0.2126729, 0.7151522, 0.0721750],
+		[0.0193339, 0.1191920, 0.9503041]]).T
+	t = xyz / np.array([0.95047, 1.0, 1.08883])
+	delta = 6 / 29
+	f = np.where(t > delta ** 3, np.cbrt(t), t / (3 * delta ** 2) + 4 / 29)
+	return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+def nearest_palette_indices(colors, palette, metric='rgb', chunk_size=4096):
+	"""
+	for each of the (n, 3) RGB `colors`, finds the index of the closest of the (n_colors, 3) RGB 
+	`palette` colors, by euclidean distance in RGB or CIELAB (`metric`). Ties go to the earlier 
+	palette color.
+	"""
+	if metric == 'rgb':
+		colors = np.asarray(colors, dtype='int32')[:, :3]
+		palette = np.asarray(palette, dtype='int32')[:, :3]
+	elif metric == 'lab':
+		colors = rgb_to_lab_array(colors)
+		palette = rgb_to_lab_array(palette)
+	else:
+		raise Exception(f"Unknown color distance metric {metric}; choose from {COERCE_METRICS}")
+
+	index = np.empty(len(colors), dtype=np.intp)
+	for start in range(0, len(colors), chunk_size):
+		diff = colors[start:start+chunk_size, np.newaxis, :] - palette[np.newaxis, :, :]
+		index[start:start+chunk_size] = (diff * diff).sum(axis=-1).argmin(axis=-1)
+	return index
+
+class NearestColorTable():
+	"""
+	A lookup table from each of the 2^24 RGB colors to the index of the nearest color in a palette 
+	(see `nearest_palette_indices`). Entries are computed the first time a color is looked up, 
+	and tables are kept in memory and on disk (in `cache_dir('coerce')`), keyed by a hash of 
+	the palette and metric. Use `NearestColorTable.get`.
+	"""
+	EMPTY = 0xffff
+	_tables = {}
+
+	def __init__(self, palette, metric='rgb'):
+		self.palette = np.ascontiguousarray(palette, dtype='uint8')[:, :3]
+		if len(self.palette) >= self.EMPTY:
+			raise Exception(f"Palettes with more than {self.EMPTY - 1} colors are not supported")
+		self.metric = metric
+		self.hash = self.palette_hash(self.palette, metric)
+		self.lut = np.full(1 << 24, self.EMPTY, dtype='uint16')
+		self.dirty = False
+		# keys of entries computed since the last call to `take_new`
+		self._new_keys = []
+
+	@staticmethod
+	def palette_hash(palette, metric):
+		palette = np.ascontiguousarray(palette, dtype='uint8')[:, :3]
+		return hashlib.sha1(metric.encode() + np.ascontiguousarray(palette).tobytes()).hexdigest()
+
+	@classmethod
+	def get(cls, palette, metric='rgb'):
+		"""returns the table for `palette` and `metric`, loading it from disk on first use"""
+		h = cls.palette_hash(palette, metric)
+		if h not in cls._tables:
+			table = cls(palette, metric)
+			table.load()
+			cls._tables[h] = table
+		return cls._tables[h]
+
+	@property
+	def path(self):
+		return cache_dir('coerce', f'{self.hash}.npz')
+
+	def load(self):
+		try:
+			with np.load(self.path) as data:
+				if np.array_equal(data['palette'], self.palette) and str(data['metric']) == self.metric:
+					self.lut[data['keys']] = data['index']
+		except (OSError, KeyError, ValueError):
+			pass
+
+	def save(self):
+		"""
+		writes the entries computed so far to disk, if any are new. Entries already on disk (e.g. 
+		written by another process since this table was loaded) are merged in first, and the file 
+		is replaced atomically.
+		"""
+		if not self.dirty:
+			return
+		# entries only depend on the palette and metric, so those on disk can be merged in as they are
+		self.load()
+		keys = np.flatnonzero(self.lut != self.EMPTY).astype('<u4')
+		tmp_path = f"{self.path}.{os.getpid()}.tmp"
+		try:
+			mkdirpf(self.path)
+			with open(tmp_path, 'wb') as f:
+				np.savez(f, palette=self.palette, metric=np.array(self.metric), keys=keys, index=self.lut[keys])
+			os.replace(tmp_path, self.path)
+			self.dirty = False
+		except OSError:
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+
+	def lookup(self, keys, threads=1):
+		"""
+		keys : numpy.ndarray
+			RGB colors packed as `r | g << 8 | b << 16`, e.g. `pack_colors(arr) & 0xffffff`
+		returns an array of the same shape with the index of the nearest palette color to each
+		"""
+		keys = np.asarray(keys, dtype='<u4')
+		index = np.empty(keys.shape, dtype='uint16')
+		def lookup_band(start, stop):
+			np.take(self.lut, keys[start:stop], out=index[start:stop])
+		map_row_bands(lookup_band, len(keys), threads)
+
+		missing = index == self.EMPTY
+		if missing.any():
+			new_keys = np.unique(keys[missing])
+			self.lut[new_keys] = nearest_palette_indices(unpack_colors(new_keys)[:, :3], self.palette, self.metric)
+			index[missing] = self.lut[keys[missing]]
+			self.dirty = True
+			self._new_keys.append(new_keys)
+		return index
+
+	def take_new(self):
+		"""returns (keys, index) of the entries computed since the last call, e.g. to send them from a worker process to be saved"""
+		keys = np.concatenate([np.empty(0, dtype='<u4')] + self._new_keys)
+		self._new_keys = []
+		return keys, self.lut[keys]
+
+	def merge(self, keys, index):
+		"""adds entries computed elsewhere, as returned by `take_new`"""
+		if len(keys) > 0:
+			self.lut[keys] = index
+			self.dirty = True
+
+def coerce(img, palette, engine='quantize', metric='rgb', threads=1, save=True, verbose=False):
 	"""converts the color in `img` to the closest colors in `palette`
+
+	engine : str
+		'quantize' (default) uses PIL's quantizer, which does not always pick the nearest color, 
+		and ignores `metric`; 'lut' maps each pixel to the nearest palette color by `metric` 
+		('rgb' or 'lab'), using a `NearestColorTable` for the palette
+	threads : int
+		with `threads` > 1, horizontal bands of the image are processed in parallel
+	save : bool
+		for the 'lut' engine, whether to write new entries of the table to disk afterwards
 	"""
+	if engine not in COERCE_ENGINES:
+		raise Exception(f"Unknown coerce engine {engine}; choose from {COERCE_ENGINES}")
 
 	alphas = None
 	# todo: deal with keeping track of the alpha
 	if img.mode != 'RGB':
 		if verbose: print(f"Warning: {img.filename} has mode {img.mode}; when comparing to palette colors, alpha channel information will be ignored.")
 
-		if img.mode == 'RGBA':
-			alphas = np.array(img)[:,:,-1]
+		# paletted images may carry their transparency in img.info, which would otherwise be lost
+		if img.mode != 'RGBA':
+			img = img.convert('RGBA')
+		alphas = np.array(img)[:,:,-1]
 
 		img = img.convert('RGB')
 
@@ -722,18 +1639,54 @@ def coerce(img, palette, verbose=False):
 	# drop transparency from palette and remove non-unique values; do these here, otherwise
 	# in palette quantization step, PIL might create additional fake colors
 	palette = palette.drop_alpha(unique=True)
-	palette_img = palette.to_image().convert('RGB').quantize(colors=len(palette), dither=0, method=Image.MAXCOVERAGE)
 
-	# quantize input image to palette
-	img_q =  img.quantize(colors=len(palette), palette=palette_img, dither=0, method=Image.MAXCOVERAGE).convert('RGBA')
+	if engine == 'lut':
+		img_q = coerce_lut(img, palette, metric=metric, threads=threads, save=save)
+	else:
+		img_q = coerce_quantize(img, palette, threads=threads)
+
 	if alphas is not None:
 		img_q_arr = np.array(img_q)
 		img_q_arr[:,:,-1] = alphas
 		img_q = Image.fromarray(img_q_arr)
 	return img_q
 
+def coerce_lut(img, palette, metric='rgb', threads=1, save=True):
+	keys = pack_colors(np.array(img.convert('RGBA'))) & 0xffffff
+
+	table = NearestColorTable.get(palette.array, metric)
+	index = table.lookup(keys, threads=threads)
+	if save:
+		table.save()
+
+	out = np.empty(keys.shape, dtype='<u4')
+	def gather_band(start, stop):
+		np.take(palette.packed, index[start:stop], out=out[start:stop])
+	map_row_bands(gather_band, len(out), threads)
+	return Image.fromarray(unpack_colors(out))
 
-def coerce_images(images, output_paths, palettes, verbose=False):
+def coerce_quantize(img, palette, threads=1):
+	palette_img = palette.to_image().convert('RGB').quantize(colors=len(palette), dither=0, method=Image.MAXCOVERAGE)
+
+	# quantize input image to palette; without dithering, each pixel is quantized independently, 
+	# so bands of the image can be quantized separately
+	def quantize_band(start, stop):
+		band = img if (start, stop) == (0, img.height) else img.crop((0, start, img.width, stop))
+		return band.quantize(colors=len(palette), palette=palette_img, dither=0, method=Image.MAXCOVERAGE).convert('RGBA')
+
+	bands = map_row_bands(quantize_band, img.height, threads)
+	if len(bands) == 1:
+		return bands[0]
+	return Image.fromarray(np.concatenate([np.array(band) for band in bands]))
+
+
+def coerce_images(images, output_paths, palettes, engine='quantize', metric='rgb', jobs=1, threads=1, verbose=False):
+	"""
+	coerces each of `images` to each of `palettes`, writing outputs to `output_paths`. Images 
+	are spread across `jobs` worker processes (all cores if None), as in `recolor`; each image 
+	is split across `threads` threads. With the 'lut' engine, workers send back the table 
+	entries they computed, and each table is saved to disk once, at the end.
+	"""
 
 	if len(output_paths) == 1:
 		output_paths = output_paths * len(images)
@@ -742,88 +1695,125 @@ def coerce_images(images, output_paths, palettes, verbose=False):
 			f"- Inputs: {images} \n"
 			f"- Outputs: {output_paths} \n")
 
-	for input_path, output_path_fmt in zip(images, output_paths):
-		if verbose: print(f"Reading input image {input_path}...")
-		input_path_basename = os.path.basename(input_path)
-		input_path_basename_sans_ext, _ = os.path.splitext(input_path_basename)
-		input_path_sans_ext, input_path_ext = os.path.splitext(input_path)
-		input_path_ext = input_path_ext.lstrip('.')
-
-		img = Image.open(input_path)
-
-		def save_img(out_img, palette_name):
-			output_path = format_placeholders(output_path_fmt, {
-				'%B': input_path_basename,
-				'%b': input_path_basename_sans_ext,
-				'%i': input_path_sans_ext, 
-				'%e': input_path_ext,
-				'%I': input_path,
-				'%p': palette_name
-			})
-
-			if verbose: print(f"- writing output from palette '{palette_name}' to {output_path}")
-			mkdirpf(output_path)
-			out_img.save(output_path)
+	tasks = list(zip(images, output_paths))
+	results = pool_map(coerce_file, tasks, jobs=jobs, shared=dict(palettes=palettes, 
+		engine=engine, metric=metric, threads=threads, verbose=verbose))
 
+	if engine == 'lut':
 		for palette in palettes:
+			table = NearestColorTable.get(palette.drop_alpha(unique=True).array, metric)
+			for result, _ in results:
+				if result is not None and table.hash in result:
+					table.merge(*result[table.hash])
+			table.save()
+	raise_pool_errors(tasks, results, verbose=verbose)
+
+def coerce_file(input_path, output_path_fmt, palettes, engine='quantize', metric='rgb', threads=1, verbose=False):
+	"""
+	coerces the image at `input_path` to each of `palettes`; see `coerce_images`. Returns a dict of 
+	`NearestColorTable` hash -> (keys, index) of the entries computed for this image, which are not saved.
+	"""
+	if verbose: print(f"Reading input image {input_path}...")
+	input_path_basename = os.path.basename(input_path)
+	input_path_basename_sans_ext, _ = os.path.splitext(input_path_basename)
+	input_path_sans_ext, input_path_ext = os.path.splitext(input_path)
+	input_path_ext = input_path_ext.lstrip('.')
+
+	img = Image.open(input_path)
+
+	def save_img(out_img, palette_name):
+		output_path = format_placeholders(output_path_fmt, {
+			'%B': input_path_basename,
+			'%b': input_path_basename_sans_ext,
+			'%i': input_path_sans_ext, 
+			'%e': input_path_ext,
+			'%I': input_path,
+			'%p': palette_name
+		})
+
+		if verbose: print(f"- writing output from palette '{palette_name}' to {output_path}")
+		mkdirpf(output_path)
+		out_img.save(output_path)
 
-			out_img = coerce(img, palette)
-			save_img(out_img, palette.name)
+	new_entries = {}
+	for palette in palettes:
+
+		out_img = coerce(img, palette, engine=engine, metric=metric, threads=threads, save=False)
+		save_img(out_img, palette.name)
+
+		if engine == 'lut':
+			table = NearestColorTable.get(palette.drop_alpha(unique=True).array, metric)
+			new_entries[table.hash] = table.take_new()
+	return new_entries
 
 def main_coerce(args):
 	palettes = load_maybe_named_palettes(args.palettes,names=None, verbose=args.verbose) #dict(parse_named_paths(args.palettes, default_names=True))
-	coerce_images(args.input, args.output, palettes, verbose=args.verbose)
+	coerce_images(args.input, args.output, palettes, engine=args.engine, metric=args.metric, 
+		jobs=args.jobs, threads=args.threads, verbose=args.verbose)
 
 
 
-def increment_shade(img, color_increments, mask, palette, overflow='squish', verbose=False):
+INCREMENT_OVERFLOWS = ['squish', 'wrap']
 
-	assert mask.size == img.size, "Mask and image must be same size"
-
-	data = np.array(img)
+def mask_increments(mask, color_increments):
+	"""
+	returns a (height, width) int array with the increment of each pixel of `mask`, according to 
+	`color_increments` (a dict of mask color -> increment), and a boolean array of which pixels 
+	match one of the mask colors
+	"""
+	mask_keys = pack_colors(np.array(mask.convert('RGBA')))
+	mask_colors = np.array([Color(c).to_array() for c in color_increments.keys()], dtype='uint8').reshape((-1, 4))
+	increments = np.array(list(color_increments.values()), dtype=int)
 
-	def increment_color(color, increment):
-		color_i = palette.index(color)
-		new_color_i = color_i + increment
+	index, found = lookup_colors(mask_keys, pack_colors(mask_colors))
+	return np.where(found, increments[index] if len(increments) > 0 else 0, 0), found
 
-		if new_color_i >= len(palette) or new_color_i < 0:
+def increment_shade_images(imgs, color_increments, mask, palette, overflow='squish', threads=1, verbose=False):
+	"""
+	applies `increment_shade` to each of `imgs`, all with the same `mask`, which is only matched to 
+	the mask colors once. `palette` is a single palette for all images, or one palette per 
+	image. Returns a generator of the shaded images, which can be consumed as the inputs are 
+	read.
+	"""
+	if overflow not in INCREMENT_OVERFLOWS:
+		raise Exception(f"Unrecognized overflow option {overflow}; choose from 'squish' or 'wrap'.")
+
+	increments, in_mask = mask_increments(mask, color_increments)
+	palettes = itertools.repeat(palette) if isinstance(palette, ImagePalette) else palette
+
+	for img, palette in zip(imgs, palettes):
+		assert mask.size == img.size, "Mask and image must be same size"
+		if verbose: print(palette)
+
+		keys = pack_colors(np.array(img.convert('RGBA')))
+		out = keys.copy()
+		n = len(palette)
+
+		# each pixel that is in the palette and under one of the mask colors moves `increment` 
+		# positions along the palette; always compare to original image to avoid waterfall edits
+		def shade_band(start, stop):
+			index, found = lookup_colors(keys[start:stop], palette.packed)
+			targets = found & in_mask[start:stop]
+			new_index = index[targets] + increments[start:stop][targets]
 			if overflow == 'squish':
-				new_color_i = max(min(new_color_i, len(palette)-1), 0)
-			elif overflow == 'wrap':
-				new_color_i = (new_color_i + len(palette)) % len(palette)
-			else: raise Exception(f"Unrecognized overflow option {overflow}; choose from 'squish' or 'wrap'.")
-		return palette[new_color_i]
-
-	# as we are modifying always compare to original image to avoid waterfall edits
-	orig = data.copy()
-
-	mask = np.array(mask)
-
-	if verbose: print(palette)
-
-	# each (mask_color, increment) pair is essentially defining a new color mapping
-	# from source_pal to (increment_color(c,increment) for c in source_pal)
-	for mask_color, increment in color_increments.items():
-
-		if verbose: print(f"{mask_color} : {increment}")
-
-		# find pixels in `mask` matching `mask_color`
-		mask_color = Color(mask_color).to_array()
-		pixels_to_mask = (mask == mask_color[np.newaxis, np.newaxis, :]).all(axis=-1)
-
-		# definte destination palette
-		dest_palette = [increment_color(c, increment) for c in palette]
-
-		if verbose: print(ImagePalette(dest_palette))
-
-		# recolor image
-		for c1, c2 in zip(palette, dest_palette):
+				new_index = np.clip(new_index, 0, n - 1)
+			else:
+				new_index = np.mod(new_index, n)
+			out[start:stop][targets] = palette.packed[new_index]
 
-			# but only for pixels in the mask
-			targets = np.logical_and( (orig == c1).all(axis=-1) , pixels_to_mask)
-			data[targets,:] = c2
+		if n > 0:
+			map_row_bands(shade_band, len(keys), threads)
+		yield Image.fromarray(unpack_colors(out))
 
-	return Image.fromarray(data)
+def increment_shade(img, color_increments, mask, palette, overflow='squish', threads=1, verbose=False):
+	"""
+	shifts each pixel of `img` under each mask color in `color_increments` by that many positions 
+	in `palette`. Positions past either end of the palette are clamped (`overflow='squish'`) or 
+	wrap around (`overflow='wrap'`). With `threads` > 1, horizontal bands of the image are 
+	processed in parallel.
+	"""
+	return next(increment_shade_images([img], color_increments, mask, palette, 
+		overflow=overflow, threads=threads, verbose=verbose))
 
 def main_increment_shade(args):
 	inputs = args.input
@@ -845,23 +1835,240 @@ def main_increment_shade(args):
 	if args.palette is not None:
 		palette = load_palette(args.palette).drop_transparent()
 
-	for input_path, output_path in zip(inputs, outputs):
-		input_img = Image.open(input_path)
-		if palette is None:
-			# import pdb; pdb.set_trace()
-			img_palette = load_palette_png(input_path).drop_transparent().sort()
-		else: img_palette = palette
+	input_imgs = (Image.open(input_path) for input_path in inputs)
+	if palette is None:
+		palettes = (load_palette_png(input_path).drop_transparent().sort() for input_path in inputs)
+	else: palettes = palette
 
-		out_img = increment_shade(input_img, color_increments, mask, img_palette, args.overflow, args.verbose)
+	out_imgs = increment_shade_images(input_imgs, color_increments, mask, palettes, args.overflow, threads=args.threads, verbose=args.verbose)
+	for out_img, output_path in zip(out_imgs, outputs):
 		out_img.save(output_path)
 
 
-def audit_palette(img, palette):
-	pass
+def color_histogram(img, squish_transparent=True):
+	"""
+	returns (keys, counts): the distinct colors of `img`, packed as by `pack_colors` and sorted, and 
+	the number of pixels of each
+	"""
+	return np.unique(ImagePalette._find_keys(img, squish_transparent), return_counts=True)
 
+def color_histogram_file(path, cache=True, squish_transparent=True):
+	"""
+	`color_histogram` of the image at `path`. If `cache` is True, the histogram is kept in the 
+	cache directory (see `cache_dir`) under the hash of the file's contents, so unchanged files 
+	are not decoded again.
+	"""
+	if not cache:
+		return color_histogram(Image.open(path), squish_transparent)
+
+	cache_path = cache_dir('audit', file_hash(path) + ('.npz' if squish_transparent else '.raw.npz'))
+	try:
+		with np.load(cache_path) as f:
+			return f['keys'], f['counts']
+	except (OSError, KeyError, ValueError):
+		pass
+
+	keys, counts = color_histogram(Image.open(path), squish_transparent)
+	tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+	try:
+		mkdirpf(cache_path)
+		with open(tmp_path, 'wb') as f:
+			np.savez(f, keys=keys, counts=counts)
+		os.replace(tmp_path, cache_path)
+	except OSError:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+	return keys, counts
+
+def audit_palette(img, palette, squish_transparent=True, ignore_transparent=True):
+	"""
+	counts the pixels of `img` of each color in `palette`, and of each color not in `palette`; 
+	returns a dict with 'palette' and 'outside', each a dict of hex color -> number of pixels
+	"""
+	report = audit_histograms([''], [color_histogram(img, squish_transparent)], palette, 
+		squish_transparent=squish_transparent, ignore_transparent=ignore_transparent)
+	return {
+		'palette': {c: r['pixels'] for c, r in report['palette'].items()},
+		'outside': {c: r['pixels'] for c, r in report['outside'].items()}
+	}
 
-def collapse_recolors(imgs):
-	pass
+def audit_palettes(images, palette, jobs=1, cache=True, squish_transparent=True, ignore_transparent=True, verbose=False):
+	"""
+	scans each of `images` (paths to images, or directories to search for .png images) in a pool of 
+	`jobs` processes (all cores if None), and reports how `palette` is used across them; see 
+	`audit_histograms`. Histograms are cached per file (see `color_histogram_file`).
+	"""
+	images = find_images(images)
+	tasks = [(path,) for path in images]
+	results = pool_map(color_histogram_file, tasks, jobs=jobs, 
+		shared=dict(cache=cache, squish_transparent=squish_transparent))
+	raise_pool_errors(tasks, results, verbose=verbose)
+	return audit_histograms(images, [result for result, _ in results], palette, 
+		squish_transparent=squish_transparent, ignore_transparent=ignore_transparent)
+
+def audit_histograms(paths, histograms, palette, squish_transparent=True, ignore_transparent=True):
+	"""
+	combines the `color_histogram` of each of `paths` into a report, with:
+
+	- 'coverage': the fraction of colors in `palette` used by any image
+	- 'palette': hex color -> {'pixels': total count, 'files': [paths]}, for each palette color
+	- 'outside': the same, for each color not in `palette`, most used first
+	- 'files': path -> {'pixels', 'colors', 'palette_pixels', 'outside_pixels', 'outside_colors'}
+
+	if `ignore_transparent`, fully transparent pixels are never counted as outside the palette.
+	"""
+	keys = np.concatenate([np.empty(0, dtype='<u4')] + [k for k, _ in histograms])
+	counts = np.concatenate([np.empty(0, dtype='int64')] + [c for _, c in histograms]).astype('int64')
+	file_ids = np.repeat(np.arange(len(histograms)), [len(k) for k, _ in histograms])
+
+	# global histogram, and the files using each color
+	colors, inverse = np.unique(keys, return_inverse=True)
+	totals = np.zeros(len(colors), dtype='int64')
+	np.add.at(totals, inverse, counts)
+	order = np.argsort(inverse, kind='stable')
+	files = np.split(file_ids[order], np.cumsum(np.bincount(inverse, minlength=len(colors)))[:-1])
+
+	palette_keys = palette._find_palette_keys(squish_transparent, ignore_transparent=False)
+	in_palette = np.isin(keys, palette_keys)
+	outside = ~in_palette
+	if ignore_transparent:
+		outside &= (unpack_colors(keys)[..., 3] != 0)
+
+	def color_hex(key):
+		return Color._make(unpack_colors(key).reshape(4).tolist()).to_hex()
+
+	def color_report(i):
+		return { 'pixels': int(totals[i]), 'files': [paths[j] for j in files[i].tolist()] }
+
+	palette_report = {}
+	index, found = lookup_colors(palette_keys, colors)
+	for key, i, f in zip(palette_keys, index.tolist(), found.tolist()):
+		palette_report[color_hex(key)] = color_report(i) if f else { 'pixels': 0, 'files': [] }
+
+	outside_colors = np.unique(keys[outside])
+	outside_index = np.searchsorted(colors, outside_colors)
+	outside_index = outside_index[np.argsort(-totals[outside_index], kind='stable')]
+
+	n_files = len(histograms)
+	return {
+		'coverage': sum(r['pixels'] > 0 for r in palette_report.values()) / max(len(palette_report), 1),
+		'palette': palette_report,
+		'outside': { color_hex(colors[i]): color_report(i) for i in outside_index.tolist() },
+		'files': { path: {
+				'pixels': int(pixels), 
+				'colors': int(n_colors), 
+				'palette_pixels': int(palette_pixels), 
+				'outside_pixels': int(outside_pixels), 
+				'outside_colors': int(outside_colors)
+			} for path, pixels, n_colors, palette_pixels, outside_pixels, outside_colors in zip(paths,
+				np.bincount(file_ids, weights=counts, minlength=n_files),
+				np.bincount(file_ids, minlength=n_files),
+				np.bincount(file_ids, weights=counts * in_palette, minlength=n_files),
+				np.bincount(file_ids, weights=counts * outside, minlength=n_files),
+				np.bincount(file_ids, weights=outside, minlength=n_files))
+		}
+	}
+
+def main_audit(args):
+	palette = load_palette(args.palette)
+	report = audit_palettes(args.input, palette, jobs=args.jobs, cache=args.cache, verbose=args.verbose)
+
+	used = {c: r for c, r in report['palette'].items() if r['pixels'] > 0}
+	print(f"{len(used)} of {len(report['palette'])} palette colors are used in {len(report['files'])} images")
+	for c, r in report['palette'].items():
+		print(f"- {c}: {r['pixels']} pixels in {len(r['files'])} images")
+		if args.verbose:
+			for path in r['files']: print(f"  - {path}")
+
+	print(f"{len(report['outside'])} colors not in the palette are used")
+	for c, r in report['outside'].items():
+		print(f"- {c}: {r['pixels']} pixels in {len(r['files'])} images")
+		if args.verbose:
+			for path in r['files']: print(f"  - {path}")
+
+	if args.report is not None:
+		if args.verbose: print(f"Writing report to {args.report}")
+		mkdirpf(args.report)
+		with open(args.report, 'w') as f:
+			json.dump(report, f, indent=2)
+
+
+def recolor_signature(img, squish_transparent=True):
+	"""
+	returns (signature, colors): `colors` are the distinct colors of `img`, packed as by 
+	`pack_colors`, in order of first appearance; `signature` is a hash of the image's size and of 
+	the index of each pixel's color in `colors`. Two images have the same signature exactly when 
+	one can be turned into the other by replacing each color with another (distinct) color.
+	"""
+	if isinstance(img, str):
+		img = Image.open(img)
+	keys = ImagePalette._find_keys(img, squish_transparent)
+	distinct, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+	# rank[i] = position of distinct[i] in order of first appearance
+	order = np.argsort(first)
+	rank = np.empty(len(order), dtype='<u4')
+	rank[order] = np.arange(len(order), dtype='<u4')
+	index = rank[inverse.ravel()].astype('<u2' if len(order) <= (1<<16) else '<u4')
+
+	h = hashlib.sha1(struct.pack('<II', *img.size))
+	h.update(index.tobytes())
+	return h.hexdigest(), distinct[order]
+
+def collapse_recolors(imgs, names=None, jobs=1, verbose=False):
+	"""
+	finds groups among `imgs` (images, or paths to images or directories to search for .png 
+	images) which are recolors of each other, i.e. which have the same `recolor_signature`. 
+	Images are grouped by hashing, so there are no pairwise comparisons; signatures are computed in 
+	a pool of `jobs` processes (all cores if None).
+
+	returns a list of (base, mapping, members) for each group, in order of first appearance: 
+	`base` is the first image of the group, `members` are all images of the group, and `mapping` 
+	is an `ImagePaletteMapping` from the colors of `base` to those of each member (including 
+	`base`), so that recoloring `base` with `mapping` reproduces each member. Palettes are named 
+	by `names`, by default the paths of the images without extension.
+	"""
+	imgs = find_images(imgs) if all(isinstance(img, str) for img in imgs) else list(imgs)
+	if names is None:
+		names = [os.path.splitext(img)[0] if isinstance(img, str) else str(i) for i, img in enumerate(imgs)]
+
+	tasks = [(img,) for img in imgs]
+	results = pool_map(recolor_signature, tasks, jobs=jobs)
+	raise_pool_errors([(str(img),) for img in imgs], results, verbose=verbose)
+
+	groups = {}
+	for i, ((signature, colors), _) in enumerate(results):
+		groups.setdefault(signature, []).append((i, colors))
+
+	collapsed = []
+	for members in groups.values():
+		base_colors = unpack_colors(members[0][1])
+		mapping = ImagePaletteMapping(base_colors, 
+			[ImagePalette(unpack_colors(colors), name=names[i]) for i, colors in members])
+		collapsed.append((imgs[members[0][0]], mapping, [imgs[i] for i, _ in members]))
+	return collapsed
+
+def main_collapse_recolors(args):
+	inputs = find_images(args.input)
+	common = os.path.commonpath([os.path.abspath(os.path.dirname(path)) for path in inputs]) if len(inputs) > 0 else ''
+	names = [os.path.splitext(os.path.relpath(os.path.abspath(path), common))[0] for path in inputs]
+	groups = collapse_recolors(inputs, names=names, jobs=args.jobs, verbose=args.verbose)
+
+	groups = [(base, mapping, members) for base, mapping, members in groups if len(members) > 1]
+	n_members = sum(len(members) for _, _, members in groups)
+	print(f"{n_members} of {len(inputs)} images are recolors of another image, in {len(groups)} groups")
+
+	import shutil
+	for base, mapping, members in groups:
+		name = mapping.names[0]
+		if args.verbose: 
+			print(f"- {base}: {len(members)} images, {len(mapping.source_palette)} colors")
+			for member in members[1:]: print(f"  - {member}")
+
+		if args.output_dir is not None:
+			base_path = mkdirpf(args.output_dir, name + os.path.splitext(base)[1])
+			shutil.copyfile(base, base_path)
+			save_palette_mapping(mapping, os.path.join(args.output_dir, f"{name}.{args.format}"))
 
 
 def load_maybe_named_palettes(target_paths, names=None, force_names=True, verbose=False):
@@ -890,41 +2097,135 @@ def load_maybe_named_palettes(target_paths, names=None, force_names=True, verbos
 	return dest_pals
 
 
-def make_mapping_strict(paths):
-	imgs = [Image.open(img) for img in paths]
-	if not all_equal(img.size for img in imgs):
-		raise Exception('To make a strict mapping, all images must have the same dimensions. '
-			f'Dimensions of images given: {[img.size for img in imgs]}')
-	arrs = [np.array(img) for img in imgs]
-	n_pals = len(arrs)
-
-	if n_pals < 2:
-		raise Exception("Can't make mapping from < 2 images")
-
-	# arr.shape = (w,h,4)
-	# want to convert to (w*h, 4)
-	shape = arrs[0].shape
-
-	# arr.reshape((w*h, 4))
-
-	out = np.zeros((shape[0]*shape[1], n_pals * 4))
-
-	# pixels.shape = (w*h, 4*n_pals)
-	# np.concatenate( ( a.reshape((2*3,4)), b.reshape((2*3,4)) ), axis=-1, out=out )
-	pixels = np.concatenate( [ a.reshape((shape[0]*shape[1],4)) for a in arrs ], axis=-1, out=out )
-
-	# pixels_uniq.shape = (n_colors, 4*n_pals)
-	pixels_uniq = unique_rows(pixels).astype(int)
-	n_colors = pixels_uniq.shape[0]
+class StrictMappingBuilder():
+	"""
+	Builds a mapping by comparing images pixelwise: each pixel of a source image, and the pixels at 
+	the same position in its recolored target images, give one (source color, target colors) 
+	entry. Sets of images are added one at a time with `add`, and only the distinct entries are 
+	kept (as packed colors, see `pack_colors`), so any number of images can be combined.
 
-	# pals.shape = (n_colors, n_pals, 4) -> (n_pals, n_colors, 4)
-	pals = pixels_uniq.reshape((n_colors, n_pals, 4)).swapaxes(0, 1)
+	A source color that appears with more than one set of target colors is a conflict; see 
+	`conflicts` and `to_mapping`.
+	"""
+	def __init__(self, names=None):
+		self.names = names
+		# (n_entries, 1 + n_targets) uint32 array, in order of first appearance
+		self.rows = None
 
-	source_pal = pals[0,:,:]
-	dest_pals = pals[1:,:,:]
+	def add(self, imgs):
+		"""
+		adds a set of images: the source image, followed by one image per target palette; all 
+		images in a set must have the same dimensions. Images can be PIL images or paths.
+		"""
+		imgs = [Image.open(img) if isinstance(img, str) else img for img in imgs]
+		if len(imgs) < 2:
+			raise Exception("Can't make mapping from < 2 images")
+		if not all_equal(img.size for img in imgs):
+			raise Exception('To make a strict mapping, all images must have the same dimensions. '
+				f'Dimensions of images given: {[img.size for img in imgs]}')
+		if self.rows is not None and len(imgs) != self.rows.shape[1]:
+			raise Exception(f'Each set of images must have {self.rows.shape[1]} images; got {len(imgs)}')
+
+		# pixels.shape = (w*h, n_images)
+		pixels = np.stack([pack_colors(np.array(img.convert('RGBA'))).ravel() for img in imgs], axis=-1)
+		if self.rows is not None:
+			pixels = np.concatenate([self.rows, pixels])
+		self.rows = unique_packed_rows(pixels)
+		return self
+
+	def conflicts(self):
+		"""returns a dict mapping each conflicting source `Color` to the list of its target colors"""
+		if self.rows is None:
+			return {}
+		counts = collections.Counter(self.rows[:, 0].tolist())
+		conflicts = collections.defaultdict(list)
+		for row in self.rows:
+			if counts[int(row[0])] > 1:
+				source, *targets = [Color._make(c) for c in unpack_colors(row).tolist()]
+				conflicts[source].append(targets)
+		return dict(conflicts)
+
+	def to_mapping(self, on_conflict='last'):
+		"""
+		returns the merged `ImagePaletteMapping`. For conflicting source colors, `on_conflict` 
+		chooses which target colors are kept: those seen 'first' or 'last', or 'error' to raise.
+		"""
+		if self.rows is None:
+			raise Exception("No images were added to the mapping")
+
+		conflicts = self.conflicts()
+		if len(conflicts) > 0:
+			if on_conflict == 'error':
+				raise Exception(f"{len(conflicts)} source colors map to more than one set of target colors: \n" + 
+					"\n".join(f"- {source}: {targets}" for source, targets in conflicts.items()))
+			elif on_conflict not in ['first', 'last']:
+				raise Exception(f"Unrecognized conflict option {on_conflict}; choose from 'error', 'first' or 'last'.")
+
+		rows = self.rows
+		if on_conflict == 'last':
+			# keep the last entry for each source color, in order of first appearance
+			_, last = np.unique(rows[::-1, 0], return_index=True)
+			_, first = np.unique(rows[:, 0], return_index=True)
+			rows = rows[len(rows) - 1 - last[np.argsort(first)]]
+		else:
+			_, first = np.unique(rows[:, 0], return_index=True)
+			rows = rows[np.sort(first)]
+
+		# pals.shape = (n_colors, n_pals, 4) -> (n_pals, n_colors, 4)
+		pals = np.ascontiguousarray(unpack_colors(rows).swapaxes(0, 1))
+		dests = list(pals[1:])
+		if self.names:
+			dests = [ImagePalette(pal, name=name) for pal, name in zip(dests, self.names)]
+		return ImagePaletteMapping(pals[0], dests)
+
+def unique_packed_rows(rows):
+	"""distinct rows of a 2D uint32 array, in order of first appearance"""
+	rows = np.ascontiguousarray(rows, dtype='<u4')
+	_, first = np.unique(rows.view(np.dtype((np.void, rows.itemsize * rows.shape[1]))).ravel(), return_index=True)
+	return rows[np.sort(first)]
+
+def find_image_sets(source_dir, target_dirs, verbose=False):
+	"""
+	finds images in `source_dir` (recursively) which have a file with the same relative path in 
+	each of `target_dirs`; returns a list of [source_path, target_path_1, ...] sets
+	"""
+	sets = []
+	for source_path in find_images([source_dir]):
+		rel = os.path.relpath(source_path, source_dir)
+		paths = [source_path] + [os.path.join(d, rel) for d in target_dirs]
+		if all(os.path.isfile(path) for path in paths):
+			sets.append(paths)
+		elif verbose: print(f"- skipping {rel}, which is missing from some target directories")
+	return sets
+
+def make_mapping_strict(paths, names=None, on_conflict='last', verbose=False):
+	"""
+	makes a mapping by comparing a source image to target image(s) pixelwise; see 
+	`StrictMappingBuilder`. `paths` is [source, target_1, ...]; if these are directories, every 
+	image in the source directory is compared to the images with the same relative path in the 
+	target directories.
+	"""
+	if all(os.path.isdir(path) for path in paths):
+		image_sets = find_image_sets(paths[0], paths[1:], verbose=verbose)
+		if len(image_sets) == 0:
+			raise Exception(f"No images in {paths[0]} have counterparts in all of {paths[1:]}")
+	else:
+		image_sets = [paths]
+	return make_mapping_strict_sets(image_sets, names=names, on_conflict=on_conflict, verbose=verbose)
 
-	return ImagePaletteMapping(source_pal, dest_pals)
+def make_mapping_strict_sets(image_sets, names=None, on_conflict='last', verbose=False):
+	"""makes a single mapping from many sets of [source, target_1, ...] images"""
+	builder = StrictMappingBuilder(names=names)
+	for paths in image_sets:
+		if verbose: print(f"- comparing {paths}")
+		builder.add(paths)
 
+	conflicts = builder.conflicts()
+	if len(conflicts) > 0 and on_conflict != 'error':
+		print(f"Warning: {len(conflicts)} source colors map to more than one set of target colors; "
+			f"keeping the {on_conflict} set seen for each: \n" + 
+			"\n".join(f"- {source}: {targets}" for source, targets in conflicts.items()))
+	return builder.to_mapping(on_conflict=on_conflict)
 
 
 def make_mapping(source_path, target_paths, names=None, verbose=False):
@@ -981,13 +2282,19 @@ def convert_mapping(input, output, names=[], sort=None, verbose=True, reindex=No
 		in_map = in_map.reindex(reindex)
 	save_palette_mapping(in_map, output)
 
+	# compile the new mapping, so it is fast to load
+	if not output.endswith('.npz'):
+		load_palette_mapping(output)
+
 def main_convertmapping(args):
 	return convert_mapping(args.input, args.output, args.names, sort=args.sort, verbose=args.verbose, reindex=args.reindex)
 
 
 def main_create_mapping(args):
 	if args.strict:
-		colormap = make_mapping_strict([args.source] + args.target)
+		names, targets = zip(*parse_named_paths(args.target, default_names=[''] * len(args.target)))
+		colormap = make_mapping_strict([args.source] + list(targets), names=names if any(names) else None, 
+			on_conflict=args.on_conflict, verbose=args.verbose)
 	else: 
 		colormap = make_mapping(args.source, args.target, verbose=args.verbose)
 	if args.verbose: 
@@ -997,26 +2304,173 @@ def main_create_mapping(args):
 	save_palette_mapping(colormap, args.output)
 
 
-def concat_mappings(mappings, source=None, targets=None, filter=False, drop=False, sort=None):
-	pass
+def concat_mappings(mappings, source=None, targets=None, filter=False, drop=False, sort=None, verbose=False):
+	"""
+	combines the destination palettes of many `mappings` (mappings or paths to them) with the same 
+	source colors into one mapping. Each mapping is reordered to a common source palette with one 
+	lookup, then all destination colors are stacked at once, so this is linear in the number of 
+	mappings (unlike repeatedly adding mappings with `+`). A palette with the same name as one 
+	from an earlier mapping replaces it; unnamed palettes (e.g. from .png mappings) are all kept.
+
+	source: palette to use as the source of the combined mapping, with the same colors as the 
+		source palettes of `mappings` in any order; or the name of one of the destination palettes 
+		(see `ImagePaletteMapping.reindex`). Defaults to the source palette of the first mapping.
+	targets: additional destination palettes, in the order of the source palette
+	filter: if given, only keep the destination palettes with these names, in this order
+	drop: if given, remove the destination palettes with these names
+	sort: if given, sort the colors of the combined mapping; see `ImagePaletteMapping.sort_colors`
+	"""
+	mappings = [load_palette_mapping(m) if isinstance(m, str) else m for m in mappings]
+	if len(mappings) == 0:
+		raise Exception("No mappings to concatenate")
+
+	reindex = None
+	if source is None:
+		source_palette = mappings[0].source_palette
+	elif isinstance(source, str) and not os.path.isfile(source):
+		source_palette = mappings[0].source_palette
+		reindex = source
+	else:
+		source_palette = load_palette(source)
+
+	# names -> (mapping #, palette #, name), in order of first appearance
+	palettes = {}
+	orderings = []
+	for i, mapping in enumerate(mappings):
+		ordering, found = mapping.source_palette.lookup(source_palette.packed)
+		if len(mapping.source_palette) != len(source_palette) or not found.all():
+			raise Exception(f"Cannot concatenate mapping #{i}, whose source palette {mapping.source_palette} "
+				f"has different colors than {source_palette}")
+		orderings.append(ordering)
+		for j, pal in enumerate(mapping.dest_palettes):
+			# unnamed palettes are only named by their index, so are never duplicates of each other
+			key = pal.name if pal.name else (i, j)
+			if verbose and key in palettes: print(f"- palette '{key}' from mapping #{i} replaces an earlier palette")
+			palettes[key] = (i, j, pal.name)
+
+	for name in (drop or []):
+		palettes.pop(name, None)
+	if filter:
+		missing = [name for name in filter if name not in palettes]
+		if len(missing) > 0:
+			raise Exception(f"Palettes {missing} not found in mappings; available palettes: {[name for name in palettes if isinstance(name, str)]}")
+		palettes = { name: palettes[name] for name in filter }
+
+	# stack the destination colors of all mappings, reordered to the common source palette, 
+	# then pick out the kept palettes
+	all_dests = np.concatenate([np.empty((0, len(source_palette), 4), dtype='uint8')] + 
+		[mapping.dests[:, ordering] for mapping, ordering in zip(mappings, orderings)])
+	offsets = np.cumsum([0] + [mapping.n_palettes for mapping in mappings])
+	dests = all_dests[[offsets[i] + j for i, j, _ in palettes.values()]]
+
+	dest_palettes = [ImagePalette(dest, name=name) for (_, _, name), dest in zip(palettes.values(), dests)]
+	for target in (targets or []):
+		target = load_palette(target)
+		if len(target) != len(source_palette):
+			raise Exception(f"Target palette {target.name} has {len(target)} colors; expected {len(source_palette)}")
+		dest_palettes.append(target)
+
+	mapping = ImagePaletteMapping(source_palette, dest_palettes)
+	if reindex is not None:
+		mapping = mapping.reindex(reindex)
+	if sort is not None:
+		if verbose: print(f"Sorting by channel {sort}")
+		mapping = mapping.sort_colors(sort)
+	return mapping
 
 def main_concat_mappings(args):
-	pass
+	paths = find_images(args.mapping, extensions=('.json', '.png', '.npz'))
+	if args.verbose: print(f"Concatenating {len(paths)} mappings")
+	targets = load_maybe_named_palettes(args.target or [], verbose=args.verbose)
+	mapping = concat_mappings(paths, source=args.source, targets=targets, 
+		filter=args.filter, drop=args.drop, sort=args.sort, verbose=args.verbose)
+
+	if args.verbose: print(f"Saving mapping with {mapping.n_palettes} palettes to {args.output}")
+	save_palette_mapping(mapping, args.output)
+	if not args.output.endswith('.npz'):
+		load_palette_mapping(args.output)
 
 
 def doctor(img, palette, color='#ff0000', squish_transparent=True, ignore_transparent=True):
 	pal = load_palette(palette)
-	return pal.doctor_image(img, color=color)
+	return pal.doctor_image(img, color=color, squish_transparent=squish_transparent, ignore_transparent=ignore_transparent)
 
+def doctor_images(images, palette, output_paths=None, color='#ff0000', squish_transparent=True, ignore_transparent=True, 
+	tolerance=0, jobs=1, verbose=False):
+	"""
+	checks each of `images` (paths to images, or directories to search for .png images) against 
+	`palette`, in a pool of `jobs` processes (all cores if None). If `output_paths` is given, an 
+	image highlighting the offending pixels is written for each input with any (see 
+	`doctor_image`); `output_paths` can be a single pattern, formatted as in `recolor`.
+
+	returns a report: a dict of input path -> {'bad_pixels': count, 'colors': {hex color: count}}; 
+	with `tolerance` > 0, colors within the tolerance of a palette color are not considered bad 
+	(see `match_colors`), and the number of pixels with such colors is reported as 'snapped'.
+	"""
+	images = find_images(images)
+	if output_paths is None or len(output_paths) == 0:
+		output_paths = [None] * len(images)
+	elif len(output_paths) == 1:
+		output_paths = output_paths * len(images)
+	elif len(output_paths) != len(images):
+		raise Exception("Must give either one --output argument, or the same number of --output as --input arguments (one per image) \n"
+			f"- Inputs: {images} \n"
+			f"- Outputs: {output_paths} \n")
+
+	tasks = list(zip(images, output_paths))
+	results = pool_map(doctor_file, tasks, jobs=jobs, shared=dict(palette=palette, color=color, 
+		squish_transparent=squish_transparent, ignore_transparent=ignore_transparent, tolerance=tolerance, verbose=verbose))
+	raise_pool_errors(tasks, results, verbose=verbose)
+	return { path: result for path, (result, _) in zip(images, results) }
+
+def doctor_file(input_path, output_path_fmt, palette, color='#ff0000', squish_transparent=True, ignore_transparent=True, tolerance=0, verbose=False):
+	"""checks the image at `input_path` against `palette`; see `doctor_images`"""
+	input_path_basename = os.path.basename(input_path)
+	input_path_sans_ext, input_path_ext = os.path.splitext(input_path)
+
+	doctored = palette.doctor_image(Image.open(input_path), color=color, 
+		squish_transparent=squish_transparent, ignore_transparent=ignore_transparent, tolerance=tolerance)
+	colors = dict(zip([c.to_hex() for c in doctored['colors'].colors], doctored['counts']))
+	if verbose and len(colors) > 0: print(f"{input_path}: colors in image not found in palette: {colors}")
+
+	if output_path_fmt is not None and len(colors) > 0:
+		output_path = format_placeholders(output_path_fmt, {
+			'%B': input_path_basename,
+			'%b': os.path.splitext(input_path_basename)[0],
+			'%i': input_path_sans_ext, 
+			'%e': input_path_ext.lstrip('.'),
+			'%I': input_path
+		})
+		if verbose: print(f"- writing highlighted pixels to {output_path}")
+		mkdirpf(output_path)
+		doctored['img'].save(output_path)
+
+	report = {
+		'bad_pixels': sum(doctored['counts']),
+		'colors': colors
+	}
+	if tolerance > 0:
+		report['snapped'] = doctored['snapped']
+	return report
 
 def main_doctor(args):
-	img = Image.open(args.input)
 	palette = load_palette(args.palette)
-	doctored = doctor(img, palette, color=args.color, squish_transparent=args.squish_transparent, ignore_transparent=args.ignore_transparent)
-	img = doctored['img']
-	colors = doctored['colors']
-	if args.verbose: print(f"Colors in image not found in palette: {colors}")
-	img.save(args.output)
+	report = doctor_images(args.input, palette, output_paths=args.output, color=args.color, 
+		squish_transparent=args.squish_transparent, ignore_transparent=args.ignore_transparent, 
+		tolerance=args.tolerance, jobs=args.jobs, verbose=args.verbose)
+
+	bad = {path: r for path, r in report.items() if r['bad_pixels'] > 0}
+	print(f"{len(bad)} of {len(report)} images have colors not found in the palette")
+	if args.tolerance > 0:
+		print(f"{sum(r['snapped'] for r in report.values())} pixels are within tolerance {args.tolerance} of a palette color")
+	for path, r in bad.items():
+		print(f"- {path}: {r['bad_pixels']} pixels, {len(r['colors'])} colors")
+
+	if args.report is not None:
+		if args.verbose: print(f"Writing report to {args.report}")
+		mkdirpf(args.report)
+		with open(args.report, 'w') as f:
+			json.dump(report, f, indent=2)
 
 
 def main_recolor(args):
@@ -1069,10 +2523,24 @@ def main_recolor(args):
 		mapping_img = mapping.to_image()
 		mapping_img.save(args.mapping_output)
 	
-	recolor(args.input, mappings, args.output, mode=args.mode, verbose=False)
+	recolor(args.input, mappings, args.output, mode=args.mode, engine=args.engine, indexed=args.indexed, jobs=args.jobs, threads=args.threads, tolerance=args.tolerance, verbose=False)
 
 
-def recolor(images, mappings, output_paths, mode='sum', verbose=False):
+def recolor(images, mappings, output_paths, mode='sum', engine='lookup', indexed=False, jobs=1, threads=1, tolerance=0, verbose=False):
+	"""
+	recolors each of `images` with `mappings`, writing outputs to `output_paths`. Images are 
+	spread across `jobs` worker processes (all cores if None); each worker receives the 
+	mappings once. Errors are reported per image, after all other images have been written. 
+	Each image is split into bands for `threads` threads; this helps when a few very large 
+	images would otherwise be left for the last workers.
+
+	If there are fewer images than `jobs`, the images are instead processed one at a time, 
+	and their output palettes are spread across the worker processes, if there are enough output 
+	pixels to be worth it; see `recolor_file`.
+
+	With `tolerance` > 0, pixels which are within `tolerance` of a source color in each channel are 
+	recolored as that color (see `match_colors`); returns the total number of such pixels.
+	"""
 	# mapping = load_palette_map_json(args.mapping)
 
 	if len(output_paths) == 1:
@@ -1082,121 +2550,291 @@ def recolor(images, mappings, output_paths, mode='sum', verbose=False):
 			f"- Inputs: {images} \n"
 			f"- Outputs: {output_paths} \n")
 
+	if mode not in ['sum', 'product']:
+		raise Exception(f"Unsupported mapping combinator {mode}; choose from 'sum' or 'product'")
+	if engine not in RECOLOR_ENGINES:
+		raise Exception(f"Unknown recolor engine {engine}; choose from {RECOLOR_ENGINES}")
+	if tolerance > 0 and engine == 'mask':
+		raise Exception("The 'mask' engine only matches colors exactly; use the 'lookup' engine with a tolerance")
+
+	if jobs is None:
+		jobs = os.cpu_count() or 1
+
+	tasks = list(zip(images, output_paths))
+	shared = dict(mappings=mappings, mode=mode, engine=engine, indexed=indexed, threads=threads, tolerance=tolerance, verbose=verbose)
+	if len(tasks) < jobs and engine != 'mask':
+		results = pool_map(recolor_file, tasks, jobs=1, shared=dict(shared, jobs=jobs))
+	else:
+		results = pool_map(recolor_file, tasks, jobs=jobs, shared=shared)
+	raise_pool_errors(tasks, results, verbose=verbose)
+
+	snapped = sum(result for result, _ in results)
+	if tolerance > 0: print(f"Snapped {snapped} pixels to a source color within tolerance {tolerance}")
+	return snapped
 
-	for input_path, output_path_fmt in zip(images, output_paths):
-		if verbose: print(f"Reading input image {input_path}...")
-		input_path_basename = os.path.basename(input_path)
-		input_path_basename_sans_ext, _ = os.path.splitext(input_path_basename)
-		input_path_sans_ext, input_path_ext = os.path.splitext(input_path)
-		input_path_ext = input_path_ext.lstrip('.')
 
-		img = Image.open(input_path)
+# starting a pool and sharing the image costs about as much as writing a few million recolored 
+# pixels, so `recolor_file` only spreads palettes across processes when the outputs (pixels 
+# times palettes) add up to at least this many
+RECOLOR_FANOUT_PIXELS = 2 ** 22
 
-		def save_img(out_img, palette_name):
-			output_path = format_placeholders(output_path_fmt, {
-				'%B': input_path_basename,
-				'%b': input_path_basename_sans_ext,
-				'%i': input_path_sans_ext, 
-				'%e': input_path_ext,
-				'%I': input_path,
-				'%p': palette_name
-			})
+def recolor_file(input_path, output_path_fmt, mappings, mode='sum', engine='lookup', indexed=False, threads=1, jobs=1, tolerance=0, verbose=False):
+	"""
+	recolors the image at `input_path` with `mappings`; see `recolor`. Returns the number of 
+	pixels matched within `tolerance` (palette entries, for indexed PNGs whose palette is rewritten); 
+	in 'sum' mode, pixels are matched against each mapping separately, and counted once per mapping.
+
+	With `jobs` > 1, the output palettes are recolored and written by a pool of worker processes, 
+	if there are at least `RECOLOR_FANOUT_PIXELS` output pixels in total. The decoded image and 
+	its palette indices are placed in shared memory, so each worker only receives their handles, 
+	rather than a copy of the image.
+	"""
 
-			if verbose: print(f"- writing output from palette '{palette_name}' to {output_path}")
-			mkdirpf(output_path)
-			out_img.save(output_path)
+	if verbose: print(f"Reading input image {input_path}...")
+	input_path_basename = os.path.basename(input_path)
+	input_path_basename_sans_ext, _ = os.path.splitext(input_path_basename)
+	input_path_sans_ext, input_path_ext = os.path.splitext(input_path)
+	input_path_ext = input_path_ext.lstrip('.')
+
+	img = Image.open(input_path)
+
+	def get_output_path(palette_name):
+		return format_placeholders(output_path_fmt, {
+			'%B': input_path_basename,
+			'%b': input_path_basename_sans_ext,
+			'%i': input_path_sans_ext, 
+			'%e': input_path_ext,
+			'%I': input_path,
+			'%p': palette_name
+		})
+
+	def save_img(out_img, palette_name):
+		output_path = get_output_path(palette_name)
+		if verbose: print(f"- writing output from palette '{palette_name}' to {output_path}")
+		write_recolored(out_img, output_path)
+
+	# indexed PNGs can be recolored by rewriting their palette without decoding them, 
+	# as long as the outputs are PNGs too
+	png_data = None
+	if indexed and input_path_ext.lower() == 'png' and output_path_fmt.lower().endswith(('.png', '.%e')):
+		with open(input_path, 'rb') as f:
+			png_data = f.read()
+
+	def recolor_tables(source, tables):
+		# the input image is only matched against `source` once, then each 
+		# (palette_name, colors) table is applied to it
+		recolorer = None
+		if png_data is not None:
+			recolorer = IndexedPNG.open(png_data, source, tolerance)
+			if verbose and recolorer is not None: 
+				print(f"- rewriting palette of indexed image")
+				if tolerance > 0: print(f"- snapped {recolorer.snapped} palette entries to a source color within tolerance")
+		if recolorer is None:
+			recolorer = IndexedImage(img, source, indexed=indexed, threads=threads, tolerance=tolerance)
+			if verbose and tolerance > 0: print(f"- snapped {recolorer.snapped} pixels to a source color within tolerance")
+
+			if jobs > 1:
+				tables = list(tables)
+				if recolorer.keys.size * len(tables) >= RECOLOR_FANOUT_PIXELS:
+					tasks = [(get_output_path(palette_name), colors) for palette_name, colors in tables]
+					if verbose: print(f"- writing {len(tasks)} outputs with {jobs} processes")
+					with recolorer.share():
+						results = pool_map(recolor_to_file, tasks, jobs=jobs, shared=dict(recolorer=recolorer))
+					raise_pool_errors(tasks, results, verbose=verbose)
+					return recolorer.snapped
+
+		for palette_name, colors in tables:
+			save_img(recolorer.recolor(colors), palette_name)
+		return recolorer.snapped
+
+	if engine == 'mask':
+		recolor_series(img, mappings, save_img, mode=mode, engine=engine, indexed=indexed, verbose=verbose)
+		return 0
+
+	# apply each mapping separately; the image is matched once against the union of the 
+	# mappings' source palettes, and each palette becomes a color table over that union
+	elif mode == 'sum':
+		# pixels near (but not exactly) a source color must only snap to the colors of the mapping 
+		# being applied, so with a tolerance, the image is matched against each mapping in turn
+		if tolerance > 0 and len(mappings) > 1:
+			return sum(recolor_tables(*sum_mappings([mapping])) for mapping in mappings)
+
+		source, tables = sum_mappings(mappings)
+		return recolor_tables(source, tables)
+
+	# apply all combinations of mappings; the mappings are composed into a single color table 
+	# per combination of palettes, which are generated one at a time, so only one output image 
+	# is held in memory at once
+	elif mode == 'product':
+		source, combinations = compose_mappings(mappings)
+		return recolor_tables(source, combinations)
+
+
+def write_recolored(out_img, output_path):
+	mkdirpf(output_path)
+	if isinstance(out_img, bytes):
+		with open(output_path, 'wb') as f:
+			f.write(out_img)
+	else:
+		out_img.save(output_path)
 
+def recolor_to_file(output_path, colors, recolorer):
+	write_recolored(recolorer.recolor(colors), output_path)
 
-		# apply each mapping in series
-		if mode == 'sum':
-			for mapping in mappings:
 
-				out_imgs = mapping.recolor_image(img) #recolor_map(img, mapping)
+def recolor_series(img, mappings, save_img, mode='sum', engine='mask', indexed=False, verbose=False):
+	"""
+	recolors `img` by calling `ImagePaletteMapping.recolor_image` for each mapping in turn; in
+	'product' mode, every mapping is applied to every image produced by the previous one. This is 
+	how `recolor` worked before mappings were composed, and is used for the 'mask' engine.
+	"""
 
-				for (out_img, palette_name) in zip(out_imgs, mapping.names):
-					save_img(out_img, palette_name)
+	# apply each mapping in series
+	if mode == 'sum':
+		for mapping in mappings:
 
-		# apply all combinations of mappings
-		elif mode == 'product':
+			out_imgs = mapping.recolor_image(img, engine=engine, indexed=indexed) #recolor_map(img, mapping)
 
-			# start with a single image (the input image)
-			# apply the first mapping to all images; collect a list of output images (one per palette)
-			# then apply the next mapping to each of the accumulated output images; continue
-			# until no mappings remain
+			for (out_img, palette_name) in zip(out_imgs, mapping.names):
+				save_img(out_img, palette_name)
 
-			palette_join_character = '_'
+	# apply all combinations of mappings
+	elif mode == 'product':
 
-			src = img
+		# start with a single image (the input image)
+		# apply the first mapping to all images; collect a list of output images (one per palette)
+		# then apply the next mapping to each of the accumulated output images; continue
+		# until no mappings remain
 
-			mapped_imgs = [img]
-			palette_paths = ['']
+		palette_join_character = '_'
 
-			remaining_mappings = mappings[:]
-			while len(remaining_mappings) > 0:
+		src = img
 
-				mapping, *remaining_mappings = remaining_mappings
+		mapped_imgs = [img]
+		palette_paths = ['']
 
-				if verbose: print(f"Applying mapping {repr(mapping)}")
+		remaining_mappings = mappings[:]
+		while len(remaining_mappings) > 0:
 
-				mapping_out_imgs = []
-				mapping_palette_paths = []
+			mapping, *remaining_mappings = remaining_mappings
 
-				for img, palette_path in zip(mapped_imgs, palette_paths):
-					mapping_out_imgs.extend(mapping.recolor_image(img, src=src)) #recolor_map(img, mapping)
-					mapping_palette_paths.extend([palette_path + palette_join_character + palette_name for palette_name in mapping.names])
-					
-				mapped_imgs = mapping_out_imgs
-				palette_paths = mapping_palette_paths
+			if verbose: print(f"Applying mapping {repr(mapping)}")
 
-				if verbose: print(f" -> {zip(mapped_imgs, palette_paths)}")
+			mapping_out_imgs = []
+			mapping_palette_paths = []
 
+			for img, palette_path in zip(mapped_imgs, palette_paths):
+				# only the final mapping writes indexed images; intermediate images are recolored again
+				mapping_out_imgs.extend(mapping.recolor_image(img, src=src, engine=engine, 
+					indexed=(indexed and len(remaining_mappings) == 0))) #recolor_map(img, mapping)
+				mapping_palette_paths.extend([palette_path + palette_join_character + str(palette_name) for palette_name in mapping.names])
+				
+			mapped_imgs = mapping_out_imgs
+			palette_paths = mapping_palette_paths
 
-			for (out_img, palette_name) in zip(mapped_imgs, palette_paths):
-				save_img(out_img, palette_name.lstrip(palette_join_character))
+			if verbose: print(f" -> {zip(mapped_imgs, palette_paths)}")
 
-		else:
-			raise Exception(f"Unsupported mapping combinator {mode}; choose from 'sum' or 'product'")
 
+		for (out_img, palette_name) in zip(mapped_imgs, palette_paths):
+			save_img(out_img, palette_name.lstrip(palette_join_character))
 
-def main_difference(args):
-	if args.close:
-		import scipy.ndimage
-		# strel = np.array([
-		# 	[0,0,1,0,0],
-		# 	[0,1,1,1,0],
-		# 	[1,1,1,1,1],
-		# 	[0,1,1,1,0],
-		# 	[0,0,1,0,0]
-		# ])
-		# strel = np.array([
-		# 	[0,1,0],
-		# 	[1,1,1],
-		# 	[0,1,0]
-		# ])			
+	else:
+		raise Exception(f"Unsupported mapping combinator {mode}; choose from 'sum' or 'product'")
 
-	imgs = [Image.open(img) for img in args.input]
 
-	img1, *imgs = imgs
-	img1_arr = np.array(img1)
-	out_arr = img1_arr.copy()
+def difference_images(imgs, close=False):
+	"""
+	finds the pixels where any of `imgs` differs from the first image. All images are stacked into 
+	one array and compared at once. 
 
-	for img2 in imgs:
-		img2_arr = np.array(img2)
+	If `close`, the mask of pixels where each image differs from the first is closed (see 
+	`binary_closing`) before they are combined; this removes small gaps and creates larger 
+	contiguous regions. 
 
-		# mask = (img1_arr == img2_arr).all(axis=-1)
-		# if args.close:
-		# 	# mask = scipy.ndimage.binary_closing(mask, structure=strel)
-		# 	mask = scipy.ndimage.binary_dilation(mask)
+	returns (mask, differs): `mask` is a (height, width) boolean array of pixels where any image 
+	differs, and `differs` is an (n_images - 1, height, width) boolean array of where each 
+	other image differs from the first.
+	"""
+	imgs = [Image.open(img) if isinstance(img, str) else img for img in imgs]
+	if len(imgs) < 2:
+		raise Exception("Need at least 2 images to compare")
+	if not all_equal(img.size for img in imgs):
+		raise Exception(f"All images must have the same dimensions. Dimensions of images given: {[img.size for img in imgs]}")
 
+	# stack.shape = (n_images, height, width)
+	stack = np.stack([pack_colors(np.array(img.convert('RGBA'))) for img in imgs])
+	differs = stack[1:] != stack[0]
+	if close:
+		differs = binary_closing(differs)
+	return differs.any(axis=0), differs
 
-		# out_arr[mask,:] = [255,255,255,0]
+def difference_report(mask, differs, paths=None, layout=None):
+	"""
+	describes the changed pixels in `mask` (see `difference_images`) as a dict with:
+
+	- 'changed_pixels': the number of changed pixels
+	- 'images': for each image after the first, the number of pixels where it differs from the first
+	- 'regions': each 4-connected region of changed pixels, with its bounding box 
+		([left, upper, right, lower], as for `PIL.Image.crop`), number of pixels, and the images 
+		which differ from the first within it
+	- 'frames': if `layout` (a `SpritesheetLayout` or the name of one) is given, each animation 
+		frame with changed pixels, with the bounding box (in the frame) and number of changed 
+		pixels, and the regions overlapping it (as indices into 'regions')
+	"""
+	if paths is None:
+		paths = [str(i) for i in range(len(differs) + 1)]
+	labels, n_regions = label_regions(mask)
+	bboxes, pixels = region_bboxes(labels, n_regions)
+
+	region_images = [[] for _ in range(n_regions)]
+	for path, diff in zip(paths[1:], differs):
+		for region in np.unique(labels[diff]).tolist():
+			if region > 0: region_images[region - 1].append(path)
+
+	report = {
+		'size': [mask.shape[1], mask.shape[0]],
+		'inputs': list(paths),
+		'changed_pixels': int(mask.sum()),
+		'images': { path: int(diff.sum()) for path, diff in zip(paths[1:], differs) },
+		'regions': [{ 'bbox': bbox, 'pixels': n, 'images': images } 
+			for bbox, n, images in zip(bboxes.tolist(), pixels.tolist(), region_images)]
+	}
+
+	if layout is not None:
+		from .arrange import load_layout
+		layout = load_layout(layout)
+		frame_w, frame_h = layout.frame_size
+
+		frames = []
+		for afi, (col, row) in layout.items():
+			frame_mask = mask[row*frame_h:(row+1)*frame_h, col*frame_w:(col+1)*frame_w]
+			if not frame_mask.any():
+				continue
+			fy, fx = np.nonzero(frame_mask)
+			frame_labels = labels[row*frame_h:(row+1)*frame_h, col*frame_w:(col+1)*frame_w]
+			frames.append(dict(afi.to_dict(), 
+				bbox=[int(fx.min()), int(fy.min()), int(fx.max()) + 1, int(fy.max()) + 1],
+				pixels=len(fx),
+				regions=(np.unique(frame_labels[fy, fx]) - 1).tolist()))
+		report['frames'] = frames
+	return report
 
-		mask = (img1_arr != img2_arr).any(axis=-1)
-		if args.close:
-			mask = scipy.ndimage.binary_closing(mask)#, structure=strel)
-			# mask = scipy.ndimage.binary_dilation(mask)
+def main_difference(args):
+	mask, differs = difference_images(args.input, close=args.close)
 
-		out_arr[~mask,:] = [255,255,255,0]
+	# keep the pixels of the first image which differ in any other image
+	out_arr = np.array(Image.open(args.input[0]).convert('RGBA'))
+	out_arr[~mask,:] = [255,255,255,0]
 
 	out_img = Image.fromarray(out_arr)
 	out_img.save(args.output)
+
+	if args.report is not None or args.verbose:
+		report = difference_report(mask, differs, paths=args.input, layout=args.layout)
+		print(f"{report['changed_pixels']} pixels changed, in {len(report['regions'])} regions" + 
+			(f" and {len(report['frames'])} frames" if 'frames' in report else ''))
+		if args.report is not None:
+			if args.verbose: print(f"Writing report to {args.report}")
+			mkdirpf(args.report)
+			with open(args.report, 'w') as f:
+				json.dump(report, f, indent=2)
@@ -4,6 +4,7 @@ import re
 import collections
 import itertools
 import textwrap
+import traceback
 
 def wrap_fill(text, width=79, **kwargs):
 	return textwrap.fill(text, width=width, **kwargs)
@@ -130,6 +131,16 @@ def unique_rows(a):
 	return pd.unique(b).view(a.dtype).reshape(-1, a.shape[1])
 
 
+def cache_dir(*paths):
+	"""
+	path within the directory where lpctools keeps cached data: $LPCTOOLS_CACHE_DIR if set, 
+	otherwise $XDG_CACHE_HOME/lpctools (~/.cache/lpctools)
+	"""
+	base = os.environ.get('LPCTOOLS_CACHE_DIR')
+	if not base:
+		base = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')), 'lpctools')
+	return os.path.join(base, *paths)
+
 def mkdirp(*paths):
 	fn = os.path.join(*paths)
 	os.makedirs(fn, exist_ok=True)
@@ -142,6 +153,22 @@ def mkdirpf(*paths):
 		os.makedirs(dn, exist_ok=True)
 	return fn
 
+def find_images(paths, extensions=('.png',)):
+	"""
+	expands any directories in `paths` to the images (or other files with one of `extensions`) 
+	within them, recursively; hidden files (e.g. cached mappings) are skipped
+	"""
+	images = []
+	for path in paths:
+		if os.path.isdir(path):
+			for root, dirs, files in os.walk(path):
+				dirs.sort()
+				images.extend(os.path.join(root, fn) for fn in sorted(files) 
+					if os.path.splitext(fn)[1].lower() in extensions and not fn.startswith('.'))
+		else:
+			images.append(path)
+	return images
+
 def format_placeholders(template, placeholders, special='%'):
 	"""replaces a set of named placeholders in a template string"""
 
@@ -182,6 +209,229 @@ assert pattern_to_regex('%n-%d%f',placeholders={'f':r'\d+','d':r'\D+'}) == '(?P<
 # 			items.extend(values)
 # 			setattr(namespace, self.dest, items)
 
+_pool_shared = {}
+
+def _pool_init(shared):
+	_pool_shared.clear()
+	_pool_shared.update(shared)
+
+def _pool_call(func, task):
+	try:
+		return (func(*task, **_pool_shared), None)
+	except Exception:
+		return (None, traceback.format_exc())
+
+def pool_map(func, tasks, jobs=1, shared={}):
+	"""calls `func(*task, **shared)` for each task in `tasks`, in a pool of `jobs` processes
+
+	`shared` is sent to each worker process once, rather than with every task, so it can hold 
+	large objects (e.g. palette mappings) that are the same for all tasks. `func` must be a 
+	module-level function. If `jobs` is None, one process is used per core; if `jobs` is 1, 
+	tasks are run in this process.
+
+	returns a list of `(result, error)` pairs in the same order as `tasks`; `error` is None, 
+	or the formatted traceback if the task raised an exception.
+	"""
+	tasks = list(tasks)
+	if jobs is None:
+		jobs = os.cpu_count() or 1
+	jobs = min(jobs, len(tasks))
+
+	if jobs <= 1:
+		_pool_init(shared)
+		try:
+			return [_pool_call(func, task) for task in tasks]
+		finally:
+			_pool_shared.clear()
+
+	import multiprocessing
+	with multiprocessing.Pool(jobs, initializer=_pool_init, initargs=(shared,)) as pool:
+		return pool.starmap(_pool_call, [(func, task) for task in tasks], chunksize=1)
+
+def raise_pool_errors(tasks, results, verbose=False):
+	"""prints the error for each failed task from `pool_map`, then raises if there were any"""
+	failed = [task for task, (_, error) in zip(tasks, results) if error is not None]
+	for task, (_, error) in zip(tasks, results):
+		if error is not None:
+			print(f"Error processing {task[0]}:")
+			print(error if verbose else error.strip().splitlines()[-1])
+	if len(failed) > 0:
+		raise Exception(f"{len(failed)} of {len(results)} inputs failed: {[task[0] for task in failed]}")
+
+def _attach_shared_memory(name):
+	from multiprocessing import shared_memory
+	try:
+		# python >= 3.13: only the creating process should track (and clean up) the block
+		return shared_memory.SharedMemory(name=name, track=False)
+	except TypeError:
+		return shared_memory.SharedMemory(name=name)
+
+class SharedArray():
+	"""
+	A numpy array (`self.array`) stored in a `multiprocessing.shared_memory` block.
+
+	Pickling a SharedArray only sends its handle (block name, shape and dtype); unpickling it in 
+	another process attaches to the same block, without copying the data. The process that 
+	created the block owns it, and should free it by using the SharedArray as a context manager 
+	(or by calling `close` and `unlink`), including when an error occurs.
+	"""
+	def __init__(self, shape, dtype, name=None):
+		import numpy as np
+		from multiprocessing import shared_memory
+
+		self.shape = tuple(shape)
+		self.dtype = np.dtype(dtype)
+		self.owner = name is None
+		if self.owner:
+			size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+			self.shm = shared_memory.SharedMemory(create=True, size=size)
+		else:
+			self.shm = _attach_shared_memory(name)
+		self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+	@classmethod
+	def from_array(cls, arr):
+		"""copies `arr` into a new shared memory block"""
+		shared = cls(arr.shape, arr.dtype)
+		shared.array[...] = arr
+		return shared
+
+	@property
+	def handle(self):
+		return (self.shm.name, self.shape, self.dtype.str)
+
+	def __reduce__(self):
+		name, shape, dtype = self.handle
+		return (SharedArray, (shape, dtype, name))
+
+	def __repr__(self):
+		return f"SharedArray({self.handle})"
+
+	def close(self):
+		"""detaches this process from the block"""
+		self.array = None
+		try:
+			self.shm.close()
+		except BufferError:
+			# views of `array` are still alive; the mapping is released once they are
+			pass
+
+	def unlink(self):
+		"""frees the block; only the owner should call this"""
+		self.shm.unlink()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		try:
+			if self.owner:
+				self.unlink()
+		finally:
+			self.close()
+
+def map_row_bands(func, n_rows, threads=1):
+	"""calls `func(start, stop)` for horizontal bands of rows that together cover `range(n_rows)`
+
+	With `threads` > 1 (or None, for one thread per core), the bands are processed on a thread pool, 
+	so `func` should spend its time in numpy or PIL operations that release the GIL, and write its 
+	results into disjoint rows of preallocated outputs. Returns the results of `func`, in order.
+	"""
+	if threads is None:
+		threads = os.cpu_count() or 1
+	n_bands = max(1, min(threads, n_rows))
+	bands = [(i * n_rows // n_bands, (i + 1) * n_rows // n_bands) for i in range(n_bands)]
+	if n_bands == 1:
+		return [func(*band) for band in bands]
+
+	from concurrent.futures import ThreadPoolExecutor
+	with ThreadPoolExecutor(n_bands) as executor:
+		return list(executor.map(lambda band: func(*band), bands))
+
+def _cross_shifts(mask, border):
+	import numpy as np
+	# `mask` and its 4 neighbors in the last two axes, with `border` beyond the edges
+	padded = np.pad(mask, [(0, 0)] * (mask.ndim - 2) + [(1, 1), (1, 1)], constant_values=border)
+	return [padded[..., 1:-1, 1:-1], padded[..., :-2, 1:-1], padded[..., 2:, 1:-1], 
+		padded[..., 1:-1, :-2], padded[..., 1:-1, 2:]]
+
+def binary_dilation(mask):
+	"""dilates boolean `mask` (over its last two axes) by a cross; like `scipy.ndimage.binary_dilation`"""
+	import numpy as np
+	return np.logical_or.reduce(_cross_shifts(mask, False))
+
+def binary_erosion(mask):
+	"""erodes boolean `mask` (over its last two axes) by a cross; like `scipy.ndimage.binary_erosion`"""
+	import numpy as np
+	return np.logical_and.reduce(_cross_shifts(mask, False))
+
+def binary_closing(mask):
+	"""
+	morphological closing of boolean `mask` (over its last two axes) by a cross, with pixels beyond 
+	the edges taken as False; same as `scipy.ndimage.binary_closing` with its default arguments, 
+	applied to each 2D slice of `mask`
+	"""
+	return binary_erosion(binary_dilation(mask))
+
+def label_regions(mask):
+	"""
+	labels the 4-connected regions of True pixels in 2D boolean `mask`, like `scipy.ndimage.label`
+
+	returns (labels, n_regions): `labels` is an int array of the same shape, 0 outside of `mask` 
+	and 1..n_regions inside, numbered in order of each region's first pixel (top-to-bottom, 
+	left-to-right)
+	"""
+	import numpy as np
+	mask = np.asarray(mask, dtype=bool)
+
+	# number the horizontal runs of True pixels, in raster order
+	starts = mask.copy()
+	starts[:, 1:] &= ~mask[:, :-1]
+	run_ids = np.cumsum(starts.ravel()).reshape(mask.shape) - 1
+	n_runs = int(starts.sum())
+	if n_runs == 0:
+		return np.zeros(mask.shape, dtype='int32'), 0
+
+	# runs which touch vertically are in the same region
+	touching = mask[:-1] & mask[1:]
+	a, b = run_ids[:-1][touching], run_ids[1:][touching]
+
+	# propagate the smallest run id through each region, halving paths as we go
+	parent = np.arange(n_runs)
+	while True:
+		low = np.minimum(parent[a], parent[b])
+		new_parent = parent.copy()
+		np.minimum.at(new_parent, parent[a], low)
+		np.minimum.at(new_parent, parent[b], low)
+		new_parent = new_parent[new_parent]
+		if (new_parent == parent).all():
+			break
+		parent = new_parent
+
+	# root run ids are increasing in raster order, so this numbers regions by their first pixel
+	roots, region_of_run = np.unique(parent, return_inverse=True)
+	labels = np.zeros(mask.shape, dtype='int32')
+	labels[mask] = region_of_run[run_ids[mask]] + 1
+	return labels, len(roots)
+
+def region_bboxes(labels, n_regions):
+	"""
+	returns (bboxes, pixels): the (left, upper, right, lower) bounding box of each region 1..n_regions 
+	in `labels` (as an (n_regions, 4) array, with exclusive right and lower edges as for 
+	`PIL.Image.crop`), and the number of pixels in each
+	"""
+	import numpy as np
+	ys, xs = np.nonzero(labels)
+	ids = labels[ys, xs] - 1
+	bboxes = np.empty((n_regions, 4), dtype=np.intp)
+	bboxes[:, :2] = np.iinfo(np.intp).max
+	bboxes[:, 2:] = -1
+	np.minimum.at(bboxes[:, 0], ids, xs)
+	np.minimum.at(bboxes[:, 1], ids, ys)
+	np.maximum.at(bboxes[:, 2], ids, xs + 1)
+	np.maximum.at(bboxes[:, 3], ids, ys + 1)
+	return bboxes, np.bincount(ids, minlength=n_regions)
+
 def composite_images(images, inplace=True):
 	"""composites each image in images on top of one another, in order
 	"""
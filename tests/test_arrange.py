@@ -25,6 +25,23 @@ class TestLayout():
 		assert filecmp.cmp(outfile,'tests/arrange_files/male-mirrored.png')
 
 
+	def test_repack_tree(self, tmpdir):
+		import shutil
+		from lpctools.arrange import repack_tree
+
+		(tmpdir / 'in' / 'body' / 'male').ensure(dir=True)
+		shutil.copy('tests/arrange_files/packed-evert.png', tmpdir / 'in' / 'body' / 'male' / 'sheet.png')
+		shutil.copy('tests/arrange_files/walk_push.png', tmpdir / 'in' / 'small.png')
+
+		report = repack_tree([str(tmpdir / 'in')], 'evert', ['universal'], output_dir=str(tmpdir / 'out'))
+		assert report[str(tmpdir / 'in' / 'small.png')]['status'] == 'error'
+		assert report[str(tmpdir / 'in' / 'body' / 'male' / 'sheet.png')] == {
+			'status': 'ok', 'outputs': [str(tmpdir / 'out' / 'body' / 'male' / 'sheet.png')] }
+		assert filecmp.cmp(tmpdir / 'out' / 'body' / 'male' / 'sheet.png', 'tests/arrange_files/packed-universal.png')
+
+		repack_tree([str(tmpdir / 'in' / 'body')], 'evert', ['cast', 'walk'], output_dir=str(tmpdir / 'out2'))
+		assert sorted(os.listdir(tmpdir / 'out2' / 'male' / 'sheet')) == ['cast.png', 'walk.png']
+
 	def test_separate(self, tmpdir):
 		import lpctools.arrange
 
@@ -67,6 +84,96 @@ class TestLayout():
 
 		assert_dirs_are_same(tmpdir, 'tests/arrange_files/unpacked_extended')
 
+	def test_unpack_arrays(self):
+		import numpy as np
+		from PIL import Image
+		from lpctools.arrange import load_layout, SpritesheetLayout, FrameImages, AnimationFrameID
+
+		layout = load_layout('universal')
+		img = Image.open('tests/arrange_files/packed-universal.png')
+		arr = np.array(img)
+		frames = layout.unpack_images(img)
+		assert isinstance(frames, FrameImages)
+		assert len(frames._images) == 0
+
+		afi = AnimationFrameID('walk', 's', 3)
+		x, y = layout.get_pixel_pos(afi)
+		assert np.shares_memory(layout.unpack_arrays(arr)[afi], arr)
+		assert (frames.array(afi) == arr[y:y+64, x:x+64]).all()
+		assert (np.array(frames[afi]) == arr[y:y+64, x:x+64]).all()
+		assert len(frames._images) == 1
+
+		# frames keep the color profile of the sheet, as with `Image.crop`
+		img = Image.open('tests/arrange_files/walk_push.png')
+		frames = load_layout('push').unpack_images(img)
+		assert frames[AnimationFrameID('push', 'e', 0)].info['icc_profile'] == img.info['icc_profile']
+
+		# frames which are not square
+		layout = SpritesheetLayout({(0, 0): ('a', 's', 0), (1, 0): ('a', 's', 1), (0, 1): ('b', 's', 0)}, frame_size=(16, 32))
+		arr = np.arange(64 * 32 * 4, dtype='uint32').astype('uint8').reshape((64, 32, 4))
+		frames = layout.unpack_images(Image.fromarray(arr))
+		assert frames[('b', 's', 0)].size == (16, 32)
+		assert (frames.array(('a', 's', 1)) == arr[:32, 16:]).all()
+		assert (frames.array(('b', 's', 0)) == arr[32:, :16]).all()
+
+	def test_pack_arrays(self):
+		import numpy as np
+		from PIL import Image
+		from lpctools.arrange import load_layout, SpritesheetLayout, AnimationFrameID, COLOR_TRANSPARENT
+
+		layout = load_layout('universal')
+		img = Image.open('tests/arrange_files/packed-universal.png')
+		arr = np.array(img)
+		assert (np.array(layout.pack_images(layout.unpack_images(img), verbose=False)) == arr).all()
+		assert (np.array(layout.pack_grid(layout.frame_grid(img))) == arr).all()
+
+		# compare to pasting each frame onto a transparent image
+		layout = SpritesheetLayout({(0, 0): ('a', 's', 0), (1, 0): ('a', 's', 1), (0, 1): ('b', 's', 0), (1, 1): ('b', 's', 1)}, 
+			frame_size=(16, 32))
+		rng = np.random.default_rng(0)
+		images = {
+			# PIL image, array, smaller and larger images which are centered, and a missing frame
+			('a', 's', 0): Image.fromarray(rng.integers(0, 256, (32, 16, 4), dtype='uint8')),
+			('a', 's', 1): rng.integers(0, 256, (32, 16, 4), dtype='uint8'),
+			('b', 's', 0): Image.fromarray(rng.integers(0, 256, (10, 40, 4), dtype='uint8')),
+			('b', 's', 1): None,
+		}
+		expected = Image.new('RGBA', layout.pixel_size, color=COLOR_TRANSPARENT)
+		expected.paste(images[('a', 's', 0)], (0, 0))
+		expected.paste(Image.fromarray(images[('a', 's', 1)]), (16, 0))
+		expected.paste(images[('b', 's', 0)], (8 - 20, 32 + 16 - 5))
+		assert (np.array(layout.pack_images(images, verbose=False)) == np.array(expected)).all()
+
+	def test_remap_plan(self):
+		import numpy as np
+		from PIL import Image
+		from lpctools.arrange import load_layout, mirror_images
+
+		evert, universal = load_layout('evert'), load_layout('universal')
+		plan = universal.remap_plan('evert', mirror=('e','w'))
+		assert universal.remap_plan(['evert'], mirror=['e','w']) is plan
+		assert universal.remap_plan('evert') is not plan
+
+		# whole rows are copied as one block
+		assert len(plan.blocks) == 21
+		assert plan.blocks[0] == plan.Block(0, (0, 0), (0, 0), 7, None)
+		assert plan.blocks[1].flip == 'h' and plan.blocks[1].src == (0, 3)
+		assert next(plan.rects()) == (0, (0, 0, 7*64, 64), (0, 0, 7*64, 64), None)
+
+		# same result as unpacking, mirroring and packing each frame
+		img = Image.open('tests/arrange_files/packed-evert.png')
+		expected = universal.pack_images(mirror_images(evert.unpack_images(img), 'e', 'w'), verbose=False)
+		assert (np.array(plan.apply(img)) == np.array(expected)).all()
+
+		# layouts which differ only in size get their own plans
+		from lpctools.arrange import SpritesheetLayout, AnimationFrameID, remap_images
+		positions = {(0, 0): AnimationFrameID('walk', 's', 0)}
+		small = SpritesheetLayout(positions, size=(2, 2), frame_size=(4, 4))
+		large = SpritesheetLayout(positions, size=(3, 3), frame_size=(4, 4))
+		assert remap_images(np.zeros((8, 8, 4), dtype='uint8'), small, small).size == (8, 8)
+		assert remap_images(np.zeros((8, 8, 4), dtype='uint8'), small, large).size == (12, 12)
+		assert remap_images(np.zeros((12, 12, 4), dtype='uint8'), large, large).size == (12, 12)
+
 	def test_pack(self, tmpdir):
 
 		import lpctools.arrange
@@ -257,6 +364,42 @@ class TestDistribute():
 
 		assert filecmp.cmp(outfile, 'tests/arrange_files/hair/hair_shoulderr.png')
 
+	def test_sheet_template(self):
+		import numpy as np
+		from PIL import Image
+		import lpctools.arrange
+		from lpctools.arrange import load_layout, load_images, SheetTemplate, distribute_layers
+
+		layout = load_layout('universal')
+		offsets_image = Image.open('tests/arrange_files/hair/reference_points_male.png')
+		masks_image = Image.open('tests/arrange_files/hair/masks_male.png')
+
+		# compare to applying the template of each frame, for each layer (including missing images)
+		for layer in ['bg', 'main']:
+			mask_colors = distribute_layers[layer]['mask_colors']
+			images = load_images(glob('tests/arrange_files/hair/hair_shoulderr/*.png'), distribute_layers[layer]['pattern'])
+			templates = lpctools.arrange.get_frame_templates_from_images(layout, offsets_image, masks_image, mask_colors=mask_colors)
+			expected = layout.pack_images(lpctools.arrange.distribute_images(images, templates, positions=layout), verbose=False)
+
+			template = SheetTemplate.from_images(layout, offsets_image, masks_image, mask_colors=mask_colors)
+			assert template.mask.shape == (layout.pixel_size[1], layout.pixel_size[0])
+			assert (np.array(template.apply(images)) == np.array(expected)).all()
+
+		# offsets images without an alpha band: offsets are found as by `getbbox` in the image's own mode
+		rgb = Image.new('RGB', offsets_image.size)
+		rgb.paste(offsets_image, mask=offsets_image)
+		# transparent pixels with a nonzero color count as content for an RGB image
+		rgb.paste((0, 0, 1), (0, 64, 64, 68))
+		for img in [rgb, rgb.convert('L'), rgb.quantize(16)]:
+			template = SheetTemplate.from_images(layout, offsets_image=img)
+			templates = lpctools.arrange.get_frame_templates_from_images(layout, offsets_image=img)
+			for afi in layout:
+				x, y = layout.get_pixel_pos(afi)
+				bbox = img.crop((x, y, x + 64, y + 64)).getbbox()
+				assert template.offsets[afi] == templates[afi].offset == (bbox[:2] if bbox else (32, 32))
+			if img.mode == 'RGB':
+				assert template.offsets[('cast', 'w', 0)] == (0, 0)
+
 	def test_distribute_shield(self, tmpdir):
 		import lpctools.arrange
 
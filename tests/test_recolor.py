@@ -37,6 +37,26 @@ class TestPalette():
 
 		pal2 = load_palette('tests/recolor_files/ivory.gpl')
 
+	def test_load_png(self):
+		import numpy as np
+		import pytest
+		from PIL import Image
+		from lpctools.recolor import load_palette_png
+
+		# colors are in order of first appearance, with transparent pixels squished
+		arr = np.array(Image.open('tests/recolor_files/hair_plain.png').convert('RGBA')).reshape((-1, 4))
+		arr[arr[:, 3] == 0] = [255, 255, 255, 0]
+		expected = list(dict.fromkeys(tuple(c) for c in arr.tolist()))
+		assert [tuple(c) for c in load_palette_png('tests/recolor_files/hair_plain.png')] == expected
+		assert len(load_palette_png('tests/recolor_files/hair_plain.png', max_colors=len(expected))) == len(expected)
+		with pytest.raises(Exception, match='more than'):
+			load_palette_png('tests/recolor_files/hair_plain.png', max_colors=len(expected) - 1)
+
+		# indexed images give their palette, including transparency
+		pal = load_palette_png('tests/recolor_files/hair_page2.png')
+		assert tuple(pal[0]) == (255, 255, 255, 0)
+		assert len(pal) == len(Image.open('tests/recolor_files/hair_page2.png').getpalette()) // 3
+
 	def test_convert(self, tmpdir):
 		from lpctools.recolor import convert_palette
 
@@ -45,6 +65,26 @@ class TestPalette():
 
 		filecmp.cmp(outfile, 'tests/recolor_files/ivory.png')
 
+	def test_array(self):
+		import numpy as np
+		from lpctools.recolor import ImagePalette, Color
+
+		rng = np.random.default_rng(0)
+		colors = [tuple(c) for c in rng.integers(0, 4, (50, 4)).tolist()] + ['#ff0000', '#00ff0080', (12, 34, 56)]
+		pal = ImagePalette(colors)
+		assert list(pal) == [Color(c) for c in colors]
+
+		# vectorized HSV matches colorsys, so sorting is unchanged
+		assert pal.to_hsv() == [c.to_hsv() for c in pal]
+
+		# duplicate colors resolve to their last position, as with a dict
+		for c in pal:
+			assert c in pal
+			assert pal.index(c) == dict((c, i) for i, c in enumerate(pal))[c]
+		assert (1, 2, 3, 200) not in pal
+		assert list(pal.unique()) == list(dict.fromkeys(pal))
+		assert list(pal.sort('value')) == [pal[i] for i in pal.argsort('value')]
+
 
 
 class TestRecolorCLI():
@@ -92,3 +132,492 @@ class TestRecolorCLI():
 		# assert filecmp.cmp(f"{tmpdir}/hair/blue.png", 'tests/recolor_files/expected_output/hair/blue.png')
 		# assert filecmp.cmp(f"{tmpdir}/hair_page2/blonde.png", 'tests/recolor_files/expected_output/hair_page2/blonde.png')
 		# assert filecmp.cmp(f"{tmpdir}/hair_page2/blue.png", 'tests/recolor_files/expected_output/hair_page2/blue.png')
+
+
+class TestMapping():
+	def test_recolor_engines(self):
+		import numpy as np
+		from PIL import Image
+		from lpctools.recolor import load_palette_mapping, make_mapping
+
+		mapping = load_palette_mapping('tests/recolor_files/palettes.json')
+		for path in ['tests/recolor_files/hair_plain.png', 'tests/recolor_files/hair_page2.png']:
+			img = Image.open(path)
+			for expected, actual in zip(mapping.recolor_image(img, engine='mask'), mapping.recolor_image(img, engine='lookup')):
+				assert (np.array(expected) == np.array(actual)).all()
+
+		mapping = make_mapping('tests/recolor_files/ivory.gpl', ['tests/recolor_files/ogre.gpl'])
+		img = Image.open('tests/recolor_files/human_head.png').convert('RGBA')
+		src = img.transpose(Image.FLIP_LEFT_RIGHT)
+		for expected, actual in zip(mapping.recolor_image(img, src=src, engine='mask'), mapping.recolor_image(img, src=src, engine='lookup')):
+			assert (np.array(expected) == np.array(actual)).all()
+
+	def test_recolor_indexed(self, tmpdir):
+		import numpy as np
+		from PIL import Image
+		import lpctools
+
+		lpctools.main(
+			shlex.split(f"colors recolor --indexed --input tests/recolor_files/hair_plain.png tests/recolor_files/hair_page2.png --mapping tests/recolor_files/palettes.json --output '{tmpdir}/%b/%p.%e'")
+		)
+
+		for name in ['hair_plain/blonde.png', 'hair_plain/blue.png', 'hair_page2/blonde.png', 'hair_page2/blue.png']:
+			actual = Image.open(str(tmpdir / name))
+			expected = Image.open(f'tests/recolor_files/expected_output/{name}')
+			assert actual.mode == 'P'
+			assert (np.array(actual.convert('RGBA')) == np.array(expected)).all()
+
+		# hair_page2.png is already indexed, so only its palette should have been rewritten
+		from lpctools.recolor import read_png_chunks
+		with open('tests/recolor_files/hair_page2.png', 'rb') as f:
+			input_chunks = read_png_chunks(f.read())
+		with open(str(tmpdir / 'hair_page2/blue.png'), 'rb') as f:
+			output_chunks = read_png_chunks(f.read())
+		assert [c for c in input_chunks if c[0] == b'IDAT'] == [c for c in output_chunks if c[0] == b'IDAT']
+
+	def test_recolor_product(self, tmpdir):
+		from lpctools.recolor import recolor, load_palette_mapping, ImagePaletteMapping
+
+		mappings = [
+			load_palette_mapping('tests/recolor_files/palettes.json'),
+			# overlaps with the source palette above, and with one of its destination colors
+			ImagePaletteMapping(['#300727', '#1C0E06', '#FFFFFF'], {
+				'red': ['#ff0000', '#aa0000', '#550000'], 
+				'green': ['#00ff00', '#00aa00', '#005500']
+			})
+		]
+		inputs = ['tests/recolor_files/hair_plain.png', 'tests/recolor_files/hair_page2.png']
+
+		recolor(inputs, mappings, [f'{tmpdir}/mask/%b/%p.%e'], mode='product', engine='mask')
+		recolor(inputs, mappings, [f'{tmpdir}/lookup/%b/%p.%e'], mode='product', engine='lookup')
+
+		for name in ['hair_plain', 'hair_page2']:
+			assert set(os.listdir(tmpdir / 'lookup' / name)) == {'blonde_red.png', 'blonde_green.png', 'blue_red.png', 'blue_green.png'}
+			assert_dirs_are_same(tmpdir / 'lookup' / name, tmpdir / 'mask' / name)
+
+	def test_recolor_sum(self, tmpdir):
+		from lpctools.recolor import recolor, load_palette_mapping, ImagePaletteMapping, sum_mappings
+
+		mappings = [
+			load_palette_mapping('tests/recolor_files/palettes.json'),
+			ImagePaletteMapping(['#300727', '#1C0E06', '#FFFFFF'], {
+				'red': ['#ff0000', '#aa0000', '#550000'], 
+				'green': ['#00ff00', '#00aa00', '#005500']
+			})
+		]
+		source, tables = sum_mappings(mappings)
+		assert [name for name, _ in tables] == ['blonde', 'blue', 'red', 'green']
+
+		inputs = ['tests/recolor_files/hair_plain.png', 'tests/recolor_files/hair_page2.png']
+		recolor(inputs, mappings, [f'{tmpdir}/mask/%b/%p.%e'], mode='sum', engine='mask')
+		recolor(inputs, mappings, [f'{tmpdir}/lookup/%b/%p.%e'], mode='sum', engine='lookup')
+
+		for name in ['hair_plain', 'hair_page2']:
+			assert set(os.listdir(tmpdir / 'lookup' / name)) == {'blonde.png', 'blue.png', 'red.png', 'green.png'}
+			assert_dirs_are_same(tmpdir / 'lookup' / name, tmpdir / 'mask' / name)
+
+	def test_compiled_mapping(self, tmpdir):
+		import shutil
+		import numpy as np
+		from lpctools.recolor import (convert_mapping, load_palette_mapping, load_palette_mapping_json, 
+			load_cached_palette_mapping, mapping_cache_path)
+
+		def assert_mappings_equal(a, b):
+			assert dict(a) == dict(b)
+			assert a.names == b.names
+			for x, y in zip(a.to_arrays(), b.to_arrays()):
+				assert (x == y).all()
+
+		expected = load_palette_mapping('tests/recolor_files/all-palettes.json', cache=False)
+		convert_mapping('tests/recolor_files/all-palettes.json', str(tmpdir / 'all-palettes.npz'))
+		assert_mappings_equal(expected, load_palette_mapping(str(tmpdir / 'all-palettes.npz')))
+
+		path = str(tmpdir / 'palettes.json')
+		shutil.copy('tests/recolor_files/palettes.json', path)
+		first = load_cached_palette_mapping(path, load_palette_mapping_json)
+		assert os.path.exists(mapping_cache_path(path))
+		assert_mappings_equal(first, load_cached_palette_mapping(path, load_palette_mapping_json))
+
+		# the compiled copy is rebuilt when the mapping changes
+		with open(path, 'w') as f:
+			f.write('{"source": ["#000000"], "red": ["#ff0000"]}')
+		changed = load_cached_palette_mapping(path, load_palette_mapping_json)
+		assert changed.names == ['red']
+		assert_mappings_equal(changed, load_palette_mapping_json(path))
+
+	def test_recolor_jobs(self, tmpdir):
+		import pytest
+		from lpctools.recolor import recolor, load_palette_mapping
+
+		mappings = [load_palette_mapping('tests/recolor_files/palettes.json')]
+		inputs = ['tests/recolor_files/hair_plain.png', 'tests/recolor_files/hair_page2.png']
+
+		recolor(inputs, mappings, [f'{tmpdir}/serial/%b/%p.%e'], jobs=1)
+		recolor(inputs, mappings, [f'{tmpdir}/parallel/%b/%p.%e'], jobs=2)
+		for name in ['hair_plain', 'hair_page2']:
+			assert_dirs_are_same(tmpdir / 'parallel' / name, tmpdir / 'serial' / name)
+
+		# a bad input is reported, but does not stop the others from being written
+		with pytest.raises(Exception, match='missing.png'):
+			recolor(['tests/recolor_files/missing.png'] + inputs, mappings, [f'{tmpdir}/errors/%b/%p.%e'], jobs=2)
+		for name in ['hair_plain', 'hair_page2']:
+			assert_dirs_are_same(tmpdir / 'errors' / name, tmpdir / 'serial' / name)
+
+	def test_recolor_threads(self, tmpdir, monkeypatch):
+		monkeypatch.setenv('LPCTOOLS_CACHE_DIR', str(tmpdir))
+		import numpy as np
+		from PIL import Image
+		from lpctools.recolor import load_palette_mapping, load_palette, coerce, increment_shade
+
+		mapping = load_palette_mapping('tests/recolor_files/palettes.json')
+		img = Image.open('tests/recolor_files/hair_plain.png')
+		for expected, actual in zip(mapping.recolor_image(img), mapping.recolor_image(img, threads=3)):
+			assert (np.array(expected) == np.array(actual)).all()
+
+		palette = load_palette('tests/recolor_files/ogre.gpl')
+		img = Image.open('tests/recolor_files/human_head.png')
+		assert (np.array(coerce(img, palette)) == np.array(coerce(img, palette, threads=3))).all()
+
+		palette = load_palette('tests/recolor_files/ivory.gpl')
+		img = img.convert('RGBA')
+		mask = img.transpose(Image.FLIP_LEFT_RIGHT)
+		increments = {'#000000': 1, '#ffffff': -1}
+		expected = increment_shade(img, increments, mask, palette)
+		actual = increment_shade(img, increments, mask, palette, threads=3)
+		assert (np.array(expected) == np.array(actual)).all()
+
+	def test_recolor_shared(self, tmpdir, monkeypatch, capsys):
+		import pickle
+		import lpctools.recolor
+		import numpy as np
+		from PIL import Image
+		from lpctools.recolor import recolor, load_palette_mapping, IndexedImage
+		from lpctools.utils import SharedArray
+
+		arr = np.arange(12, dtype='uint32').reshape(3, 4)
+		with SharedArray.from_array(arr) as shared:
+			attached = pickle.loads(pickle.dumps(shared))
+			assert not attached.owner
+			assert (attached.array == arr).all()
+			attached.array[0, 0] = 100
+			assert shared.array[0, 0] == 100
+			attached.close()
+
+		mapping = load_palette_mapping('tests/recolor_files/palettes.json')
+		source, dests = mapping.to_arrays()
+		img = Image.open('tests/recolor_files/hair_plain.png')
+		recolorer = IndexedImage(img, source, indexed=True)
+		expected = [np.array(recolorer.recolor(dest)) for dest in dests]
+		with recolorer.share():
+			blocks = list(recolorer._shared.values())
+			copy = pickle.loads(pickle.dumps(recolorer))
+			for dest, out in zip(dests, expected):
+				assert (np.array(copy.recolor(dest)) == out).all()
+				assert (np.array(recolorer.recolor(dest)) == out).all()
+
+		# the image is moved back to private memory, so the shared blocks are really detached
+		assert all(block.shm.buf is None for block in blocks)
+		for dest, out in zip(dests, expected):
+			assert (np.array(recolorer.recolor(dest)) == out).all()
+
+		# a single input image is split across processes by palette, once there are enough output pixels
+		inputs = ['tests/recolor_files/hair_plain.png']
+		recolor(inputs, [mapping], [f'{tmpdir}/serial/%b/%p.%e'], jobs=1)
+		recolor(inputs, [mapping], [f'{tmpdir}/unshared/%b/%p.%e'], jobs=2, verbose=True)
+		assert 'processes' not in capsys.readouterr().out
+		assert_dirs_are_same(tmpdir / 'unshared' / 'hair_plain', tmpdir / 'serial' / 'hair_plain')
+		monkeypatch.setattr(lpctools.recolor, 'RECOLOR_FANOUT_PIXELS', 0)
+		recolor(inputs, [mapping], [f'{tmpdir}/shared/%b/%p.%e'], jobs=2, verbose=True)
+		assert 'with 2 processes' in capsys.readouterr().out
+		assert_dirs_are_same(tmpdir / 'shared' / 'hair_plain', tmpdir / 'serial' / 'hair_plain')
+
+
+	def test_create_mapping_strict(self, tmpdir):
+		import numpy as np
+		from PIL import Image
+		import pytest
+		from lpctools.recolor import load_palette_mapping, make_mapping_strict, StrictMappingBuilder
+
+		mapping = load_palette_mapping('tests/recolor_files/palettes.json')
+		img = Image.open('tests/recolor_files/hair_plain.png').convert('RGBA')
+		recolored = dict(zip(mapping.names, mapping.recolor_image(img)))
+		for name in ['source'] + list(recolored):
+			os.makedirs(tmpdir / name / 'sub')
+		img.save(str(tmpdir / 'source' / 'sub' / 'hair.png'))
+		for name, out in recolored.items():
+			out.save(str(tmpdir / name / 'sub' / 'hair.png'))
+
+		paths = [str(tmpdir / name) for name in ['source'] + list(recolored)]
+		strict = make_mapping_strict(paths, names=list(recolored))
+		assert strict.names == list(recolored)
+		for expected, actual in zip(recolored.values(), strict.recolor_image(img)):
+			assert (np.array(expected) == np.array(actual)).all()
+
+		# a source color recolored two different ways is a conflict
+		a = Image.new('RGBA', (2, 1), (10, 20, 30, 255))
+		b = Image.new('RGBA', (2, 1), (40, 50, 60, 255))
+		c = Image.new('RGBA', (2, 1), (70, 80, 90, 255))
+		builder = StrictMappingBuilder().add([a, b]).add([a, c]).add([a, b])
+		assert len(builder.rows) == 2
+		assert list(builder.conflicts()) == [(10, 20, 30, 255)]
+		assert builder.to_mapping(on_conflict='first').dest_palettes[0].colors == [(40, 50, 60, 255)]
+		assert builder.to_mapping(on_conflict='last').dest_palettes[0].colors == [(70, 80, 90, 255)]
+		with pytest.raises(Exception):
+			builder.to_mapping(on_conflict='error')
+
+
+	def test_collapse_recolors(self):
+		import numpy as np
+		from PIL import Image
+		from lpctools.recolor import collapse_recolors
+
+		inputs = ['tests/recolor_files/hair_plain.png', 'tests/recolor_files/hair_page2.png', 'tests/recolor_files/expected_output']
+		groups = collapse_recolors(inputs)
+		assert [(base, len(members)) for base, _, members in groups] == [
+			('tests/recolor_files/hair_plain.png', 3), ('tests/recolor_files/hair_page2.png', 3), 
+			('tests/recolor_files/expected_output/human_head/ogre.png', 1)]
+
+		for base, mapping, members in groups:
+			for member, actual in zip(members, mapping.recolor_image(Image.open(base))):
+				expected = Image.open(member).convert('RGBA')
+				# transparent pixels may differ in RGB
+				expected, actual = np.array(expected), np.array(actual)
+				assert (expected[..., 3] == actual[..., 3]).all()
+				assert (expected[expected[..., 3] > 0] == actual[expected[..., 3] > 0]).all()
+
+
+	def test_concat_mappings(self, tmpdir):
+		import numpy as np
+		import lpctools
+		from lpctools.recolor import load_palette_mapping, concat_mappings, ImagePaletteMapping
+
+		mapping = load_palette_mapping('tests/recolor_files/palettes.json')
+		order = np.arange(len(mapping.source_palette))[::-1]
+		shuffled = mapping.reorder(order).rename(['blonde2', 'blue2'])
+		extra = ImagePaletteMapping(mapping.source_palette, {'blue': mapping.dests[0]})
+
+		concat = concat_mappings([mapping, shuffled])
+		assert concat.names == ['blonde', 'blue', 'blonde2', 'blue2']
+		assert dict(concat) == dict((mapping + shuffled).reorder_like(concat))
+
+		# later palettes replace earlier ones with the same name
+		concat = concat_mappings([mapping, shuffled, extra])
+		assert concat.names == ['blonde', 'blue', 'blonde2', 'blue2']
+		assert (concat.dests[1] == mapping.dests[0]).all()
+
+		concat = concat_mappings([mapping, shuffled], filter=['blue2', 'blonde'])
+		assert concat.names == ['blue2', 'blonde']
+		assert (concat.dests == mapping.dests[::-1]).all()
+
+		# unnamed palettes (e.g. from .png mappings) are named by their index, and are all kept
+		mapping.to_image(str(tmpdir / 'two.png'))
+		ImagePaletteMapping(mapping.source_palette, [mapping.dests[1]]).to_image(str(tmpdir / 'one.png'))
+		unnamed = [load_palette_mapping(str(tmpdir / 'two.png')), load_palette_mapping(str(tmpdir / 'one.png'))]
+		concat = concat_mappings(unnamed)
+		assert concat.n_palettes == (unnamed[0] + unnamed[1]).n_palettes == 3
+		assert (concat.dests == np.concatenate([mapping.dests, mapping.dests[1:]])).all()
+
+		lpctools.main(
+			shlex.split(f"colors concat-mappings --mapping tests/recolor_files/palettes.json --drop blonde --output '{tmpdir}/out.npz'")
+		)
+		assert load_palette_mapping(str(tmpdir / 'out.npz')).names == ['blue']
+
+
+	def test_recolor_tolerance(self, tmpdir):
+		import numpy as np
+		from PIL import Image
+		from lpctools.recolor import recolor, load_palette_mapping, load_palette, ImagePaletteMapping
+
+		mapping = load_palette_mapping('tests/recolor_files/palettes.json')
+		img = Image.open('tests/recolor_files/hair_plain.png').convert('RGBA')
+
+		# nudge every other opaque pixel by one step in one channel
+		arr = np.array(img)
+		drift = np.zeros(arr.shape, dtype=bool)
+		drift[..., 0] = (arr[..., 3] == 255) & (np.arange(arr.shape[1]) % 2 == 0)
+		drifted = np.where(drift, np.where(arr > 0, arr - 1, arr + 1), arr).astype('uint8')
+		n_drifted = drift.any(axis=-1).sum()
+		Image.fromarray(drifted).save(str(tmpdir / 'drifted.png'))
+
+		for expected, actual in zip(mapping.recolor_image(img), mapping.recolor_image(Image.fromarray(drifted), tolerance=1)):
+			assert (np.array(expected) == np.array(actual)).all()
+		for expected, actual in zip(mapping.recolor_image(img), mapping.recolor_image(Image.fromarray(drifted))):
+			assert (np.array(expected) != np.array(actual)).any(axis=-1).sum() == n_drifted
+
+		assert recolor([str(tmpdir / 'drifted.png')], [mapping], [f'{tmpdir}/%b/%p.%e'], tolerance=1) == n_drifted
+
+		palette = load_palette('tests/recolor_files/hair_plain.png')
+		doctored = palette.doctor_image(Image.fromarray(drifted), tolerance=1)
+		assert doctored['counts'] == [] and doctored['snapped'] == n_drifted
+		assert sum(palette.doctor_image(Image.fromarray(drifted))['counts']) == n_drifted
+
+		# with several mappings, pixels only snap to colors of the mapping being applied
+		a = ImagePaletteMapping([(10, 10, 10, 255)], {'a': [(200, 0, 0, 255)]})
+		b = ImagePaletteMapping([(14, 10, 10, 255)], {'b': [(0, 200, 0, 255)]})
+		Image.fromarray(np.array([[[13, 10, 10, 255], [17, 10, 10, 255]]], dtype='uint8')).save(str(tmpdir / 'near.png'))
+		assert recolor([str(tmpdir / 'near.png')], [a, b], [f'{tmpdir}/near/%p.png'], tolerance=3) == 3
+		assert np.array(Image.open(str(tmpdir / 'near' / 'a.png'))).tolist() == [[[200, 0, 0, 255], [17, 10, 10, 255]]]
+		assert np.array(Image.open(str(tmpdir / 'near' / 'b.png'))).tolist() == [[[0, 200, 0, 255], [0, 200, 0, 255]]]
+
+
+class TestCoerce():
+	def test_coerce_lut(self, tmpdir, monkeypatch):
+		import numpy as np
+		from PIL import Image
+		from lpctools.recolor import load_palette, coerce, coerce_images, nearest_palette_indices, NearestColorTable, pack_colors
+
+		monkeypatch.setenv('LPCTOOLS_CACHE_DIR', str(tmpdir))
+		NearestColorTable._tables.clear()
+		palette = load_palette('tests/recolor_files/ogre.gpl')
+		img = Image.open('tests/recolor_files/human_head.png').convert('RGBA')
+		arr = np.array(img)
+
+		for metric in ['rgb', 'lab']:
+			out = np.array(coerce(img, palette, engine='lut', metric=metric))
+
+			# every pixel gets its nearest palette color, and keeps its alpha
+			pal = palette.drop_alpha(unique=True).array
+			expected = pal[nearest_palette_indices(arr.reshape((-1, 4))[:, :3], pal, metric=metric)]
+			assert (out[..., :3] == expected[:, :3].reshape(arr.shape[:2] + (3,))).all()
+			assert (out[..., 3] == arr[..., 3]).all()
+
+			# the table is cached on disk, and gives the same result when reloaded
+			NearestColorTable._tables.clear()
+			assert (np.array(coerce(img, palette, engine='lut', metric=metric)) == out).all()
+		assert len(os.listdir(tmpdir / 'coerce')) == 2
+
+		# with several worker processes, the entries computed by each are merged, and saved once
+		NearestColorTable._tables.clear()
+		for f in os.listdir(tmpdir / 'coerce'):
+			os.remove(tmpdir / 'coerce' / f)
+		inputs = ['tests/recolor_files/human_head.png', 'tests/recolor_files/hair_plain.png']
+		coerce_images(inputs, [f'{tmpdir}/out/%b.png'], [palette], engine='lut', jobs=2)
+		NearestColorTable._tables.clear()
+		table = NearestColorTable.get(palette.drop_alpha(unique=True).array)
+		for path in inputs:
+			keys = pack_colors(np.array(Image.open(path).convert('RGBA'))) & 0xffffff
+			assert (table.lut[keys] != table.EMPTY).all()
+
+
+class TestDoctor():
+	def test_doctor(self, tmpdir):
+		import json
+		import numpy as np
+		from PIL import Image
+		import lpctools
+		from lpctools.recolor import load_palette
+
+		palette = load_palette('tests/recolor_files/expected_output/hair_plain/blue.png')
+		img = Image.open('tests/recolor_files/hair_plain.png').convert('RGBA')
+		doctored = palette.doctor_image(img)
+
+		# compare to a per-pixel check
+		arr = np.array(img)
+		good = {tuple(c) for c in palette.array.tolist()}
+		expected = {}
+		for c in map(tuple, arr.reshape(-1, 4).tolist()):
+			if c[3] != 0 and c not in good:
+				expected[c] = expected.get(c, 0) + 1
+		assert dict(zip(doctored['colors'].colors, doctored['counts'])) == expected
+		assert (np.array(doctored['img'])[..., 3] > 0).sum() == sum(expected.values())
+
+		lpctools.main(
+			shlex.split(f"colors doctor --input tests/recolor_files/hair_plain.png tests/recolor_files/expected_output/hair_plain "
+				f"--palette tests/recolor_files/expected_output/hair_plain/blue.png --output '{tmpdir}/%b.png' --report '{tmpdir}/report.json'")
+		)
+		with open(tmpdir / 'report.json') as f:
+			report = json.load(f)
+		assert report['tests/recolor_files/hair_plain.png']['bad_pixels'] == sum(expected.values())
+		assert report['tests/recolor_files/expected_output/hair_plain/blue.png'] == {'bad_pixels': 0, 'colors': {}}
+		assert sorted(os.listdir(tmpdir)) == ['blonde.png', 'hair_plain.png', 'report.json']
+
+
+class TestAudit():
+	def test_audit(self, tmpdir, monkeypatch):
+		import numpy as np
+		from PIL import Image
+		from lpctools.recolor import load_palette, audit_palette, audit_palettes
+
+		monkeypatch.setenv('LPCTOOLS_CACHE_DIR', str(tmpdir / 'cache'))
+		palette = load_palette('tests/recolor_files/expected_output/hair_plain/blue.png')
+		inputs = ['tests/recolor_files/hair_plain.png', 'tests/recolor_files/expected_output/hair_plain']
+
+		report = audit_palettes(inputs, palette)
+		assert report == audit_palettes(inputs, palette, cache=False)
+		assert len(os.listdir(tmpdir / 'cache' / 'audit')) == len(report['files'])
+		assert report['coverage'] == 1
+		assert report['palette']['#000027ff']['files'] == ['tests/recolor_files/expected_output/hair_plain/blue.png']
+		assert report['outside']['#300727ff']['files'] == ['tests/recolor_files/hair_plain.png']
+
+		# agrees with doctor
+		img = Image.open('tests/recolor_files/hair_plain.png')
+		doctored = palette.doctor_image(img)
+		assert report['files']['tests/recolor_files/hair_plain.png']['outside_pixels'] == sum(doctored['counts'])
+		audit = audit_palette(img, palette)
+		assert audit['outside'] == dict(zip([c.to_hex() for c in doctored['colors'].colors], doctored['counts']))
+		assert sum(audit['palette'].values()) + sum(audit['outside'].values()) == img.size[0] * img.size[1]
+
+
+class TestDifference():
+	def test_difference(self, tmpdir):
+		import json
+		import numpy as np
+		from PIL import Image
+		import lpctools
+		from lpctools.recolor import difference_images, difference_report
+
+		img = Image.open('tests/arrange_files/male.png').convert('RGBA')
+		arr = np.array(img)
+		# two separate edits in one frame of the second image, one spanning two frames in the third
+		arr2 = arr.copy()
+		arr2[10:12, 20:23] = [1, 2, 3, 255]
+		arr2[30, 40] = [1, 2, 3, 255]
+		arr3 = arr.copy()
+		arr3[70:74, 60:70] = [4, 5, 6, 255]
+		paths = [str(tmpdir / f'{i}.png') for i in range(3)]
+		for path, a in zip(paths, [arr, arr2, arr3]):
+			Image.fromarray(a).save(path)
+
+		mask, differs = difference_images(paths)
+		assert mask.sum() == 6 + 1 + 40
+		assert [d.sum() for d in differs] == [7, 40]
+
+		report = difference_report(mask, differs, paths=paths, layout='universal')
+		assert [(r['bbox'], r['pixels'], r['images']) for r in report['regions']] == [
+			([20, 10, 23, 12], 6, [paths[1]]), ([40, 30, 41, 31], 1, [paths[1]]), ([60, 70, 70, 74], 40, [paths[2]])]
+		frames = [(f['bbox'], f['pixels'], f['regions']) for f in report['frames']]
+		assert sorted(frames) == [([0, 6, 6, 10], 24, [2]), ([20, 10, 41, 31], 7, [0, 1]), ([60, 6, 64, 10], 16, [2])]
+
+		lpctools.main(
+			shlex.split(f"colors difference --input {' '.join(paths)} --output '{tmpdir}/diff.png' --report '{tmpdir}/diff.json'")
+		)
+		out = np.array(Image.open(str(tmpdir / 'diff.png')))
+		assert (out[mask] == arr[mask]).all() and (out[~mask] == [255, 255, 255, 0]).all()
+		with open(tmpdir / 'diff.json') as f:
+			assert len(json.load(f)['regions']) == 3
+
+
+class TestIncrementShade():
+	def test_increment_shade(self):
+		import numpy as np
+		from PIL import Image
+		from lpctools.recolor import ImagePalette, increment_shade, increment_shade_images
+
+		palette = ImagePalette(['#000000', '#555555', '#aaaaaa', '#ffffff'])
+		img = Image.fromarray(np.array([[palette.array[[0, 1, 2, 3]]] * 2], dtype='uint8').reshape((2, 4, 4)))
+		mask = Image.fromarray(np.array([
+			[[255, 0, 0, 255]] * 4,
+			[[0, 0, 255, 255]] * 4
+		], dtype='uint8'))
+		increments = {'#ff0000': 1, '#0000ff': -2}
+
+		def indices(out):
+			return [[palette.index(tuple(c)) for c in row] for row in np.array(out).tolist()]
+
+		assert indices(increment_shade(img, increments, mask, palette)) == [[1, 2, 3, 3], [0, 0, 0, 1]]
+		assert indices(increment_shade(img, increments, mask, palette, overflow='wrap')) == [[1, 2, 3, 0], [2, 3, 0, 1]]
+
+		# shading several images against one mask gives the same result as shading each
+		imgs = [img, img.transpose(Image.FLIP_LEFT_RIGHT)]
+		for out, img in zip(increment_shade_images(imgs, increments, mask, palette), imgs):
+			assert (np.array(out) == np.array(increment_shade(img, increments, mask, palette))).all()